@@ -6,16 +6,21 @@ from flask.ext.wtf import FileRequired
 
 from sqlalchemy.orm.exc import NoResultFound
 
+from newrem.cache import bump
 from newrem.config import load_config, write_config
+from newrem.converters import forget
 from newrem.files import save_file
+from newrem.images import remove_with_derivatives
+from newrem.jobs import queue, stage
 from newrem.forms import (ConfigForm, CreateCharacterForm,
                           DeleteCharacterForm, ModifyCharacterForm, NewsForm,
                           EditNewsForm, CreatePortraitForm,
                           ModifyPortraitForm, CreateUniverseForm,
                           ModifyUniverseForm, DeleteUniverseForm,
-                          CreateComicForm, ModifyComicForm)
+                          CreateComicForm, ModifyComicForm, RetryJobForm)
 from newrem.models import (db, Board, Character, Comic, Newspost, Portrait,
     Thread, Universe)
+from newrem.navigation import invalidate
 from newrem.security import Authenticator
 from newrem.util import abbreviate
 
@@ -57,6 +62,35 @@ admin = AdminBlueprint("admin", __name__, static_folder="static",
     template_folder="templates/admin")
 
 
+def forget_universe(u, renamed_from=None):
+    """
+    Drop everything cached about a universe, after changing it.
+
+    Call this after committing, so that nothing cached in between is built
+    from the old rows.
+    """
+
+    invalidate(u)
+    bump("universe", u.slug)
+    if renamed_from is not None:
+        bump("universe", renamed_from)
+    bump("comics")
+    forget(Universe, Character, Board)
+
+
+def derive(comic):
+    """
+    Queue up the smaller copies of a freshly saved comic. Until they are
+    made, the comic is shown as it is.
+    """
+
+    # Any copies are of the previous image.
+    comic.derivatives_version = None
+    db.session.commit()
+
+    queue.enqueue("derive", model="comic", id=comic.id)
+
+
 @admin.route("/")
 def index():
     form = CreateUniverseForm()
@@ -65,6 +99,29 @@ def index():
     return render_template("admin.html", form=form, universes=universes)
 
 
+@admin.route("/jobs")
+def jobs():
+    form = RetryJobForm()
+    counts = queue.counts() if queue.path else {}
+    recent = queue.recent() if queue.path else []
+
+    return render_template("jobs.html", form=form, counts=counts,
+        recent=recent, queued=queue.path is not None)
+
+
+@admin.route("/jobs/<int:jid>/retry", methods=("POST",))
+def jobs_retry(jid):
+    form = RetryJobForm()
+
+    if form.validate_on_submit() and queue.path:
+        queue.retry(jid)
+        flash("Job %d will be retried." % jid)
+    else:
+        flash("Couldn't validate form...")
+
+    return redirect(url_for("admin.jobs"))
+
+
 @admin.route("/config")
 def config():
     form = ConfigForm(current_app)
@@ -113,10 +170,10 @@ def universe_modify(u):
     form = ModifyUniverseForm()
 
     if form.validate_on_submit():
-        old = u.title
+        old, slug = u.title, u.slug
         u.rename(form.name.data)
-        db.session.add(u)
         db.session.commit()
+        forget_universe(u, renamed_from=slug)
         flash("Successfully renamed the universe of %s to %s!" %
             (old, u.title))
 
@@ -130,6 +187,7 @@ def universe_delete(u):
         if form.verify.data:
             db.session.delete(u)
             db.session.commit()
+            forget_universe(u)
             flash("Successfully destroyed universe %s!" % u.title)
         else:
             flash("Guess you changed your mind, huh? No worries.")
@@ -153,9 +211,6 @@ def character(u, c):
                                 description=c.description)
     dform = DeleteCharacterForm(prefix="delete")
 
-    # Character needs to be bound to a session.
-    db.session.add(c)
-
     return render_template("character.html", mform=mform, dform=dform, u=u,
         c=c)
 
@@ -186,14 +241,18 @@ def characters_modify(u, c):
     form = ModifyCharacterForm(prefix="modify")
 
     if form.validate_on_submit():
-        # Which modifications do we want to make?
-        db.session.add(c)
+        # Names and majority show up on universe pages.
+        listed = False
 
+        # Which modifications do we want to make?
         if form.name.data and form.name.data != c.name:
             c.rename(form.name.data)
+            listed = True
             flash("Successfully renamed character %s!" % c.name)
 
-        c.major = form.major.data
+        if form.major.data != c.major:
+            c.major = form.major.data
+            listed = True
 
         if form.portrait.file:
             if save_file(c.fp(), form.portrait.file):
@@ -211,6 +270,11 @@ def characters_modify(u, c):
                 c.name)
 
         db.session.commit()
+
+        if listed:
+            forget_universe(u)
+        else:
+            forget(Character)
     else:
         flash("Couldn't validate form...")
 
@@ -224,6 +288,7 @@ def characters_delete(u, c):
     if form.validate_on_submit():
         db.session.delete(c)
         db.session.commit()
+        forget_universe(u)
         c.fp().remove()
         flash("Successfully removed character %s!" % c.name)
     else:
@@ -247,7 +312,8 @@ def portraits_create():
         db.session.add(portrait)
         db.session.commit()
 
-        portrait.update_portrait(form.portrait.file)
+        queue.enqueue("portrait", slug=portrait.slug,
+                      staged=stage(form.portrait.file))
 
         flash("Successfully created portrait %s!" % portrait.name)
     else:
@@ -262,7 +328,8 @@ def portraits_modify():
     if form.validate_on_submit():
         portrait = form.portraits.data
         if portrait and form.portrait.file:
-            portrait.update_portrait(form.portrait.file)
+            queue.enqueue("portrait", slug=portrait.slug,
+                          staged=stage(form.portrait.file))
 
             flash("Successfully changed portrait for portrait %s!" %
                 portrait.name)
@@ -291,8 +358,6 @@ def news():
 
 @admin.route("/news/<newspost:n>", methods=("GET", "POST"))
 def newsdetail(n):
-    db.session.add(n)
-
     form = EditNewsForm()
 
     if form.validate_on_submit():
@@ -300,8 +365,8 @@ def newsdetail(n):
         n.title = form.title.data
         n.content = form.content.data
         n.portrait = form.portrait.data
-        db.session.add(n)
         db.session.commit()
+        forget(Newspost)
         flash("Successfully edited the news!")
         return redirect(url_for("index"))
 
@@ -348,7 +413,6 @@ def comics_create(u):
                 flash("Couldn't position comic: %s" % ", ".join(e.args))
                 return render_template("upload.html", form=form, u=u)
 
-        db.session.add(u)
         filename = secure_filename(form.file.file.filename)
 
         try:
@@ -358,7 +422,7 @@ def comics_create(u):
             return render_template("upload.html", form=form, u=u)
 
         comic.characters = form.characters.data
-        comic.title = form.title.data
+        comic.retitle(form.title.data)
         comic.description = form.description.data
         comic.comment = form.comment.data
         comic.thread = Thread(u.board, comic.title, "DCoN")
@@ -374,7 +438,10 @@ def comics_create(u):
         db.session.add(comic)
         db.session.commit()
 
-        save_file(comic.fp(), form.file.file)
+        if save_file(comic.fp(), form.file.file):
+            derive(comic)
+
+        forget_universe(u)
 
         return redirect(url_for("admin.comics_modify", u=u, cid=comic.id))
 
@@ -390,10 +457,9 @@ def comics_modify(u, cid):
     form = ModifyComicForm(u)
 
     if form.validate_on_submit():
-        db.session.add(u)
-
         # Attempt to set the new filename, and then verify it.
         if form.file.file:
+            replaced = comic.fp()
             comic.filename = secure_filename(form.file.file.filename)
             try:
                 comic.verify_fp()
@@ -403,7 +469,7 @@ def comics_modify(u, cid):
                                        comic=comic)
 
         comic.characters = form.characters.data
-        comic.title = form.title.data
+        comic.retitle(form.title.data)
         comic.description = form.description.data
         comic.comment = form.comment.data
 
@@ -426,9 +492,14 @@ def comics_modify(u, cid):
         db.session.add(comic)
         db.session.commit()
 
-        # Only write a new image down if requested.
+        # Only write a new image down if requested. The old one, and its
+        # smaller copies, go once the new one is in place.
         if form.file.file:
-            save_file(comic.fp(), form.file.file)
+            if save_file(comic.fp(), form.file.file):
+                remove_with_derivatives(replaced)
+                derive(comic)
+
+        forget_universe(u)
 
         return render_template("upload-modify.html", form=form, u=u,
                                comic=comic)
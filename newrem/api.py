@@ -0,0 +1,173 @@
+"""
+A read-only JSON API, for readers and mirrors which would otherwise scrape
+whole pages.
+
+Lists are paged by cursor rather than by offset: each page links to the
+next with the ID of its last item, and the next page carries on from that
+item's place in the ordering, so deep pages cost no more than the first.
+Only published comics are visible, as on the site itself.
+"""
+
+from datetime import datetime
+
+from sqlalchemy import and_, or_
+
+from flask import Blueprint, abort, jsonify, request, url_for
+
+from newrem.conditional import conditional, make_etag
+from newrem.filters import url_for_comic
+from newrem.models import db, Comic, posts_page
+from newrem.navigation import navigation_for
+from newrem.views import get_comic_query, universe_state
+
+api = Blueprint("api", __name__)
+
+# How many items go on a page, unless fewer are asked for.
+PER_PAGE = 50
+MAX_PER_PAGE = 100
+
+# The orders comics can be listed in. Ties are broken by ID.
+ORDERS = {
+    "position": Comic.position,
+    "time": Comic.time,
+}
+
+
+@api.errorhandler(400)
+@api.errorhandler(404)
+def error(e):
+    response = jsonify(error=e.name)
+    response.status_code = e.code
+    return response
+
+
+def page_size():
+    limit = request.args.get("limit", PER_PAGE, type=int)
+    return max(1, min(limit, MAX_PER_PAGE))
+
+
+def comic_json(comic):
+    d = comic.__json__()
+    d["url"] = url_for_comic(comic, _external=True)
+    d["image"] = comic.url()
+    d["web"] = comic.derivative_url("web")
+    d["thumb"] = comic.derivative_url("thumb")
+    return d
+
+
+def post_json(post):
+    d = post.__json__()
+    d["comment_html"] = unicode(post.html("comment"))
+    if post.filename:
+        d["image"] = post.url()
+        d["thumb"] = post.derivative_url("thumb")
+    return d
+
+
+def universe_validators(u, cid=None):
+    # Lists and navigation change when comics are edited, and when
+    # scheduled comics go live.
+    revision, newest, thread = universe_state(u, datetime.now())
+    return make_etag(u.slug, revision, newest, cid,
+                     request.query_string), None
+
+
+def posts_validators(u, cid):
+    revision, newest, thread = universe_state(u, datetime.now(), cid)
+    return make_etag(thread, request.query_string), None
+
+
+@api.route("/<universe:u>/comics")
+@conditional(universe_validators)
+def comics(u):
+    """
+    List the comics in a universe, in story order or, with
+    ``?order=time``, upload order.
+    """
+
+    order = request.args.get("order", "position")
+    if order not in ORDERS:
+        abort(400)
+    key = ORDERS[order]
+    limit = page_size()
+
+    q = get_comic_query(u)
+
+    after = request.args.get("after", type=int)
+    if after is not None:
+        sq = db.session.query(key).filter(Comic.universe_fk == u.slug)
+        sq = sq.filter(Comic.id == after).as_scalar()
+        q = q.filter(or_(key > sq, and_(key == sq, Comic.id > after)))
+
+    comics = q.order_by(key, Comic.id).limit(limit + 1).all()
+
+    if len(comics) > limit:
+        comics = comics[:limit]
+        next = url_for("api.comics", u=u, order=order, after=comics[-1].id,
+                       limit=limit, _external=True)
+    else:
+        next = None
+
+    return jsonify(comics=[comic_json(comic) for comic in comics],
+                   next=next)
+
+
+@api.route("/<universe:u>/comics/<int:cid>")
+@conditional(universe_validators)
+def comic(u, cid):
+    """
+    Get a comic, with its cast and the IDs of its neighbors.
+    """
+
+    comic = get_comic_query(u).filter_by(id=cid).first()
+    if comic is None:
+        abort(404)
+
+    index = navigation_for(u)
+    now = datetime.now()
+
+    first, previous, next, last = index.upload_neighbors(comic, now)
+    story = index.story_neighbors(comic, now)
+    slugs = [character.slug for character in comic.characters]
+    appearances = index.character_neighbors(comic, slugs, now)
+
+    d = comic_json(comic)
+    d["characters"] = [{"slug": c.slug, "name": c.name}
+                       for c in comic.characters]
+    d["navigation"] = {
+        "first": first,
+        "previous": previous,
+        "next": next,
+        "last": last,
+        "story": {"previous": story[0], "next": story[1]},
+        "characters": dict(
+            (slug, {"previous": pair[0], "next": pair[1]})
+            for slug, pair in appearances.iteritems()),
+    }
+    d["posts"] = url_for("api.posts", u=u, cid=cid, _external=True)
+
+    return jsonify(d)
+
+
+@api.route("/<universe:u>/comics/<int:cid>/posts")
+@conditional(posts_validators)
+def posts(u, cid):
+    """
+    List the posts discussing a comic, newest page first. Each page is in
+    posting order, and links to the page of posts before it.
+    """
+
+    comic = get_comic_query(u).filter_by(id=cid).first()
+    if comic is None:
+        abort(404)
+
+    limit = page_size()
+    before = request.args.get("before", type=int)
+
+    posts, older = posts_page(comic.threadid, before, limit=limit)
+
+    if older is not None:
+        older = url_for("api.posts", u=u, cid=cid, before=older, limit=limit,
+                        _external=True)
+
+    return jsonify(posts=[post_json(post) for post in posts], older=older)
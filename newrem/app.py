@@ -1,7 +1,17 @@
+import os.path
+from time import time
+
 from jinja2 import ChoiceLoader, FileSystemLoader
 from werkzeug.exceptions import NotFound
 from flask import Flask
-from flask.helpers import locked_cached_property, send_from_directory
+from flask.helpers import (locked_cached_property, safe_join,
+                           send_from_directory)
+
+from newrem import files
+from newrem.files import AssetManifest
+
+# How many static filenames to remember the paths of.
+MAX_STATIC_ROOTS = 10000
 
 
 class DCoN(Flask):
@@ -15,22 +25,92 @@ class DCoN(Flask):
 
         self.static_paths = []
         self.template_paths = []
+        self.assets = AssetManifest(self.static_paths)
+        self.static_roots = {}
 
-    def send_static_file(self, filename):
-        cache_timeout = self.get_send_file_max_age(filename)
+    def static_root(self, filename):
+        """
+        Find the static path which serves a file, or None if none does.
+
+        Answers, including misses, are remembered for a while, so that most
+        requests for static files don't have to look through every path.
+        """
+
+        entry = self.static_roots.get(filename)
+        if entry is not None and time() - entry[0] <= files.CHECK_INTERVAL:
+            return entry[1]
 
         l = self.static_paths[:]
         if self.has_static_folder:
             l.append(self.static_folder)
 
+        root = None
         for path in l:
-            try:
-                return send_from_directory(path, filename,
-                        cache_timeout=cache_timeout)
-            except NotFound:
-                continue
+            # safe_join() refuses filenames which escape their path.
+            if os.path.isfile(safe_join(path, filename)):
+                root = path
+                break
+
+        if len(self.static_roots) >= MAX_STATIC_ROOTS:
+            self.static_roots.clear()
+        self.static_roots[filename] = time(), root
+
+        return root
+
+    def send_static_file(self, filename):
+        cache_timeout = self.get_send_file_max_age(filename)
+
+        root = self.static_root(filename)
+        if root is None:
+            raise NotFound()
+
+        try:
+            response = send_from_directory(root, filename,
+                    cache_timeout=cache_timeout, conditional=True)
+        except NotFound:
+            # The file went away; look again next time.
+            self.static_roots.pop(filename, None)
+            raise
+
+        # send_file() has already set X-Sendfile if it was asked to; the
+        # front-end might want it spelled differently.
+        path = response.headers.pop("X-Sendfile", None)
+        if path is not None:
+            config = self.config.get("DCON_CONFIG", {})
+            if config.get("sendfile") == "x-accel-redirect":
+                prefix = config.get("sendfile_prefix", "/_sendfile")
+                response.headers["X-Accel-Redirect"] = prefix + path
+            else:
+                response.headers["X-Sendfile"] = path
+
+        return response
+
+    @locked_cached_property
+    def template_manifest(self):
+        """
+        Listings of the template directories, for finding per-universe
+        templates without asking the loaders and catching misses.
+        """
+
+        roots = self.template_paths[:]
+        if self.template_folder:
+            roots.append(os.path.join(self.root_path, self.template_folder))
+        for blueprint in self.blueprints.itervalues():
+            if blueprint.template_folder:
+                roots.append(os.path.join(blueprint.root_path,
+                                          blueprint.template_folder))
+
+        return AssetManifest(roots)
+
+    def universe_template(self, universe, name):
+        """
+        Pick the name of a universe's own version of a template, if it has
+        one, or else the generic template.
+        """
 
-        raise NotFound()
+        if name in self.template_manifest.names(["universe", universe.slug]):
+            return "universe/%s/%s" % (universe.slug, name)
+        return "universe/%s" % name
 
     @locked_cached_property
     def jinja_loader(self):
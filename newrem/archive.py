@@ -0,0 +1,452 @@
+"""
+Export and restore of whole universes.
+
+A universe is written to a tar archive as a stream of members, in the order
+they are restored::
+
+    universe.json           the universe, its board and the board's category
+    characters/00000.json   characters, each chunk followed by its portraits
+    files/characters/...
+    threads/00000.json      threads on the board or discussing comics
+    comics/00000.json       comics, with their casts
+    posts/00000.json        posts in those threads
+    files/...               uploads, by their unsharded segments
+
+Rows are read and written a chunk at a time, and files are streamed, so
+memory use doesn't grow with the universe. Smaller copies of images aren't
+archived; make them again with "make-derivatives" after a restore.
+
+Restoring keeps every row's ID, so links to comics and threads still work.
+Rows and files which are already present are skipped, so a broken restore
+can be run again. Anything else in the way stops the restore instead: a
+universe or board of the same name which differs, a row whose ID is taken by
+something else, or a comic whose time or filename is. Categories are only
+names, so an existing one is shared.
+
+Rows are inserted with their IDs, which doesn't move PostgreSQL's sequences
+along, so those are reset afterwards. Other databases need nothing done.
+"""
+
+from __future__ import with_statement
+
+from datetime import datetime
+import json
+from StringIO import StringIO
+import tarfile
+from time import time
+
+from sqlalchemy import or_, select, text
+
+from flask import current_app
+
+from newrem.files import CHUNK_SIZE, fp_root, sharded
+from newrem.models import (db, casts, acquire_upload, revise_thread,
+                           revise_universe, Board, Category, Character, Comic,
+                           Post, Thread, Universe)
+
+TIME_FORMATS = ("%Y-%m-%dT%H:%M:%S.%f", "%Y-%m-%dT%H:%M:%S")
+
+# The extra comic columns which Comic.__json__() leaves out.
+COMIC_COLUMNS = ("slug", "threadid", "universe_fk", "comment_html",
+                 "markup_version")
+
+
+def json_default(o):
+    if isinstance(o, datetime):
+        return o.isoformat()
+    raise TypeError("%r can't be archived" % o)
+
+
+def parse_time(value):
+    for format in TIME_FORMATS:
+        try:
+            return datetime.strptime(value, format)
+        except ValueError:
+            pass
+    raise ValueError("Couldn't understand time %r" % value)
+
+
+def columns(table, row):
+    """
+    Turn a row from an archive back into column values for a table.
+    """
+
+    values = {}
+
+    for column in table.columns:
+        if column.name not in row:
+            continue
+
+        value = row[column.name]
+        if value is not None and isinstance(column.type, db.DateTime):
+            value = parse_time(value)
+        values[column.name] = value
+
+    # Derivatives aren't archived.
+    if "derivatives_version" in table.c:
+        values["derivatives_version"] = None
+
+    return values
+
+
+def storage(segments):
+    """
+    Find where a file named in an archive lives under the upload root.
+
+    Only the kinds of file which are archived are allowed, and bp's
+    ``FilePath`` refuses segments which would escape the upload root.
+    """
+
+    if segments[0] not in ("characters", "comics", "comments"):
+        raise ValueError("Unexpected file %s" % "/".join(segments))
+
+    if segments[0] in ("comics", "comments"):
+        segments = sharded(segments)
+    return fp_root(current_app).descendant(segments)
+
+
+class Exporter(object):
+    """
+    Write a universe to a tar archive.
+    """
+
+    def __init__(self, universe, fileobj, gzip=False, chunk=500):
+        self.universe = universe
+        self.chunk = chunk
+        self.tar = tarfile.open(fileobj=fileobj,
+                                mode="w|gz" if gzip else "w|")
+
+    def forget(self):
+        # Tar files remember every member they have seen, which would grow
+        # without bound.
+        self.tar.members = []
+
+    def add_json(self, name, data):
+        body = json.dumps(data, default=json_default)
+        info = tarfile.TarInfo(name)
+        info.size = len(body)
+        info.mtime = time()
+        self.tar.addfile(info, StringIO(body))
+        self.forget()
+
+    def add_file(self, segments):
+        fp = storage(segments)
+        if fp.exists():
+            self.tar.add(fp.path, "files/" + "/".join(segments), False)
+            self.forget()
+            return True
+        return False
+
+    def rows(self, table, where):
+        """
+        Read rows of a table a chunk at a time, by primary key.
+        """
+
+        pk = list(table.primary_key.columns)[0]
+        last = None
+
+        while True:
+            q = table.select().where(where)
+            if last is not None:
+                q = q.where(pk > last)
+            rows = db.session.execute(q.order_by(pk).limit(self.chunk))
+            rows = [dict(row) for row in rows]
+            if not rows:
+                break
+
+            yield rows
+            last = rows[-1][pk.name]
+
+    def threads(self):
+        u = self.universe
+        q = select([Comic.threadid]).where(Comic.universe_fk == u.slug)
+        if u.board_fk is None:
+            return Thread.id.in_(q)
+        return or_(Thread.board_fk == u.board_fk, Thread.id.in_(q))
+
+    def export(self):
+        u = self.universe
+
+        board = category = None
+        if u.board is not None:
+            board = {"abbreviation": u.board.abbreviation,
+                     "name": u.board.name,
+                     "category_fk": u.board.category_fk}
+            if u.board.category_fk is not None:
+                category = {"title": u.board.category_fk}
+
+        self.add_json("universe.json", {
+            "universe": {"slug": u.slug, "title": u.title,
+                         "board_fk": u.board_fk},
+            "board": board,
+            "category": category,
+        })
+
+        files = 0
+
+        table = Character.__table__
+        for i, rows in enumerate(self.rows(table,
+                                           table.c.universe_fk == u.slug)):
+            self.add_json("characters/%05d.json" % i, rows)
+            for row in rows:
+                files += self.add_file(["characters", u.slug,
+                                        "%s.png" % row["slug"]])
+
+        threads = self.threads()
+        for i, rows in enumerate(self.rows(Thread.__table__, threads)):
+            self.add_json("threads/%05d.json" % i, rows)
+
+        for i, comics in enumerate(self.comics()):
+            self.add_json("comics/%05d.json" % i, comics)
+
+        posts = Post.threadid.in_(select([Thread.id]).where(threads))
+        for i, rows in enumerate(self.rows(Post.__table__, posts)):
+            self.add_json("posts/%05d.json" % i, rows)
+
+        last = 0
+        while True:
+            q = db.session.query(Comic.id, Comic.filename)
+            q = q.filter(Comic.universe_fk == u.slug, Comic.id > last)
+            rows = q.order_by(Comic.id).limit(self.chunk).all()
+            if not rows:
+                break
+
+            for cid, filename in rows:
+                files += self.add_file(["comics", u.slug, filename])
+            last = rows[-1][0]
+
+        last = ""
+        while True:
+            q = db.session.query(Post.filename).filter(posts)
+            q = q.filter(Post.filename > last).distinct()
+            filenames = [f for f, in q.order_by(Post.filename).limit(
+                self.chunk)]
+            if not filenames:
+                break
+
+            for filename in filenames:
+                files += self.add_file(["comments", filename])
+            last = filenames[-1]
+
+        self.tar.close()
+        return files
+
+    def comics(self):
+        """
+        Read comics a chunk at a time, with their casts.
+        """
+
+        last = 0
+        while True:
+            q = Comic.query.filter(Comic.universe_fk == self.universe.slug)
+            q = q.filter(Comic.id > last).order_by(Comic.id)
+            comics = q.limit(self.chunk).all()
+            if not comics:
+                break
+
+            ids = [comic.id for comic in comics]
+            cast = {}
+            q = select([casts.c.comic_id, casts.c.character_id])
+            for cid, slug in db.session.execute(
+                    q.where(casts.c.comic_id.in_(ids))):
+                cast.setdefault(cid, []).append(slug)
+
+            rows = []
+            for comic in comics:
+                row = comic.__json__()
+                for key in COMIC_COLUMNS:
+                    row[key] = getattr(comic, key)
+                row["characters"] = sorted(cast.get(comic.id, []))
+                rows.append(row)
+
+            yield rows
+            last = ids[-1]
+
+
+def insert_missing(table, owner, rows, unique=()):
+    """
+    Insert the rows which aren't in a table yet, and return them.
+
+    Rows already present must have the same values in the ``owner`` columns,
+    or else their IDs have been taken by something else. Rows which are
+    inserted mustn't clash with anything in the ``unique`` columns.
+    """
+
+    if not rows:
+        return []
+
+    pk = list(table.primary_key.columns)[0]
+    ids = [row[pk.name] for row in rows]
+
+    # Labelled, since the key may also be an owner.
+    labelled = [pk.label("id")]
+    for i, name in enumerate(owner):
+        labelled.append(table.c[name].label("owner_%d" % i))
+    q = select(labelled).where(pk.in_(ids))
+    present = dict((row[0], tuple(row[1:]))
+                   for row in db.session.execute(q))
+
+    missing = []
+    for row in rows:
+        if row[pk.name] not in present:
+            missing.append(row)
+        elif present[row[pk.name]] != tuple(row.get(name)
+                                            for name in owner):
+            raise ValueError("%s %s is already taken" %
+                             (table.name, row[pk.name]))
+
+    if not missing:
+        return []
+
+    for name in unique:
+        column = table.c[name]
+        q = select([column]).where(column.in_([row[name]
+                                               for row in missing]))
+        for value, in db.session.execute(q.limit(1)):
+            raise ValueError("%s %s %s is already taken" %
+                             (table.name, name, value))
+
+    db.session.execute(table.insert(), missing)
+    return missing
+
+
+class Restorer(object):
+    """
+    Read a universe back from a tar archive.
+    """
+
+    def __init__(self, fileobj):
+        self.tar = tarfile.open(fileobj=fileobj, mode="r|*")
+        self.counts = {}
+        self.slug = None
+
+    def count(self, kind, n):
+        self.counts[kind] = self.counts.get(kind, 0) + n
+
+    def load(self, member):
+        return json.load(self.tar.extractfile(member))
+
+    def restore(self):
+        """
+        Restore everything in the archive, committing after each member.
+
+        Returns how many rows and files of each kind were restored.
+        """
+
+        for member in self.tar:
+            name = member.name
+
+            if name == "universe.json":
+                self.restore_universe(self.load(member))
+            elif name.startswith("characters/"):
+                self.restore_characters(self.load(member))
+            elif name.startswith("threads/"):
+                self.restore_rows(Thread.__table__,
+                                  ("board_fk", "subject", "author"),
+                                  self.load(member))
+            elif name.startswith("comics/"):
+                self.restore_comics(self.load(member))
+            elif name.startswith("posts/"):
+                self.restore_posts(self.load(member))
+            elif name.startswith("files/") and member.isfile():
+                self.restore_file(member)
+
+            db.session.commit()
+            self.tar.members = []
+
+        self.reset_sequences()
+        return self.counts
+
+    def restore_universe(self, data):
+        if data["category"] is not None:
+            self.restore_rows(Category.__table__, ("title",),
+                              [data["category"]])
+        if data["board"] is not None:
+            self.restore_rows(Board.__table__, ("name", "category_fk"),
+                              [data["board"]])
+        self.restore_rows(Universe.__table__, ("title", "board_fk"),
+                          [data["universe"]])
+        self.slug = data["universe"]["slug"]
+
+    def restore_rows(self, table, owner, rows, unique=()):
+        rows = [columns(table, row) for row in rows]
+        missing = insert_missing(table, owner, rows, unique)
+        self.count(table.name, len(missing))
+        return missing
+
+    def restore_characters(self, rows):
+        missing = self.restore_rows(Character.__table__, ("universe_fk",),
+                                    rows)
+
+        # Inserted without the ORM, so revise the universe by hand.
+        if missing:
+            revise_universe(db.session.connection(), self.slug)
+
+    def restore_comics(self, rows):
+        cast = dict((row["id"], row["characters"]) for row in rows)
+        missing = self.restore_rows(Comic.__table__, ("universe_fk",), rows,
+                                    unique=("time", "filename"))
+
+        pairs = []
+        for row in missing:
+            for slug in cast[row["id"]]:
+                pairs.append({"comic_id": row["id"], "character_id": slug})
+        if pairs:
+            db.session.execute(casts.insert(), pairs)
+
+        # Inserted without the ORM, so revise the universe by hand.
+        if missing:
+            revise_universe(db.session.connection(), self.slug)
+
+    def restore_posts(self, rows):
+        missing = self.restore_rows(Post.__table__,
+                                    ("threadid", "timestamp"), rows)
+
+        # Inserted without the ORM, so count their uploads and revise their
+        # threads by hand.
+        connection = db.session.connection()
+        for row in missing:
+            if row.get("filename"):
+                acquire_upload(connection, row["filename"])
+        for threadid in set(row["threadid"] for row in missing):
+            revise_thread(connection, threadid)
+
+    def reset_sequences(self):
+        """
+        Move PostgreSQL's sequences past the IDs which were restored.
+        """
+
+        connection = db.session.connection()
+        if connection.dialect.name != "postgresql":
+            return
+
+        preparer = connection.dialect.identifier_preparer
+        for table in Thread.__table__, Comic.__table__, Post.__table__:
+            connection.execute(text(
+                "SELECT setval(pg_get_serial_sequence(:table, 'id'), "
+                "(SELECT coalesce(max(id), 1) FROM %s))" %
+                preparer.format_table(table)), table=table.name)
+        db.session.commit()
+
+    def restore_file(self, member):
+        segments = member.name.split("/")[1:]
+        fp = storage(segments)
+        if fp.exists():
+            return
+
+        if not fp.parent().exists():
+            fp.parent().makedirs()
+
+        # Renamed into place once whole, so that a broken restore doesn't
+        # leave half a file behind to be skipped next time.
+        temporary = fp.temporarySibling()
+        source = self.tar.extractfile(member)
+        with open(temporary.path, "wb") as handle:
+            while True:
+                chunk = source.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                handle.write(chunk)
+        temporary.moveTo(fp)
+
+        self.count("files", 1)
@@ -0,0 +1,148 @@
+"""
+Caching of rendered output.
+
+Cached entries are grouped under generations. Rather than finding and
+deleting every entry which depends on, say, a universe, the universe's
+generation is replaced; entries are keyed by generation, so the old ones are
+simply never read again and age out on their own.
+
+Invalidation only reaches the processes which share the cache. A site run by
+more than one process, including a job worker next to the site, should set
+``cache_dir`` so that every process shares one cache. Otherwise, the site
+should say that it is a single process with ``single_process: true``; manage
+commands then can't reach the running site, and it is restarted after them.
+Sites which say neither still start, with a warning, and each process keeps
+its own short-lived cache.
+"""
+
+from datetime import datetime
+from os import urandom
+
+from werkzeug.contrib.cache import FileSystemCache, SimpleCache
+
+# The longest, in seconds, that anything is cached in a single process. Other
+# processes can't see invalidations, so this is kept short.
+DEFAULT_TIMEOUT = 300
+
+# The longest, in seconds, that anything is cached in a cache shared by all
+# processes. Invalidations reach everybody, so only expirations matter.
+SHARED_TIMEOUT = 6 * 60 * 60
+
+
+class Cache(object):
+    """
+    A cache whose backend is picked when the application is configured.
+
+    Until then, and by default, each process keeps its own ``SimpleCache``.
+    """
+
+    def __init__(self):
+        self.backend = SimpleCache(default_timeout=DEFAULT_TIMEOUT)
+        self.timeout = DEFAULT_TIMEOUT
+
+    def __getattr__(self, name):
+        return getattr(self.backend, name)
+
+
+cache = Cache()
+
+
+def configure_cache(app):
+    """
+    Set up the cache from the site configuration.
+
+    If ``cache_dir`` is set, the cache is kept in files in that directory, so
+    that every worker process shares it. Otherwise, each process keeps its
+    own, which is only safe when ``single_process`` is set and no job worker
+    runs alongside the site; anything else is warned about.
+    """
+
+    config = app.config["DCON_CONFIG"]
+    directory = config.get("cache_dir")
+
+    if not directory:
+        if config.get("job_queue"):
+            app.logger.warning("The job worker is another process, so set "
+                               "cache_dir with job_queue; until then, pages "
+                               "may lag behind its work")
+        elif not config.get("single_process"):
+            app.logger.warning("Set cache_dir to share the cache between "
+                               "processes, or single_process if there's "
+                               "only one; until then, each process keeps "
+                               "its own cache")
+
+    if directory:
+        cache.backend = FileSystemCache(directory,
+            threshold=config.get("cache_threshold", 5000),
+            default_timeout=SHARED_TIMEOUT)
+        cache.timeout = SHARED_TIMEOUT
+    else:
+        cache.backend = SimpleCache(default_timeout=DEFAULT_TIMEOUT)
+        cache.timeout = DEFAULT_TIMEOUT
+
+
+def shared():
+    """
+    Whether invalidations reach every process, or only this one.
+    """
+
+    return isinstance(cache.backend, FileSystemCache)
+
+
+# Generations must outlive everything keyed on them.
+GENERATION_TIMEOUT = 24 * 60 * 60
+
+
+def generation_key(*parts):
+    return "generation:%s" % ":".join(str(part) for part in parts)
+
+
+def new_generation():
+    return urandom(8).encode("hex")
+
+
+def generation(*parts):
+    """
+    Get the current generation for some cached thing, such as a universe.
+    """
+
+    key = generation_key(*parts)
+    value = cache.get(key)
+
+    if value is None:
+        # Never fall back to a well-known value; an entry from before this
+        # generation was lost could still be around.
+        cache.add(key, new_generation(), timeout=GENERATION_TIMEOUT)
+        value = cache.get(key)
+
+    return value
+
+
+def bump(*parts):
+    """
+    Invalidate everything cached under a generation.
+    """
+
+    cache.set(generation_key(*parts), new_generation(),
+              timeout=GENERATION_TIMEOUT)
+
+
+def timeout_until(when, now=None):
+    """
+    Figure out how long to cache something which becomes stale at ``when``.
+
+    ``when`` may be None, for things which never go stale on their own.
+    """
+
+    if when is None:
+        return cache.timeout
+
+    if now is None:
+        now = datetime.now()
+
+    delta = when - now
+    seconds = delta.days * 24 * 60 * 60 + delta.seconds
+    if delta.microseconds:
+        seconds += 1
+
+    return max(1, min(seconds, cache.timeout))
@@ -1,29 +1,33 @@
-from flask import Blueprint, render_template, request, url_for
+from flask import (Blueprint, abort, current_app, render_template, request,
+                   url_for)
 
+from sqlalchemy import select, union_all
+
+from newrem.files import fp_root, save_upload
 from newrem.forms import ChanForm
+from newrem.jobs import queue
 from newrem.models import db, Board, Post, Thread
-from newrem.util import chan_filename
 
 osuchan = Blueprint("osuchan", __name__, static_folder="static",
     template_folder="templates")
 
 header = "OSUChan"
 
+# How many threads to list on each page of a board.
+THREADS_PER_PAGE = 10
+
+# How many of the latest replies to show under each thread on a board.
+REPLIES_SHOWN = 3
+
 def save_file(f):
     """
-    Save the given file resource to disk.
+    Save the given file resource to disk, alongside comic comments.
 
     Returns the filename on disk.
     """
 
-    # Empty file?
-    if not f.content_length:
-        return ""
-
-    filename = chan_filename(f)
-    f.save("static/images/%s" % filename)
-
-    return filename
+    directory = fp_root(current_app).child("comments")
+    return save_upload(f, directory) or ""
 
 @osuchan.route('/')
 def index():
@@ -46,20 +50,23 @@ def comment(b):
     thread = Thread(b, form.subject.data, form.name.data)
     post = Post(form.name.data, form.comment.data, form.email.data, filename)
 
-    thread.posts = [post]
+    thread.add_post(post)
 
     db.session.add(thread)
     db.session.commit()
 
+    if post.filename:
+        queue.enqueue("derive", model="post", id=post.id)
+
     email = form.email.data
 
     if email == "noko":
         if request.referrer:
             url = request.referrer
         else:
-            url = url_for("osuchan.showthread", board=b, tid=thread)
+            url = url_for("osuchan.showthread", b=b, tid=thread.id)
     else:
-        url = url_for("osuchan.showboard", board=b)
+        url = url_for("osuchan.showboard", b=b)
 
     return render_template("oc/redirect.html", url=url)
 
@@ -70,36 +77,94 @@ def threadcomment(b, thread):
     if not form.validate_on_submit():
         return "Error"
 
+    # Look the thread up first, so that a missing thread doesn't leave an
+    # upload behind which nothing refers to.
+    t = Thread.query.filter_by(id=thread, board=b).first_or_404()
+
     if "datafile" in request.files:
         filename = save_file(request.files["datafile"])
     else:
         filename = ""
 
     post = Post(form.name.data, form.comment.data, form.email.data, filename)
-    post.threadid = thread
+    t.add_post(post)
 
     db.session.add(post)
     db.session.commit()
 
+    if post.filename:
+        queue.enqueue("derive", model="post", id=post.id)
+
     email = form.email.data
 
     if email == "noko":
         if request.referrer:
             url = request.referrer
         else:
-            url = url_for("osuchan.showthread", board=b, tid=thread)
+            url = url_for("osuchan.showthread", b=b, tid=thread)
     else:
-        url = url_for("osuchan.showboard", board=b)
+        url = url_for("osuchan.showboard", b=b)
 
     return render_template("oc/redirect.html", url=url)
 
+def previews(threads):
+    """
+    Fetch the opening post and the latest few replies of each of several
+    threads, along with how many replies were left out.
+
+    Returns a dictionary of thread IDs to (posts, omitted) pairs. This takes
+    one query however many threads there are; each thread's posts are picked
+    by two short walks of its index, one from either end.
+    """
+
+    ids = [thread.id for thread in threads]
+    if not ids:
+        return {}
+
+    branches = []
+    for tid in ids:
+        q = db.session.query(Post.id).filter(Post.threadid == tid)
+        opening = q.order_by(Post.timestamp, Post.id).limit(1)
+        latest = q.order_by(Post.timestamp.desc(), Post.id.desc())
+        latest = latest.limit(REPLIES_SHOWN)
+
+        # Wrapped, since not every database allows a LIMIT inside a UNION.
+        for sq in opening.subquery(), latest.subquery():
+            branches.append(select([sq.c.id]))
+
+    q = Post.query.filter(Post.id.in_(union_all(*branches)))
+    q = q.order_by(Post.threadid, Post.timestamp, Post.id)
+
+    d = dict((tid, []) for tid in ids)
+    for post in q:
+        d[post.threadid].append(post)
+
+    for thread in threads:
+        posts = d[thread.id]
+        d[thread.id] = posts, max(0, thread.post_count - len(posts))
+
+    return d
+
 @osuchan.route('/<board:b>/')
 def showboard(b):
     form = ChanForm()
-    threads = Thread.query.filter_by(board=b).all()
+
+    page = request.args.get("page", 1, type=int)
+    if page < 1:
+        abort(404)
+
+    q = Thread.query.filter_by(board=b)
+    pages = max(1, -(-q.count() // THREADS_PER_PAGE))
+    if page > pages:
+        abort(404)
+
+    q = q.order_by(Thread.bumped.desc(), Thread.id.desc())
+    start = (page - 1) * THREADS_PER_PAGE
+    threads = q[start:start + THREADS_PER_PAGE]
 
     return render_template("oc/showboard.html", title=b.abbreviation, board=b,
-        threads=threads, form=form)
+        threads=threads, previews=previews(threads), page=page, pages=pages,
+        form=form)
 
 @osuchan.route('/<board:b>/<int:tid>')
 def showthread(b, tid):
@@ -0,0 +1,100 @@
+"""
+Conditional GET support.
+
+Views work out cheap validators for their output before doing any real work,
+so that clients which already have the current version can be answered with
+a bare 304.
+"""
+
+from functools import wraps
+from hashlib import md5
+
+from flask import g, make_response, request
+
+
+def make_etag(*parts):
+    """
+    Make an entity tag out of anything which identifies a version of a page.
+    """
+
+    return md5(":".join(str(part) for part in parts)).hexdigest()
+
+
+def whole_seconds(dt):
+    """
+    HTTP dates don't have sub-second precision, so neither should anything
+    compared against them.
+    """
+
+    if dt is None:
+        return None
+    return dt.replace(microsecond=0)
+
+
+def is_fresh(etag=None, last_modified=None):
+    """
+    Check whether the client's copy matches the given validators.
+
+    As in RFC 2616, an entity tag takes precedence over a modification time.
+    """
+
+    if request.method not in ("GET", "HEAD"):
+        return False
+
+    if request.if_none_match:
+        return etag is not None and request.if_none_match.contains_weak(etag)
+
+    if request.if_modified_since and last_modified is not None:
+        return whole_seconds(last_modified) <= request.if_modified_since
+
+    return False
+
+
+def with_validators(response, etag=None, last_modified=None):
+    """
+    Attach validators to a response.
+
+    Responses are marked so that clients always check back with us before
+    reusing them; the check is cheap, and pages change when comics go live.
+    """
+
+    response = make_response(response)
+
+    if etag is not None:
+        response.set_etag(etag, weak=True)
+    if last_modified is not None:
+        response.last_modified = whole_seconds(last_modified)
+    response.cache_control.no_cache = True
+
+    return response
+
+
+def not_modified(etag=None, last_modified=None):
+    return with_validators(("", 304), etag, last_modified)
+
+
+def conditional(validators):
+    """
+    Answer conditional requests for a view.
+
+    ``validators`` is called with the view's arguments and returns an entity
+    tag and a last-modified time, either of which may be None. The view
+    itself is only called if the client's copy is out of date.
+
+    The entity tag is kept as ``g.etag``, so that ``cached()`` can file the
+    output under it.
+    """
+
+    def decorator(f):
+        @wraps(f)
+        def decorated(*args, **kwargs):
+            etag, last_modified = validators(*args, **kwargs)
+            g.etag = etag
+
+            if is_fresh(etag, last_modified):
+                return not_modified(etag, last_modified)
+
+            response = f(*args, **kwargs)
+            return with_validators(response, etag, last_modified)
+        return decorated
+    return decorator
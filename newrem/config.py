@@ -2,6 +2,11 @@ import os.path
 
 import yaml
 
+from newrem.cache import configure_cache
+from newrem.files import AssetManifest
+from newrem.jobs import configure_jobs
+from newrem.markup import configure_markup
+
 
 def load_config(app):
     config = {
@@ -25,6 +30,20 @@ def load_config(app):
         app.static_paths = [os.path.join(assets, "static")]
         app.template_paths = [os.path.join(assets, "template")]
 
+    # Banners and 404 images are picked from the static paths on every page
+    # view, so list them now rather than then.
+    app.assets = AssetManifest(app.static_paths)
+    app.assets.build()
+    app.static_roots = {}
+
+    # Let the front-end server send static files itself, if it can.
+    app.config["USE_X_SENDFILE"] = config.get("sendfile") in ("x-sendfile",
+        "x-accel-redirect")
+
+    configure_cache(app)
+    configure_markup(app)
+    configure_jobs(app)
+
 
 def write_config(app):
     config = app.config["DCON_CONFIG"]
@@ -2,9 +2,12 @@ from __future__ import with_statement
 
 from datetime import datetime
 from calendar import timegm
+from time import time
 
+from werkzeug.exceptions import NotFound
 from werkzeug.routing import BaseConverter, ValidationError
 
+from sqlalchemy import inspect
 from sqlalchemy.orm.exc import MultipleResultsFound, NoResultFound
 from sqlalchemy.types import DateTime
 
@@ -16,6 +19,30 @@ thawers = {
     DateTime: lambda s: datetime.utcfromtimestamp(float(s)),
 }
 
+# How long, in seconds, a looked-up primary key may be reused. Admin edits
+# forget keys immediately in the process which made them; other processes
+# may map a renamed segment to its old row until this runs out, but rows
+# themselves are always loaded fresh.
+MAX_AGE = 60
+
+# How many keys each converter remembers at most.
+MAX_ENTRIES = 1000
+
+# Every converter made by make_model_converter(), for forget().
+converters = []
+
+class Lookup(object):
+    """
+    A row found by a converter, to be loaded by ``merge_view_args()``.
+    """
+
+    def __init__(self, model, key):
+        self.model = model
+        self.key = key
+
+    def __repr__(self):
+        return "<Lookup(%s, %r)>" % (self.model.__name__, self.key)
+
 class ModelConverter(BaseConverter):
     """
     Converts a URL segment to and from a SQLAlchemy model.
@@ -24,21 +51,40 @@ class ModelConverter(BaseConverter):
     the `model` and `field` class attributes filled in. `model` is the
     Flask-SQLAlchemy model to use for queries, and `field` is the field on the
     model to use for lookups.
+
+    URLs are matched before the request's session is available, so only the
+    row's primary key is found here, as a ``Lookup``. Keys are remembered for
+    a while, so that popular segments don't need a query. ``merge_view_args()``
+    then loads the row itself through the request's session, so views always
+    see it as it is now.
     """
 
     def to_python(self, value):
         value = self.thawer(value)
 
-        try:
-            with self.app.test_request_context():
-                obj = self.model.query.filter_by(**{self.field: value}).one()
-        except (MultipleResultsFound, NoResultFound):
-            raise ValidationError()
+        entry = self.keys.get(value)
+        if entry is None or time() - entry[0] > MAX_AGE:
+            pk = inspect(self.model).primary_key[0]
+            try:
+                with self.app.app_context():
+                    q = self.model.query.filter_by(**{self.field: value})
+                    key = q.with_entities(pk).one()[0]
+            except (MultipleResultsFound, NoResultFound):
+                raise ValidationError()
 
-        return obj
+            if len(self.keys) >= MAX_ENTRIES:
+                self.keys.clear()
+            self.keys[value] = time(), key
+        else:
+            key = entry[1]
+
+        return Lookup(self.model, key)
 
     def to_url(self, value):
-        return self.freezer(getattr(value, self.field))
+        # Either an object or just the value of its field will do.
+        if isinstance(value, self.model):
+            value = getattr(value, self.field)
+        return self.freezer(value)
 
 def make_model_converter(a, m, f):
     """
@@ -53,5 +99,36 @@ def make_model_converter(a, m, f):
         model = m
         freezer = staticmethod(freezers.get(column_type, str))
         thawer = staticmethod(thawers.get(column_type, unicode))
+        keys = {}
+
+    converters.append(Subclass)
 
     return Subclass
+
+def forget(*models):
+    """
+    Forget every remembered key of the given models, after they change.
+    """
+
+    for converter in converters:
+        if converter.model in models:
+            converter.keys.clear()
+
+def merge_view_args(session, values):
+    """
+    Load the rows found by converters through a session.
+
+    Register this as a URL value preprocessor, so that views get objects
+    which they can query and modify like any other. A row which has gone
+    since its key was remembered is not found.
+    """
+
+    if not values:
+        return
+
+    for key, value in values.items():
+        if isinstance(value, Lookup):
+            obj = session.query(value.model).get(value.key)
+            if obj is None:
+                raise NotFound()
+            values[key] = obj
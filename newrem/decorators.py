@@ -1,19 +1,44 @@
 from functools import wraps
 
-from werkzeug.contrib.cache import SimpleCache
+from flask import g, request
 
-from flask import request
+from newrem.cache import cache, generation, timeout_until
 
-cache = SimpleCache()
+def cached(depends, expires=None):
+    """
+    Cache a view's output by request path.
+
+    ``depends`` is called with the view's arguments and returns a list of
+    generations, as tuples of parts, which the output depends on; bumping any
+    of them invalidates the cached output. ``expires``, if given, is also
+    called with the view's arguments and returns the time at which the output
+    goes stale on its own, or None.
+
+    Behind ``conditional()``, the output is also filed under its entity tag,
+    so that output cached before a change which no generation was bumped for
+    is never sent with the tag from after it.
+    """
+
+    def decorator(f):
+        @wraps(f)
+        def decorated(*args, **kwargs):
+            parts = [request.path]
+            for dependency in depends(*args, **kwargs):
+                parts.append(generation(*dependency))
+            parts.append(getattr(g, "etag", None) or "")
+            key = "view:%s" % ":".join(parts)
+
+            data = cache.get(key)
+            if data is not None:
+                return data
+            data = f(*args, **kwargs)
+
+            if expires is None:
+                when = None
+            else:
+                when = expires(*args, **kwargs)
+            cache.set(key, data, timeout=timeout_until(when))
 
-def cached(f):
-    @wraps(f)
-    def decorated(*args, **kwargs):
-        key = request.path
-        data = cache.get(key)
-        if data is not None:
             return data
-        data = f(*args, **kwargs)
-        cache.set(key, data)
-        return data
-    return decorated
+        return decorated
+    return decorator
@@ -1,7 +1,27 @@
+from __future__ import with_statement
+
+from hashlib import md5
+from os import urandom
+from time import time
+
 from bp.filepath import FilePath
 
 from flask import flash
 
+from newrem.images import sniff_extension
+
+# How long, in seconds, a directory listing is trusted before checking
+# whether the directory has changed.
+CHECK_INTERVAL = 10
+
+# How many bytes of an upload to read at a time.
+CHUNK_SIZE = 64 * 1024
+
+# How many levels of directories uploads are spread across. Each level is
+# named by two hex digits of a hash of the upload's filename, so each
+# directory holds about 1/256th of the uploads of the one above it.
+SHARD_LEVELS = 2
+
 
 def fp_root(app):
     """
@@ -47,6 +67,159 @@ def save_file(fp, fs):
         return True
 
 
+def shard(filename):
+    """
+    Pick the directories an upload goes in, by its filename.
+    """
+
+    if isinstance(filename, unicode):
+        filename = filename.encode("utf-8")
+
+    digest = md5(filename).hexdigest()
+    return [digest[i * 2:i * 2 + 2] for i in range(SHARD_LEVELS)]
+
+
+def sharded(segments):
+    """
+    Spread some segments naming an upload across shard directories.
+    """
+
+    return segments[:-1] + shard(segments[-1]) + segments[-1:]
+
+
+def save_upload(fs, directory):
+    """
+    Save an uploaded ``FileStorage`` into the shards of a ``FilePath``
+    directory, under a name made from a hash of its contents, and return that
+    name.
+
+    The upload is hashed in chunks while it is written, so it is read once
+    and never held in memory. If the same content is already there, the new
+    copy is thrown away instead. The extension comes from the image's own
+    header. Uploads which are empty, or aren't images in one of the allowed
+    formats, aren't saved, and give None.
+    """
+
+    if not directory.exists():
+        directory.makedirs()
+
+    # Written beside its final name, so that it can be renamed into place
+    # whole.
+    temporary = directory.child(".upload-%s" % urandom(8).encode("hex"))
+    hash = md5()
+    size = 0
+
+    try:
+        with open(temporary.path, "wb") as handle:
+            while True:
+                chunk = fs.stream.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                hash.update(chunk)
+                handle.write(chunk)
+                size += len(chunk)
+
+        # Named by what the upload is, not by what the client says it is.
+        extension = size and sniff_extension(temporary.path)
+        if not extension:
+            temporary.remove()
+            return None
+
+        filename = hash.hexdigest() + extension
+
+        fp = directory.descendant(shard(filename) + [filename])
+        if fp.exists():
+            temporary.remove()
+        else:
+            if not fp.parent().exists():
+                fp.parent().makedirs()
+            temporary.moveTo(fp)
+    except:
+        if temporary.exists():
+            temporary.remove()
+        raise
+
+    return filename
+
+
+class AssetManifest(object):
+    """
+    An in-memory listing of the directories under a list of static paths.
+
+    Listings are checked against their directories' modification times at
+    most every ``CHECK_INTERVAL`` seconds, so asking for a listing usually
+    costs no system calls at all. Directories which don't exist are
+    remembered too.
+    """
+
+    def __init__(self, paths):
+        self.paths = paths
+        self.listings = {}
+
+    def build(self):
+        """
+        List every directory under the static paths up front.
+        """
+
+        for path in self.paths:
+            root = FilePath(path)
+            if not root.isdir():
+                continue
+
+            for fp in root.walk():
+                if fp != root and fp.isdir():
+                    self.scan(tuple(fp.segmentsFrom(root)))
+
+    def stamps(self, segments):
+        """
+        Find the modification times of the directories named by some
+        segments, one for each static path; None for those which don't exist.
+        """
+
+        stamps = []
+
+        for path in self.paths:
+            fp = FilePath(path).descendant(segments)
+            if fp.isdir():
+                stamps.append((path, fp.getModificationTime()))
+            else:
+                stamps.append((path, None))
+
+        return stamps
+
+    def scan(self, segments):
+        stamps = self.stamps(segments)
+        names = []
+
+        for path, mtime in stamps:
+            if mtime is not None:
+                fp = FilePath(path).descendant(segments)
+                names.extend(sorted(p.basename() for p in fp.children()))
+
+        self.listings[segments] = time(), stamps, names
+        return names
+
+    def names(self, segments):
+        """
+        Get the basenames of everything in the directories named by some
+        segments, across all of the static paths.
+        """
+
+        segments = tuple(segments)
+        listing = self.listings.get(segments)
+
+        if listing is None:
+            return self.scan(segments)
+
+        checked, stamps, names = listing
+        if time() - checked > CHECK_INTERVAL:
+            if self.stamps(segments) != stamps:
+                return self.scan(segments)
+            self.listings[segments] = time(), stamps, names
+
+        return names
+
+
 def assets_in_paths(app, segments):
     """
     Select some assets from all of the static paths in the app which match the
@@ -56,14 +229,4 @@ def assets_in_paths(app, segments):
     other images.
     """
 
-    names = []
-
-    for path in app.static_paths:
-        root = FilePath(path)
-        fp = root.descendant(segments)
-
-        # Get some banners, if they exist.
-        if fp.exists():
-            names.extend([p.basename() for p in fp.children()])
-
-    return names
+    return app.assets.names(segments)
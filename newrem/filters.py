@@ -4,8 +4,16 @@ from newrem.util import slugify
 
 
 def url_for_comic(comic, **kwargs):
-    return url_for("comics", u=comic.universe, cid=comic.id,
-                   name=slugify(comic.title), **kwargs)
+    """
+    Build the URL for a comic using only its own columns, so that long lists
+    of comics don't load their universes.
+    """
+
+    # Comics from before slugs were stored have to make one up.
+    name = comic.slug or slugify(comic.title)
+
+    return url_for("comics", u=comic.universe_fk, cid=comic.id, name=name,
+                   **kwargs)
 
 
 def load_filters(app):
@@ -115,6 +115,9 @@ CreateCharacterForm, ModifyCharacterForm = makeCU(CharacterBase)
 class DeleteCharacterForm(FormBase):
     submit = SubmitField("Delete!")
 
+class RetryJobForm(FormBase):
+    submit = SubmitField("Retry")
+
 class CreatePortraitForm(FormBase):
     name = TextField(u"New name", validators=(Required(),))
     portrait = portrait
@@ -222,5 +225,5 @@ class ChanForm(FormBase):
     email = TextField("Email")
     subject = TextField("Subject")
     comment = TextAreaField("Comment")
-    datafile = FileField("Image")
+    datafile = FileField("Image", validators=(BetterFileAllowed(images),))
     submit = SubmitField("Submit")
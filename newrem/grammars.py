@@ -47,3 +47,211 @@ safe_paragraphs = (safe_entities | entities | anything)*:l
 """
 
 BlogGrammar = makeGrammar(blog_grammar + html_grammar, {})
+
+
+escapes = {
+    "<": "&lt;",
+    ">": "&gt;",
+    "&": "&amp;",
+    "'": "&apos;",
+    '"': "&quot;",
+}
+
+# Kinds of decorations, with their delimiter lengths and tags.
+BOLD, ITALICS, UNDERLINE = 1, 2, 3
+decoration_tags = {
+    BOLD: (2, "<b>", "</b>"),
+    ITALICS: (1, "<i>", "</i>"),
+    UNDERLINE: (1, "<u>", "</u>"),
+}
+
+
+class LinearBlogGrammar(object):
+    """
+    A renderer for the blog grammar which takes time linear in the size of
+    its input, and which produces exactly the same output as ``BlogGrammar``.
+
+    The blog grammar is a PEG, so whether a rule matches at some position
+    depends only on the text after that position. The renderer makes a pass
+    from the end of the text to the beginning, recording where each rule
+    stops when tried at each position, and then a pass forward to emit HTML
+    for the rules which matched.
+    """
+
+    def __init__(self, s):
+        self.s = s
+        self._analyze()
+
+    def _analyze(self):
+        s = self.s
+        n = len(s)
+
+        # For each position: where nested_decos ends, or 0 if it fails; which
+        # decoration, if any, matches; and where the repetition inside each
+        # kind of decoration, and inside greentext, stops.
+        nested = [0] * (n + 2)
+        decoration = [0] * (n + 2)
+        bold_stop = [0] * (n + 2)
+        italics_stop = [0] * (n + 2)
+        underline_stop = [0] * (n + 2)
+        any_stop = [0] * (n + 2)
+
+        for i in (n, n + 1):
+            bold_stop[i] = italics_stop[i] = underline_stop[i] = i
+            any_stop[i] = i
+
+        for j in xrange(n - 1, -1, -1):
+            c = s[j]
+            if j + 1 < n:
+                following = s[j + 1]
+            else:
+                following = None
+
+            double_star = c == "*" and following == "*"
+            single_star = c == "*" and following != "*"
+
+            end = 0
+            if double_star:
+                k = bold_stop[j + 2]
+                if k > j + 2 and s[k:k + 2] == "**":
+                    decoration[j] = BOLD
+                    end = k + 2
+            elif single_star:
+                k = italics_stop[j + 1]
+                if k > j + 1 and s[k:k + 1] == "*" and s[k + 1:k + 2] != "*":
+                    decoration[j] = ITALICS
+                    end = k + 1
+            elif c == "_":
+                k = underline_stop[j + 1]
+                if k > j + 1 and s[k:k + 1] == "_":
+                    decoration[j] = UNDERLINE
+                    end = k + 1
+
+            if not end and not (c == "\r" and following == "\n"):
+                end = j + 1
+
+            nested[j] = end
+
+            if end:
+                bold_stop[j] = j if double_star else bold_stop[end]
+                italics_stop[j] = j if single_star else italics_stop[end]
+                underline_stop[j] = j if c == "_" else underline_stop[end]
+                any_stop[j] = any_stop[end]
+            else:
+                bold_stop[j] = italics_stop[j] = underline_stop[j] = j
+                any_stop[j] = j
+
+        self.nested = nested
+        self.decoration = decoration
+        self.any_stop = any_stop
+
+    def _crlfs(self, i):
+        """
+        Get the length and HTML of the line breaks at a position.
+        """
+
+        s = self.s
+        if s[i:i + 2] != "\r\n":
+            return 0, None
+        if s[i + 2:i + 4] == "\r\n":
+            return 4, "</p><p>"
+        return 2, "<br />"
+
+    def _greentext(self, i):
+        """
+        Find the quote starting with the line breaks at a position.
+
+        Returns the ends of its head, body, and tail, or None.
+        """
+
+        s = self.s
+        head, ignored = self._crlfs(i)
+        start = i + head
+        if s[start:start + 1] != ">" or not self.nested[start + 1]:
+            return None
+
+        stop = self.any_stop[start + 1]
+        tail, ignored = self._crlfs(stop)
+        if not tail:
+            return None
+
+        return start, stop, stop + tail
+
+    def _decorations(self, start, stop, out):
+        """
+        Emit a run of nested decorations and plain characters.
+
+        Deeply nested decorations are handled with an explicit stack rather
+        than recursion.
+        """
+
+        s = self.s
+        nested = self.nested
+        decoration = self.decoration
+
+        stack = []
+        closing = None
+
+        while True:
+            while start < stop:
+                kind = decoration[start]
+                if kind:
+                    width, opening, tag = decoration_tags[kind]
+                    end = nested[start]
+                    out.append(opening)
+                    stack.append((end, stop, closing))
+                    start, stop, closing = start + width, end - width, tag
+                else:
+                    out.append(s[start])
+                    start += 1
+
+            if closing is not None:
+                out.append(closing)
+            if not stack:
+                break
+            start, stop, closing = stack.pop()
+
+    def _paragraphs(self, safe):
+        s = self.s
+        n = len(s)
+        nested = self.nested
+        decoration = self.decoration
+
+        out = ["<p>"]
+        i = 0
+
+        while i < n:
+            c = s[i]
+
+            if safe and c in escapes:
+                out.append(escapes[c])
+                i += 1
+            elif c == "\r" and s[i + 1:i + 2] == "\n":
+                quote = self._greentext(i)
+                if quote:
+                    start, stop, end = quote
+                    out.append(self._crlfs(i)[1])
+                    out.append('<span class="quote">&gt;')
+                    self._decorations(start + 1, stop, out)
+                    out.append("</span>")
+                    out.append(self._crlfs(stop)[1])
+                    i = end
+                else:
+                    length, html = self._crlfs(i)
+                    out.append(html)
+                    i += length
+            elif decoration[i]:
+                self._decorations(i, nested[i], out)
+                i = nested[i]
+            else:
+                out.append(c)
+                i += 1
+
+        out.append("</p>")
+        return "".join(out)
+
+    def paragraphs(self):
+        return self._paragraphs(False)
+
+    def safe_paragraphs(self):
+        return self._paragraphs(True)
@@ -0,0 +1,136 @@
+"""
+Smaller copies of uploaded images.
+
+Each upload gets a copy for each of ``SIZES``, in a directory named after the
+size next to the original::
+
+    comics/<universe>/strip.png
+    comics/<universe>/thumb/strip.png
+    comics/<universe>/web/strip.png
+
+Images which already fit are copied as they are, so that every derivative
+exists once an upload has been processed.
+"""
+
+from __future__ import with_statement
+
+from bp.filepath import FilePath
+
+from PIL import Image
+
+# Bounding boxes, in pixels, for each derivative. Comics are often tall, so
+# web copies are only held to a reasonable width.
+SIZES = {
+    "thumb": (200, 200),
+    "web": (960, 4096),
+}
+
+# Uploads are tagged with the version of this pipeline which processed them.
+# Bump this whenever SIZES change; older derivatives are then ignored until
+# they are made again.
+DERIVATIVES_VERSION = 1
+
+# The file extension for each image format which uploads may be in.
+EXTENSIONS = {
+    "BMP": ".bmp",
+    "GIF": ".gif",
+    "JPEG": ".jpg",
+    "PNG": ".png",
+}
+
+
+def sniff_extension(path):
+    """
+    Pick the file extension for an image by reading its header, or return
+    None if it isn't an image in one of the allowed formats.
+    """
+
+    with open(path, "rb") as handle:
+        try:
+            image = Image.open(handle)
+        except IOError:
+            return None
+        return EXTENSIONS.get(image.format)
+
+
+def derivative_segments(segments, size):
+    """
+    Find the segments of a derivative, given the segments of its original.
+    """
+
+    return segments[:-1] + [size, segments[-1]]
+
+
+def derivative_fp(fp, size):
+    return fp.sibling(size).child(fp.basename())
+
+
+def make_derivatives(fp):
+    """
+    Write every derivative of the image at a ``FilePath``.
+
+    Raises ``IOError`` if the image can't be read or written.
+    """
+
+    image = Image.open(fp.path)
+    image.load()
+
+    for size, bounds in sorted(SIZES.items()):
+        target = derivative_fp(fp, size)
+        if not target.parent().exists():
+            target.parent().makedirs()
+
+        width, height = image.size
+        if width <= bounds[0] and height <= bounds[1]:
+            fp.copyTo(target)
+            continue
+
+        copy = image.copy()
+        copy.thumbnail(bounds, Image.ANTIALIAS)
+        copy.save(target.path, format=image.format)
+
+
+def make_derivatives_at(path):
+    """
+    Like ``make_derivatives()``, but taking a plain path and returning
+    whether it worked, for use from a process pool.
+    """
+
+    try:
+        make_derivatives(FilePath(path))
+    except (IOError, OSError):
+        return False
+    return True
+
+
+def remove_with_derivatives(fp):
+    """
+    Remove an upload at a ``FilePath``, along with any of its derivatives.
+    """
+
+    for target in [fp] + [derivative_fp(fp, size) for size in sorted(SIZES)]:
+        if target.exists():
+            target.remove()
+
+
+def move_with_derivatives(source, target):
+    """
+    Move an upload between ``FilePath``s, along with any of its derivatives.
+
+    Files already at the target are left alone, so that an interrupted move
+    can be finished by trying it again. Returns how many files were moved.
+    """
+
+    pairs = [(source, target)]
+    pairs.extend((derivative_fp(source, size), derivative_fp(target, size))
+                 for size in sorted(SIZES))
+
+    moved = 0
+    for old, new in pairs:
+        if old.exists() and not new.exists():
+            if not new.parent().exists():
+                new.parent().makedirs()
+            old.moveTo(new)
+            moved += 1
+
+    return moved
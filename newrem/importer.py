@@ -0,0 +1,302 @@
+"""
+Bulk import of comics.
+
+A back catalogue is described by a manifest, either YAML, as a list of
+mappings, or CSV, with a header row. Each comic has:
+
+ * ``file``: the image, relative to the manifest's directory
+ * ``title``
+ * ``time``: when the comic goes up, as ``YYYY-MM-DD HH:MM:SS``; optional,
+   defaulting to the time of the import
+ * ``characters``: slugs of the cast; separated by spaces or commas in CSV
+ * ``description`` and ``comment``: optional
+ * ``order``: a number to sort by; optional, defaulting to manifest order
+
+Imported comics are appended to the end of their universe's timeline.
+Comics whose files are already in the universe are skipped, so a broken
+import can be finished by running it again. Their smaller copies are then
+made by background jobs.
+"""
+
+from __future__ import with_statement
+
+import csv
+from datetime import date, datetime, timedelta
+from multiprocessing.pool import ThreadPool
+import os.path
+
+from bp.filepath import FilePath
+
+import yaml
+
+from sqlalchemy import func
+
+from flask import current_app
+
+from newrem.files import fp_root, sharded
+from newrem.jobs import queue
+from newrem.models import db, POSITION_GAP, Comic, Thread
+
+TIME_FORMATS = ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%d")
+
+# How many values to put in a single IN clause.
+CHUNK = 500
+
+
+def read_manifest(path):
+    """
+    Read the rows of a YAML or CSV manifest, as dictionaries.
+    """
+
+    if path.lower().endswith(".csv"):
+        with open(path, "rb") as handle:
+            return [dict((key, value.decode("utf-8"))
+                         for key, value in row.items() if value is not None)
+                    for row in csv.DictReader(handle)]
+
+    with open(path, "rb") as handle:
+        rows = yaml.safe_load(handle) or []
+
+    if not isinstance(rows, list):
+        raise ValueError("The manifest should be a list of comics")
+
+    return rows
+
+
+def parse_time(value):
+    if not value:
+        return None
+    if isinstance(value, datetime):
+        return value
+    if isinstance(value, date):
+        return datetime.combine(value, datetime.min.time())
+
+    for format in TIME_FORMATS:
+        try:
+            return datetime.strptime(value.strip(), format)
+        except ValueError:
+            pass
+
+    raise ValueError("Couldn't understand time %r" % value)
+
+
+def parse_characters(value):
+    if not value:
+        return []
+    if isinstance(value, basestring):
+        value = value.replace(",", " ").split()
+    return [unicode(slug) for slug in value]
+
+
+def parse_entries(rows):
+    """
+    Check and normalize the rows of a manifest, and put them in order.
+    """
+
+    entries = []
+
+    for i, row in enumerate(rows):
+        if not isinstance(row, dict):
+            raise ValueError("Entry %d isn't a mapping" % (i + 1))
+
+        try:
+            if not row.get("file") or not row.get("title"):
+                raise ValueError("A file and a title are required")
+
+            order = row.get("order")
+            if order is None or order == "":
+                order = i
+
+            entry = {
+                "file": row["file"],
+                "filename": os.path.basename(row["file"]),
+                "title": unicode(row["title"]),
+                "time": parse_time(row.get("time")),
+                "characters": parse_characters(row.get("characters")),
+                "description": row.get("description") or None,
+                "comment": row.get("comment") or None,
+                "order": float(order),
+                "index": i,
+            }
+        except ValueError, e:
+            raise ValueError("Entry %d: %s" % (i + 1, ", ".join(e.args)))
+
+        entries.append(entry)
+
+    entries.sort(key=lambda entry: (entry["order"], entry["index"]))
+    return entries
+
+
+def chunks(l, size):
+    for i in xrange(0, len(l), size):
+        yield l[i:i + size]
+
+
+def existing_values(column, values):
+    """
+    Find which of some values of a comic column are already taken, and by
+    which universe.
+    """
+
+    taken = {}
+    for chunk in chunks(list(values), CHUNK):
+        q = db.session.query(column, Comic.universe_fk)
+        for value, slug in q.filter(column.in_(chunk)):
+            taken[value] = slug
+    return taken
+
+
+def copy_upload(paths):
+    """
+    Copy an image into place, unless it is already there.
+
+    The copy is renamed into place once it is whole, so an interrupted copy
+    is never mistaken for a finished one.
+    """
+
+    source, target = FilePath(paths[0]), FilePath(paths[1])
+    if target.exists():
+        return False
+
+    parent = target.parent()
+    if not parent.exists():
+        try:
+            parent.makedirs()
+        except OSError:
+            # Another copy made it first.
+            pass
+
+    temporary = target.temporarySibling()
+    source.copyTo(temporary)
+    temporary.moveTo(target)
+    return True
+
+
+def import_comics(universe, entries, directory, batch=500, threads=8):
+    """
+    Import comics into a universe from parsed manifest entries, with their
+    files in a ``FilePath`` directory.
+
+    Everything is checked before anything is written. Comics are then
+    inserted ``batch`` at a time, while their files are copied by a pool of
+    ``threads`` threads.
+
+    Returns how many comics were imported, skipped and copied.
+    """
+
+    mine = universe.slug
+
+    def paths(entry):
+        segments = sharded(["comics", mine, entry["filename"]])
+        target = fp_root(current_app).descendant(segments)
+        return directory.preauthChild(entry["file"]).path, target.path
+
+    taken = existing_values(Comic.filename,
+                            [entry["filename"] for entry in entries])
+    for filename, slug in taken.iteritems():
+        if slug != mine:
+            raise ValueError("%s is already a comic in %s" % (filename, slug))
+
+    new = [entry for entry in entries if entry["filename"] not in taken]
+
+    seen = set()
+    for entry in entries:
+        if entry["filename"] in seen:
+            raise ValueError("%s is listed twice" % entry["filename"])
+        seen.add(entry["filename"])
+
+        source, target = paths(entry)
+        if not os.path.isfile(source):
+            raise ValueError("%s doesn't exist" % entry["file"])
+        if entry["filename"] not in taken and os.path.exists(target):
+            raise ValueError("%s is already in the way" % target)
+
+    cast = dict((c.slug, c) for c in universe.characters)
+    for entry in new:
+        for slug in entry["characters"]:
+            if slug not in cast:
+                raise ValueError("%s has no character %s" % (mine, slug))
+
+    # Times are unique, so comics without one are a microsecond apart.
+    now = datetime.utcnow()
+    for i, entry in enumerate(new):
+        if entry["time"] is None:
+            entry["time"] = now + timedelta(microseconds=i)
+
+    times = set()
+    for entry in new:
+        if entry["time"] in times:
+            raise ValueError("More than one comic goes up at %s" %
+                             entry["time"])
+        times.add(entry["time"])
+
+    for time in existing_values(Comic.time, times):
+        raise ValueError("A comic already goes up at %s" % time)
+
+    # Positions are handed out once, after the last comic.
+    q = db.session.query(func.max(Comic.position))
+    last = q.filter(Comic.universe_fk == mine).scalar()
+    position = 0 if last is None else last + POSITION_GAP
+
+    pool = ThreadPool(threads)
+    results = []
+
+    try:
+        for chunk in chunks(new, batch):
+            pairs = []
+
+            for entry in chunk:
+                comic = Comic(universe, entry["filename"])
+                comic.characters = [cast[slug]
+                                    for slug in entry["characters"]]
+                comic.retitle(entry["title"])
+                comic.description = entry["description"]
+                comic.comment = entry["comment"]
+                comic.time = entry["time"]
+                comic.position = position
+                comic.thread = Thread(universe.board, comic.title, "DCoN")
+                position += POSITION_GAP
+
+                db.session.add(comic)
+                pairs.append(paths(entry))
+
+            db.session.commit()
+
+            # Copy while the next batch is inserted.
+            results.append(pool.map_async(copy_upload, pairs))
+
+        # Finish copying files whose comics were imported before.
+        pairs = [paths(entry) for entry in entries
+                 if entry["filename"] in taken]
+        results.append(pool.map_async(copy_upload, pairs))
+
+        copied = sum(sum(result.get()) for result in results)
+    finally:
+        pool.close()
+        pool.join()
+
+    return len(new), len(entries) - len(new), copied
+
+
+def queue_derivatives(universe, entries):
+    """
+    Queue jobs to make the smaller copies of imported comics which don't
+    have them yet.
+
+    Returns how many were queued.
+    """
+
+    queued = 0
+
+    for chunk in chunks([entry["filename"] for entry in entries], CHUNK):
+        q = db.session.query(Comic.id)
+        q = q.filter(Comic.universe_fk == universe.slug,
+                     Comic.filename.in_(chunk),
+                     Comic.derivatives_version == None)
+
+        # Jobs may run right away, and commit, so don't hold a cursor open.
+        for cid, in q.all():
+            queue.enqueue("derive", model="comic", id=cid)
+            queued += 1
+
+    return queued
@@ -0,0 +1,341 @@
+"""
+Background jobs.
+
+Slow work which can wait until after a request has been answered, such as
+resizing images, is queued here and run by a separate worker process::
+
+    python -m newrem.manage work
+
+The queue is a local SQLite database, named by ``job_queue`` in the site
+configuration, so the worker must run on the same machine as the site.
+Without a queue, jobs run immediately, inside the request which queued them.
+
+Only the work done on an upload once it has arrived is queued: making the
+smaller copies of comics and posts, and resizing portraits. Saving the
+upload itself is not queued. Comics, character portraits and posts are still
+written into place during the request, as they always were, since the
+request is where the upload is and writing it to a staging directory would
+cost the same as writing it into place. It also means they can be shown as
+soon as the request is answered.
+
+A portrait which can't be resized keeps its staged file, so that its job
+can be retried from the jobs page.
+"""
+
+from __future__ import with_statement
+
+from contextlib import closing
+import json
+from os import urandom
+import sqlite3
+from time import time
+import traceback
+
+from bp.filepath import FilePath
+
+from flask import current_app
+
+from newrem.cache import bump
+from newrem.files import fp_root
+from newrem.models import db, Comic, Portrait, Post
+
+# How many times a job is tried before giving up on it.
+MAX_ATTEMPTS = 5
+
+# How long, in seconds, to wait before retrying a failed job. Each further
+# retry waits twice as long as the last.
+RETRY_DELAY = 30
+
+# How long, in seconds, a job may run before its worker is assumed to have
+# died and the job is handed to another.
+LEASE = 10 * 60
+
+# How long, in seconds, finished jobs are kept around for the status page.
+KEEP = 7 * 24 * 60 * 60
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    kind TEXT NOT NULL,
+    args TEXT NOT NULL,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    created REAL NOT NULL,
+    updated REAL NOT NULL,
+    run_after REAL NOT NULL
+)
+"""
+
+handlers = {}
+
+
+def job(f):
+    """
+    Register a function as a kind of job.
+
+    Jobs are called with the keyword arguments they were queued with, inside
+    a request context, and must commit their own changes.
+    """
+
+    handlers[f.__name__] = f
+    return f
+
+
+class Queue(object):
+    """
+    A queue of jobs in a SQLite database at ``path``, or no queue at all if
+    ``path`` is None.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+
+    def connect(self):
+        # Autocommit, so that transactions are only those asked for.
+        connection = sqlite3.connect(self.path, timeout=30,
+                                     isolation_level=None)
+        connection.row_factory = sqlite3.Row
+        connection.execute(SCHEMA)
+        return connection
+
+    def enqueue(self, kind, **kwargs):
+        """
+        Queue up a job.
+
+        Returns the new job's ID, or None if the job was run on the spot.
+        """
+
+        if self.path is None:
+            try:
+                handlers[kind](**kwargs)
+            except Exception:
+                db.session.rollback()
+                current_app.logger.exception("Job %s failed" % kind)
+            return None
+
+        now = time()
+        with closing(self.connect()) as connection:
+            cursor = connection.execute("""
+                INSERT INTO jobs (kind, args, status, created, updated,
+                                  run_after)
+                VALUES (?, ?, 'queued', ?, ?, ?)
+            """, (kind, json.dumps(kwargs), now, now, now))
+            return cursor.lastrowid
+
+    def claim(self):
+        """
+        Take the next job which is due, marking it as running.
+
+        Returns the job's row, or None if nothing is due.
+        """
+
+        now = time()
+        with closing(self.connect()) as connection:
+            # Take the write lock up front, so that two workers can't claim
+            # the same job.
+            connection.execute("BEGIN IMMEDIATE")
+
+            connection.execute("""
+                UPDATE jobs SET status = 'queued'
+                WHERE status = 'running' AND updated < ?
+            """, (now - LEASE,))
+
+            row = connection.execute("""
+                SELECT * FROM jobs
+                WHERE status = 'queued' AND run_after <= ?
+                ORDER BY run_after, id LIMIT 1
+            """, (now,)).fetchone()
+
+            if row is not None:
+                connection.execute("""
+                    UPDATE jobs
+                    SET status = 'running', attempts = attempts + 1,
+                        updated = ?
+                    WHERE id = ?
+                """, (now, row["id"]))
+
+            connection.execute("COMMIT")
+
+        if row is None:
+            return None
+
+        # Hand back the job as it now is in the queue.
+        row = dict(zip(row.keys(), row))
+        row["attempts"] += 1
+        return row
+
+    def finish(self, jid):
+        with closing(self.connect()) as connection:
+            connection.execute("""
+                UPDATE jobs SET status = 'done', error = NULL, updated = ?
+                WHERE id = ?
+            """, (time(), jid))
+
+    def fail(self, jid, attempts, error):
+        """
+        Record a failed attempt at a job, and retry it later unless it has
+        been tried too many times.
+        """
+
+        now = time()
+        if attempts < MAX_ATTEMPTS:
+            status = "queued"
+            run_after = now + RETRY_DELAY * 2 ** (attempts - 1)
+        else:
+            status = "failed"
+            run_after = now
+
+        with closing(self.connect()) as connection:
+            connection.execute("""
+                UPDATE jobs SET status = ?, error = ?, updated = ?,
+                                run_after = ?
+                WHERE id = ?
+            """, (status, error, now, run_after, jid))
+
+    def retry(self, jid):
+        """
+        Give a failed job a fresh set of attempts.
+        """
+
+        now = time()
+        with closing(self.connect()) as connection:
+            connection.execute("""
+                UPDATE jobs SET status = 'queued', attempts = 0,
+                                updated = ?, run_after = ?
+                WHERE id = ? AND status = 'failed'
+            """, (now, now, jid))
+
+    def prune(self):
+        """
+        Forget jobs which finished a while ago.
+        """
+
+        with closing(self.connect()) as connection:
+            connection.execute("""
+                DELETE FROM jobs WHERE status = 'done' AND updated < ?
+            """, (time() - KEEP,))
+
+    def counts(self):
+        """
+        Count the jobs in each status.
+        """
+
+        with closing(self.connect()) as connection:
+            rows = connection.execute("""
+                SELECT status, COUNT(*) FROM jobs GROUP BY status
+            """)
+            return dict(tuple(row) for row in rows)
+
+    def recent(self, limit=50):
+        """
+        List the most recently touched jobs.
+        """
+
+        with closing(self.connect()) as connection:
+            rows = connection.execute("""
+                SELECT * FROM jobs ORDER BY updated DESC, id DESC LIMIT ?
+            """, (limit,))
+            return [dict(zip(row.keys(), row)) for row in rows]
+
+
+queue = Queue()
+
+
+def configure_jobs(app):
+    """
+    Set up the job queue from the site configuration.
+    """
+
+    queue.path = app.config["DCON_CONFIG"].get("job_queue")
+
+
+def run_next():
+    """
+    Run the next job which is due, if any.
+
+    Returns whether a job was run.
+    """
+
+    row = queue.claim()
+    if row is None:
+        return False
+
+    # Python 2.6 won't take Unicode keyword arguments.
+    kwargs = dict((str(k), v) for k, v in json.loads(row["args"]).items())
+
+    try:
+        handlers[row["kind"]](**kwargs)
+    except Exception:
+        db.session.rollback()
+        queue.fail(row["id"], row["attempts"], traceback.format_exc())
+    else:
+        queue.finish(row["id"])
+
+    return True
+
+
+def stage(fs):
+    """
+    Save an uploaded ``FileStorage`` somewhere for a job to pick up, and
+    return its path.
+    """
+
+    fp = fp_root(current_app).child("staging")
+    if not fp.exists():
+        fp.makedirs()
+
+    fp = fp.child(urandom(16).encode("hex"))
+    fs.save(fp.path)
+    return fp.path
+
+
+@job
+def derive(model, id):
+    """
+    Make the smaller copies of an uploaded comic or post image.
+    """
+
+    cls = {"comic": Comic, "post": Post}[model]
+    row = cls.query.get(id)
+    if row is None:
+        # Deleted in the meantime.
+        return
+
+    try:
+        row.make_derivatives()
+    except IOError:
+        # Not an image PIL understands, and trying again won't help; it is
+        # shown as it is.
+        current_app.logger.exception("Couldn't make copies of %r" % row)
+        row.derivatives_version = None
+    db.session.commit()
+
+    # Pages showing the upload should switch to the copies. Posts revise
+    # their threads themselves.
+    if model == "comic":
+        bump("universe", row.universe_fk)
+        bump("comics")
+
+
+@job
+def portrait(slug, staged):
+    """
+    Resize a staged upload into place as a portrait, and clean up after it.
+    """
+
+    fp = FilePath(staged)
+
+    # Already done by an earlier try.
+    if not fp.exists():
+        return
+
+    # Failures leave the staged file behind for a retry.
+    p = Portrait.query.get(slug)
+    if p is not None:
+        parent = p.fp().parent()
+        if not parent.exists():
+            parent.makedirs()
+        p.update_portrait(fp.path)
+
+    fp.remove()
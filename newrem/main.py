@@ -5,6 +5,7 @@ from bp.filepath import FilePath
 from flask.ext.uploads import configure_uploads, patch_request_class
 
 from newrem.admin import admin
+from newrem.api import api
 from newrem.chan import osuchan
 from newrem.comics import comics
 from newrem.config import load_config
@@ -55,3 +56,4 @@ app.register_blueprint(users)
 app.register_blueprint(admin, url_prefix="/admin")
 app.register_blueprint(comics)
 app.register_blueprint(osuchan, url_prefix="/chan")
+app.register_blueprint(api, url_prefix="/api")
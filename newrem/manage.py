@@ -0,0 +1,580 @@
+"""
+Maintenance commands for a DCoN instance.
+
+Run these from the instance directory, the same place ``shell.py`` is run
+from::
+
+    python -m newrem.manage <command> [options]
+"""
+
+from __future__ import with_statement
+
+from multiprocessing import Pool, cpu_count
+from optparse import OptionParser
+import os.path
+import sys
+from time import sleep
+
+from bp.filepath import FilePath
+
+from sqlalchemy import func, or_
+from sqlalchemy.exc import IntegrityError
+
+from newrem import importer
+from newrem.archive import Exporter, Restorer
+from newrem.cache import bump, shared
+from newrem.files import fp_root, sharded
+from newrem.images import (DERIVATIVES_VERSION, make_derivatives_at,
+                           move_with_derivatives)
+from newrem.jobs import queue, run_next
+from newrem.markup import MARKUP_VERSION
+from newrem.models import (db, POSITION_GAP, Comic, Newspost, Post, Thread,
+                           Universe, Upload, rebalance_positions,
+                           smallest_gap)
+from newrem.schema import missing_columns, missing_indexes, upgrade
+
+commands = {}
+
+
+def command(f):
+    """
+    Register a function as a command.
+
+    Commands are called with the application and their own argument list, and
+    may return an exit status.
+    """
+
+    commands[f.__name__.replace("_", "-")] = f
+    return f
+
+
+def universes_for(args):
+    """
+    Look up the universes named by slug on the command line, or all of them.
+    """
+
+    q = Universe.query.order_by(Universe.slug)
+    if args:
+        q = q.filter(Universe.slug.in_(args))
+    return q.all()
+
+
+def forget_universe(slug):
+    """
+    Drop everything cached about a universe, after changing it.
+    """
+
+    if slug is not None:
+        bump("universe", slug)
+    bump("comics")
+
+    if not shared():
+        print "The cache isn't shared; restart the site to see the changes."
+
+
+@command
+def rebalance(app, argv):
+    """
+    Spread out comic positions in universes whose gaps are running low.
+
+    This is safe to run from cron at any time. It is also the migration for
+    databases created before positions were sparse, since dense positions
+    have no gaps at all.
+    """
+
+    parser = OptionParser(usage="%prog rebalance [options] [universe ...]")
+    parser.add_option("--min-gap", type="int", default=POSITION_GAP // 16,
+                      help="rebalance universes with a smaller gap than this")
+    parser.add_option("--force", action="store_true", default=False,
+                      help="rebalance even when there is room left")
+    options, args = parser.parse_args(argv)
+
+    for universe in universes_for(args):
+        gap = smallest_gap(universe)
+        if gap is None:
+            continue
+        if gap >= options.min_gap and not options.force:
+            continue
+
+        # Each universe is its own transaction, so that a large site doesn't
+        # hold one enormous lock.
+        moved = rebalance_positions(universe)
+        db.session.commit()
+        print "%s: moved %d comics (smallest gap was %d)" % (
+            universe.slug, moved, gap)
+
+        # The site's timelines still hold the old positions.
+        if moved:
+            forget_universe(universe.slug)
+
+
+@command
+def migrate(app, argv):
+    """
+    Add missing tables, columns and indexes to an existing database.
+
+    The site can stay up while this runs; see ``newrem.schema``.
+    """
+
+    parser = OptionParser(usage="%prog migrate [options]")
+    parser.add_option("--dry-run", action="store_true", default=False,
+                      help="only list what would be changed")
+    options, args = parser.parse_args(argv)
+
+    engine = db.get_engine(app)
+
+    if options.dry_run:
+        for column in missing_columns(engine, db.metadata):
+            print "missing column %s.%s" % (column.table.name, column.name)
+        for index in missing_indexes(engine, db.metadata):
+            print "missing index %s on %s" % (index.name, index.table.name)
+        return
+
+    def log(message):
+        print message
+
+    if not upgrade(engine, db.metadata, log):
+        print "Database is up to date."
+
+
+@command
+def render_markup(app, argv):
+    """
+    Store rendered HTML for comics, newsposts and posts which lack it.
+
+    Rows rendered by an older MARKUP_VERSION are rendered again. Until then,
+    pages render their markup on the fly.
+    """
+
+    parser = OptionParser(usage="%prog render-markup [options]")
+    parser.add_option("--force", action="store_true", default=False,
+                      help="render every row, even current ones")
+    parser.add_option("--batch", type="int", default=500,
+                      help="rows to render per transaction")
+    options, args = parser.parse_args(argv)
+
+    for model in (Comic, Newspost, Post):
+        if options.force:
+            model.query.update({"markup_version": None},
+                               synchronize_session=False)
+            db.session.commit()
+
+        stale = or_(model.markup_version == None,
+                    model.markup_version != MARKUP_VERSION)
+
+        count = 0
+        while True:
+            rows = model.query.filter(stale).limit(options.batch).all()
+            if not rows:
+                break
+
+            for row in rows:
+                row.render_markup()
+            db.session.commit()
+
+            count += len(rows)
+
+        print "%s: rendered %d rows" % (model.__tablename__, count)
+
+
+@command
+def make_derivatives(app, argv):
+    """
+    Make smaller copies of uploaded comics and post images which lack them.
+
+    Uploads processed by an older DERIVATIVES_VERSION are processed again.
+    Images are resized in a pool of worker processes.
+    """
+
+    parser = OptionParser(usage="%prog make-derivatives [options]")
+    parser.add_option("--force", action="store_true", default=False,
+                      help="process every upload, even current ones")
+    parser.add_option("--batch", type="int", default=100,
+                      help="uploads to process per transaction")
+    parser.add_option("--processes", type="int", default=cpu_count(),
+                      help="worker processes to resize images with")
+    options, args = parser.parse_args(argv)
+
+    # Start the workers before anything touches the database, so that they
+    # don't inherit any connections.
+    pool = Pool(options.processes)
+
+    try:
+        for model in (Comic, Post):
+            made = failed = 0
+            last = 0
+
+            # Walk through by ID, so that uploads which can't be processed
+            # are only tried once.
+            while True:
+                q = model.query.filter(model.id > last)
+                q = q.filter(model.filename != None, model.filename != "")
+                if not options.force:
+                    q = q.filter(or_(
+                        model.derivatives_version == None,
+                        model.derivatives_version != DERIVATIVES_VERSION))
+                rows = q.order_by(model.id).limit(options.batch).all()
+                if not rows:
+                    break
+
+                paths = [row.fp().path for row in rows]
+                results = pool.map(make_derivatives_at, paths)
+
+                for row, ok in zip(rows, results):
+                    if ok:
+                        row.derivatives_version = DERIVATIVES_VERSION
+                        made += 1
+                    else:
+                        row.derivatives_version = None
+                        failed += 1
+                db.session.commit()
+
+                last = rows[-1].id
+
+            print "%s: processed %d uploads, %d failed" % (
+                model.__tablename__, made, failed)
+    finally:
+        pool.close()
+        pool.join()
+
+
+@command
+def import_comics(app, argv):
+    """
+    Import a back catalogue of comics into a universe from a manifest.
+
+    See ``newrem.importer`` for the manifest format. Smaller copies of the
+    imported images are made by background jobs afterwards.
+    """
+
+    parser = OptionParser(usage="%prog import-comics [options] universe "
+                                "manifest")
+    parser.add_option("--images", metavar="PATH",
+                      help="find images in PATH, instead of next to the "
+                           "manifest")
+    parser.add_option("--batch", type="int", default=500,
+                      help="comics to insert per transaction")
+    parser.add_option("--threads", type="int", default=8,
+                      help="threads to copy images with")
+    options, args = parser.parse_args(argv)
+
+    if len(args) != 2:
+        parser.error("a universe and a manifest are required")
+
+    universe = Universe.query.get(args[0])
+    if universe is None:
+        parser.error("no such universe %s" % args[0])
+
+    directory = options.images or os.path.dirname(os.path.abspath(args[1]))
+
+    try:
+        entries = importer.parse_entries(importer.read_manifest(args[1]))
+        imported, skipped, copied = importer.import_comics(universe, entries,
+            FilePath(directory), options.batch, options.threads)
+    except ValueError, e:
+        print "Couldn't import comics: %s" % ", ".join(e.args)
+        return 1
+
+    print "%s: imported %d comics, skipped %d, copied %d files" % (
+        universe.slug, imported, skipped, copied)
+
+    queued = importer.queue_derivatives(universe, entries)
+    if queue.path is None:
+        print "%s: made copies of %d comics" % (universe.slug, queued)
+    else:
+        print "%s: queued copies of %d comics; run work to make them" % (
+            universe.slug, queued)
+
+    forget_universe(universe.slug)
+
+
+@command
+def export_universe(app, argv):
+    """
+    Write a universe, with its discussion and uploads, to a tar archive.
+
+    The archive is gzipped if its name ends in ".gz". See ``newrem.archive``
+    for what goes in it.
+    """
+
+    parser = OptionParser(usage="%prog export-universe [options] universe "
+                                "archive")
+    parser.add_option("--chunk", type="int", default=500,
+                      help="rows to read per query")
+    options, args = parser.parse_args(argv)
+
+    if len(args) != 2:
+        parser.error("a universe and an archive are required")
+
+    universe = Universe.query.get(args[0])
+    if universe is None:
+        parser.error("no such universe %s" % args[0])
+
+    with open(args[1], "wb") as handle:
+        exporter = Exporter(universe, handle, args[1].endswith(".gz"),
+                            options.chunk)
+        files = exporter.export()
+
+    print "%s: exported, with %d files" % (universe.slug, files)
+
+
+@command
+def restore_universe(app, argv):
+    """
+    Restore a universe from an archive made by export-universe.
+
+    It is safe to run again if it is interrupted. Afterwards, run
+    make-derivatives to make smaller copies of the restored images.
+    """
+
+    parser = OptionParser(usage="%prog restore-universe archive")
+    options, args = parser.parse_args(argv)
+
+    if len(args) != 1:
+        parser.error("an archive is required")
+
+    with open(args[0], "rb") as handle:
+        restorer = Restorer(handle)
+        try:
+            counts = restorer.restore()
+        except ValueError, e:
+            db.session.rollback()
+            print "Couldn't restore: %s" % ", ".join(e.args)
+            return 1
+        except IntegrityError, e:
+            db.session.rollback()
+            print "Couldn't restore: %s" % e.orig
+            return 1
+
+    forget_universe(restorer.slug)
+
+    for kind in sorted(counts):
+        print "%s: restored %d" % (kind, counts[kind])
+
+
+@command
+def shard_uploads(app, argv):
+    """
+    Move uploaded comics and post images from the old flat directories into
+    their shards.
+
+    Nothing in the database changes. Images which haven't been moved yet
+    can't be found, so run this straight after upgrading. It can be
+    interrupted and run again; files already moved are skipped.
+    """
+
+    parser = OptionParser(usage="%prog shard-uploads [options]")
+    parser.add_option("--batch", type="int", default=1000,
+                      help="uploads to look up per query")
+    parser.add_option("--legacy", metavar="PATH",
+                      help="also take board images from PATH, where boards "
+                           "used to save them")
+    options, args = parser.parse_args(argv)
+
+    root = fp_root(app)
+
+    # Comics, by ID.
+    moved = 0
+    last = 0
+    while True:
+        q = db.session.query(Comic.id, Universe.slug, Comic.filename)
+        q = q.join(Comic.universe).filter(Comic.id > last)
+        rows = q.order_by(Comic.id).limit(options.batch).all()
+        if not rows:
+            break
+
+        for cid, slug, filename in rows:
+            segments = ["comics", slug, filename]
+            moved += move_with_derivatives(root.descendant(segments),
+                                           root.descendant(sharded(segments)))
+
+        last = rows[-1][0]
+
+    print "comics: moved %d files" % moved
+
+    # Post images, by filename; posts share them.
+    moved = 0
+    last = ""
+    while True:
+        q = db.session.query(Post.filename).filter(Post.filename > last)
+        q = q.distinct().order_by(Post.filename).limit(options.batch)
+        filenames = [filename for filename, in q]
+        if not filenames:
+            break
+
+        for filename in filenames:
+            segments = ["comments", filename]
+            target = root.descendant(sharded(segments))
+
+            sources = [root.descendant(segments)]
+            if options.legacy:
+                sources.append(FilePath(options.legacy).child(filename))
+
+            for source in sources:
+                moved += move_with_derivatives(source, target)
+
+        last = filenames[-1]
+
+    print "post: moved %d files" % moved
+
+
+@command
+def fill_slugs(app, argv):
+    """
+    Store URL slugs for comics from before they were stored.
+
+    Until then, their URLs are worked out from their titles every time.
+    """
+
+    parser = OptionParser(usage="%prog fill-slugs [options]")
+    parser.add_option("--batch", type="int", default=500,
+                      help="comics to update per transaction")
+    options, args = parser.parse_args(argv)
+
+    count = 0
+    while True:
+        comics = Comic.query.filter(Comic.slug == None)
+        comics = comics.limit(options.batch).all()
+        if not comics:
+            break
+
+        for comic in comics:
+            comic.retitle(comic.title)
+        db.session.commit()
+
+        count += len(comics)
+
+    print "comics: filled %d slugs" % count
+
+
+@command
+def repair_threads(app, argv):
+    """
+    Recompute the bump times and counters of threads from their posts.
+
+    Threads from before these were kept have no bump time, and sort after
+    every other thread on their boards, until this is run. It is also safe to
+    run at any time to correct counts which have drifted.
+    """
+
+    parser = OptionParser(usage="%prog repair-threads [options]")
+    parser.add_option("--batch", type="int", default=1000,
+                      help="threads to repair per transaction")
+    options, args = parser.parse_args(argv)
+
+    def posts(*columns):
+        return db.session.query(*columns).filter(Post.threadid == Thread.id)
+
+    # A thread was last bumped by its latest post not marked "sage", or by
+    # its opening post if every post was. Threads without posts keep their
+    # bump time.
+    sage = func.lower(func.trim(func.coalesce(Post.email, ""))) == "sage"
+    bumped = posts(func.max(Post.timestamp)).filter(~sage).as_scalar()
+    opened = posts(func.min(Post.timestamp)).as_scalar()
+
+    images = posts(func.count(Post.id)).filter(Post.filename != None)
+    images = images.filter(Post.filename != "")
+
+    values = {
+        "bumped": func.coalesce(bumped, opened, Thread.bumped),
+        "post_count": posts(func.count(Post.id)).as_scalar(),
+        "image_count": images.as_scalar(),
+        "last_post": posts(func.max(Post.timestamp)).as_scalar(),
+    }
+
+    # Work through the threads in ranges of IDs, so that each transaction
+    # stays short.
+    top = db.session.query(func.max(Thread.id)).scalar() or 0
+    count = 0
+    for start in xrange(0, top + 1, options.batch):
+        q = Thread.query.filter(Thread.id >= start)
+        q = q.filter(Thread.id < start + options.batch)
+        count += q.update(values, synchronize_session=False)
+        db.session.commit()
+
+    print "thread: repaired %d rows" % count
+
+
+@command
+def repair_uploads(app, argv):
+    """
+    Recount the posts using each uploaded file.
+
+    Files uploaded before they were counted are never removed until this is
+    run. It is also safe to run at any time to correct counts which have
+    drifted, although posts made while it runs may be miscounted.
+    """
+
+    parser = OptionParser(usage="%prog repair-uploads")
+    options, args = parser.parse_args(argv)
+
+    q = db.session.query(Post.filename, func.count(Post.id))
+    q = q.filter(Post.filename != None).filter(Post.filename != "")
+    counts = q.group_by(Post.filename).all()
+
+    Upload.query.delete()
+    db.session.add_all([Upload(filename=filename, refcount=count)
+                        for filename, count in counts])
+    db.session.commit()
+
+    print "upload: counted %d files" % len(counts)
+
+
+@command
+def work(app, argv):
+    """
+    Run queued background jobs.
+
+    Run this alongside the site whenever ``job_queue`` is configured; it
+    keeps going until interrupted.
+    """
+
+    parser = OptionParser(usage="%prog work [options]")
+    parser.add_option("--once", action="store_true", default=False,
+                      help="exit once nothing is due, instead of waiting")
+    parser.add_option("--poll", type="float", default=5,
+                      help="seconds to wait between checks when idle")
+    options, args = parser.parse_args(argv)
+
+    if queue.path is None:
+        print "No job_queue is configured; jobs run inside requests."
+        return 1
+
+    queue.prune()
+
+    while True:
+        if run_next():
+            continue
+
+        if options.once:
+            break
+        sleep(options.poll)
+
+
+def usage():
+    print "Usage: python -m newrem.manage <command> [options]"
+    print
+    print "Commands:"
+    for name in sorted(commands):
+        doc = commands[name].__doc__ or ""
+        print "    %-16s %s" % (name, doc.strip().split("\n")[0])
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+
+    if len(argv) < 2 or argv[1] not in commands:
+        usage()
+        return 1
+
+    # Import the instance only when actually running something; it needs the
+    # configuration files in the working directory.
+    from newrem.main import app
+
+    with app.test_request_context():
+        return commands[argv[1]](app, argv[2:])
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,58 @@
+"""
+Rendering of blog markup to HTML.
+"""
+
+from newrem.grammars import BlogGrammar, LinearBlogGrammar
+
+# Stored HTML is tagged with the version of the renderer which produced it.
+# Bump this whenever the renderer's output changes; stored HTML from older
+# versions is then ignored until it is rendered again.
+MARKUP_VERSION = 1
+
+# Both renderers produce identical output, so switching between them doesn't
+# need a new MARKUP_VERSION.
+renderers = {
+    "parsley": BlogGrammar,
+    "linear": LinearBlogGrammar,
+}
+
+renderer = BlogGrammar
+
+
+def configure_markup(app):
+    """
+    Pick the markup renderer named by ``markup_renderer`` in the site
+    configuration.
+    """
+
+    global renderer
+
+    name = app.config["DCON_CONFIG"].get("markup_renderer", "parsley")
+    renderer = renderers[name]
+
+
+def blogify(s):
+    """
+    Run a string through a grammar to prettify it somewhat.
+    """
+
+    return renderer(s).paragraphs()
+
+
+def eblogify(s):
+    """
+    Like ``blogify``, but also apply HTML escapes. For untrusted input.
+    """
+
+    return renderer(s).safe_paragraphs()
+
+
+def render(s, trusted):
+    """
+    Render some markup, escaping it unless it is trusted.
+    """
+
+    if trusted:
+        return blogify(s)
+    else:
+        return eblogify(s)
@@ -5,12 +5,20 @@ from PIL import Image
 
 from werkzeug.security import generate_password_hash, check_password_hash
 
+from jinja2 import Markup
+
+from sqlalchemy import and_, event, inspect, or_, select
+from sqlalchemy.orm import Session, backref
+
 from flask import current_app
 
 from flask.ext.login import LoginManager, make_secure_token
 from flask.ext.sqlalchemy import SQLAlchemy
 
-from newrem.files import extend_url, fp_root, url_root
+from newrem.files import extend_url, fp_root, sharded, url_root
+from newrem.images import (DERIVATIVES_VERSION, derivative_segments,
+                           make_derivatives, remove_with_derivatives)
+from newrem.markup import MARKUP_VERSION, render
 from newrem.util import slugify
 
 db = SQLAlchemy()
@@ -21,9 +29,17 @@ FK = partial(db.ForeignKey, onupdate="cascade", ondelete="cascade")
 # Oh, wait, that doesn't work on SQLite or MySQL. Plan B!
 relationship = partial(db.relationship, cascade="all", passive_updates=False)
 
+# The spacing between neighboring comics in a freshly balanced timeline.
+# Inserting a comic takes the midpoint of a gap, so each gap can absorb about
+# ten insertions before the universe needs to be rebalanced.
+POSITION_GAP = 1024
+
 casts = db.Table("casts", db.metadata,
     db.Column("character_id", db.String(45), FK("characters.slug")),
-    db.Column("comic_id", db.Integer, FK("comics.id"))
+    db.Column("comic_id", db.Integer, FK("comics.id")),
+    # Both directions are joined: a comic's cast, and a character's comics.
+    db.Index("ix_casts_character_comic", "character_id", "comic_id"),
+    db.Index("ix_casts_comic_character", "comic_id", "character_id"),
 )
 
 
@@ -39,6 +55,101 @@ class FilenameMixin(object):
         return extend_url(url_root(current_app), self.segments())
 
 
+class DerivativesMixin(FilenameMixin):
+    """
+    A mixin for uploaded images which have smaller copies made of them; see
+    ``newrem.images``.
+    """
+
+    # The DERIVATIVES_VERSION which made the copies, if any.
+    derivatives_version = db.Column(db.Integer)
+
+    def make_derivatives(self):
+        """
+        Make the copies of this upload. The upload must already be saved.
+
+        Raises ``IOError`` if the upload isn't a readable image.
+        """
+
+        make_derivatives(self.fp())
+        self.derivatives_version = DERIVATIVES_VERSION
+
+    def derivative_url(self, size):
+        """
+        Get the URL of a copy of this upload, or of the upload itself if its
+        copies haven't been made yet.
+        """
+
+        if self.derivatives_version != DERIVATIVES_VERSION:
+            return self.url()
+
+        segments = derivative_segments(self.segments(), size)
+        return extend_url(url_root(current_app), segments)
+
+
+class MarkupMixin(object):
+    """
+    A mixin to store HTML rendered from blog markup alongside the markup
+    itself, so that pages don't need to run the grammar on every view.
+
+    ``markup_fields`` lists tuples of (source column, HTML column, whether
+    the source is trusted). The HTML is rendered whenever the object is
+    written.
+    """
+
+    markup_fields = ()
+
+    # The MARKUP_VERSION which rendered the stored HTML.
+    markup_version = db.Column(db.Integer)
+
+    def render_markup(self):
+        for source, target, trusted in self.markup_fields:
+            text = getattr(self, source)
+            if text:
+                setattr(self, target, render(text, trusted))
+            else:
+                setattr(self, target, None)
+
+        self.markup_version = MARKUP_VERSION
+
+    def markup_changed(self):
+        if self.markup_version != MARKUP_VERSION:
+            return True
+
+        state = inspect(self)
+        return any(state.attrs[source].history.has_changes()
+                   for source, target, trusted in self.markup_fields)
+
+    def html(self, source):
+        """
+        Get the HTML for a field.
+
+        The stored HTML is used if it is current; otherwise, the markup is
+        rendered on the spot.
+        """
+
+        for field, target, trusted in self.markup_fields:
+            if field == source:
+                break
+        else:
+            raise KeyError(source)
+
+        if self.markup_version == MARKUP_VERSION:
+            html = getattr(self, target)
+        else:
+            text = getattr(self, source)
+            html = render(text, trusted) if text else None
+
+        return Markup(html or u"")
+
+
+@event.listens_for(MarkupMixin, "before_insert", propagate=True)
+@event.listens_for(MarkupMixin, "before_update", propagate=True)
+def render_markup(mapper, connection, target):
+    if target.markup_changed():
+        target.render_markup()
+
+
 class Wordfilter(db.Model):
     __tablename__ = "badwords"
 
@@ -68,11 +179,29 @@ class Board(db.Model):
 
 class Thread(db.Model):
     __tablename__ = "thread"
+    __table_args__ = (
+        # Boards are listed most recently bumped first.
+        db.Index("ix_thread_board_bumped", "board_fk", "bumped"),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     subject = db.Column(db.Unicode(50))
     author = db.Column(db.Unicode(30))
     board_fk = db.Column(db.String(5), FK(Board.abbreviation))
+    # The time of the latest post which bumped this thread.
+    bumped = db.Column(db.DateTime)
+
+    # Counters kept up to date by add_post(), so that listings don't have to
+    # count posts. "python -m newrem.manage repair-threads" recomputes them.
+    post_count = db.Column(db.Integer, nullable=False, default=0,
+                           server_default="0")
+    image_count = db.Column(db.Integer, nullable=False, default=0,
+                            server_default="0")
+    last_post = db.Column(db.DateTime)
+    # Counts every change to the thread's posts, so that pages showing them
+    # can be validated without reading them. Kept by the events below.
+    revision = db.Column(db.Integer, nullable=False, default=0,
+                         server_default="0")
 
     board = relationship(Board, backref="threads")
 
@@ -81,20 +210,71 @@ class Thread(db.Model):
         self.subject = subject
         self.author = author
 
+        self.bumped = datetime.now()
+        self.post_count = 0
+        self.image_count = 0
+
+    def add_post(self, post):
+        """
+        Add a new post to this thread, and count it.
+
+        The post still needs to be added to the session. The counters are
+        incremented in SQL, in the same transaction as the post, so that
+        concurrent posts don't lose each other's counts.
+        """
+
+        if inspect(self).has_identity:
+            # Don't load the whole thread just to add to it.
+            post.threadid = self.id
+
+            counts = {"post_count": Thread.post_count + 1}
+            if post.filename:
+                counts["image_count"] = Thread.image_count + 1
+
+            q = Thread.query.filter_by(id=self.id)
+            q.update(counts, synchronize_session=False)
+            db.session.expire(self, counts.keys())
+        else:
+            self.posts.append(post)
+            self.post_count += 1
+            if post.filename:
+                self.image_count += 1
+
+        self.last_post = post.timestamp
+        self.bump(post)
+
+    def bump(self, post):
+        """
+        Move this thread to the top of its board for a new post, unless the
+        poster asked not to.
+        """
+
+        if not post.sage():
+            self.bumped = post.timestamp
+
 
-class Post(db.Model, FilenameMixin):
+class Post(db.Model, DerivativesMixin, MarkupMixin):
     __tablename__ = "post"
+    __table_args__ = (
+        # Threads are always read in posting order.
+        db.Index("ix_post_thread_timestamp", "threadid", "timestamp"),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     author = db.Column(db.Unicode(30), nullable=False)
     threadid = db.Column(db.Integer, FK(Thread.id), nullable=False)
     timestamp = db.Column(db.DateTime, nullable=False)
     comment = db.Column(db.UnicodeText(1024 * 1024))
+    comment_html = db.Column(db.UnicodeText(16 * 1024 * 1024))
     email = db.Column(db.String(30))
     filename = db.Column(db.String(50))
 
-    thread = relationship(Thread, backref="posts", single_parent=True,
-                          cascade="all, delete, delete-orphan")
+    markup_fields = [("comment", "comment_html", False)]
+
+    # Threads own their posts, so deleting a post leaves its thread alone.
+    thread = relationship(Thread, cascade="save-update, merge",
+                          backref=backref("posts",
+                                          cascade="all, delete-orphan"))
 
     def __init__(self, author, comment, email, filename):
         self.comment = comment
@@ -104,8 +284,181 @@ class Post(db.Model, FilenameMixin):
 
         self.timestamp = datetime.now()
 
+    def sage(self):
+        """
+        Whether this post was made without bumping its thread.
+        """
+
+        return (self.email or "").strip().lower() == "sage"
+
+    def __json__(self):
+        d = {
+            "author": self.author,
+            "comment": self.comment,
+            "filename": self.filename,
+            "id": self.id,
+            "timestamp": self.timestamp,
+        }
+        return d
+
     def segments(self):
-        return ["comments", self.filename]
+        return sharded(["comments", self.filename])
+
+
+class Upload(db.Model):
+    """
+    A file uploaded with posts.
+
+    Uploads are named by their contents, so a file posted again is stored
+    only once; this counts the posts using each file, so that it is removed
+    along with the last of them. The counts are kept by the events below.
+    "python -m newrem.manage repair-uploads" recomputes them.
+    """
+
+    __tablename__ = "upload"
+
+    filename = db.Column(db.String(50), primary_key=True)
+    refcount = db.Column(db.Integer, nullable=False, default=0)
+
+
+def acquire_upload(connection, filename):
+    table = Upload.__table__
+    q = table.update().where(table.c.filename == filename)
+    result = connection.execute(q.values(refcount=table.c.refcount + 1))
+    if not result.rowcount:
+        connection.execute(table.insert().values(filename=filename,
+                                                 refcount=1))
+
+
+def release_upload(connection, filename):
+    """
+    Drop a reference to an upload, and say whether it was the last one.
+
+    Files without a count, which predate counting, are never released.
+    """
+
+    table = Upload.__table__
+    q = table.update().where(table.c.filename == filename)
+    connection.execute(q.values(refcount=table.c.refcount - 1))
+
+    q = table.delete().where(and_(table.c.filename == filename,
+                                  table.c.refcount <= 0))
+    return connection.execute(q).rowcount > 0
+
+
+def revise_thread(connection, threadid):
+    table = Thread.__table__
+    q = table.update().where(table.c.id == threadid)
+    connection.execute(q.values(revision=table.c.revision + 1))
+
+
+def release_post_upload(connection, post, filename):
+    if release_upload(connection, filename):
+        # The file goes once the post's removal is committed; see
+        # remove_released_uploads().
+        fp = fp_root(current_app).descendant(sharded(["comments", filename]))
+        released = inspect(post).session.info.setdefault("released_uploads",
+                                                         [])
+        released.append((filename, fp))
+
+
+@event.listens_for(Post, "after_insert")
+@event.listens_for(Post, "after_update")
+@event.listens_for(Post, "after_delete")
+def revise_post_thread(mapper, connection, target):
+    revise_thread(connection, target.threadid)
+
+
+@event.listens_for(Post, "after_insert")
+def count_post_upload(mapper, connection, target):
+    if target.filename:
+        acquire_upload(connection, target.filename)
+
+
+@event.listens_for(Post, "after_update")
+def recount_post_upload(mapper, connection, target):
+    history = inspect(target).attrs.filename.history
+    if not history.has_changes():
+        return
+
+    for filename in history.deleted:
+        if filename:
+            release_post_upload(connection, target, filename)
+    for filename in history.added:
+        if filename:
+            acquire_upload(connection, filename)
+
+
+@event.listens_for(Post, "after_delete")
+def uncount_post_upload(mapper, connection, target):
+    if target.filename:
+        release_post_upload(connection, target, target.filename)
+
+
+@event.listens_for(Post, "after_delete")
+def uncount_post(mapper, connection, target):
+    table = Thread.__table__
+    counts = {"post_count": table.c.post_count - 1}
+    if target.filename:
+        counts["image_count"] = table.c.image_count - 1
+    q = table.update().where(table.c.id == target.threadid)
+    connection.execute(q.values(**counts))
+
+
+@event.listens_for(Session, "after_commit")
+def remove_released_uploads(session):
+    released = session.info.pop("released_uploads", [])
+    if not released:
+        return
+
+    # Another post may have taken the same file since this commit, so only
+    # remove files which are still uncounted.
+    table = Upload.__table__
+    connection = session.get_bind(Upload.__mapper__).connect()
+    try:
+        for filename, fp in released:
+            q = select([table.c.filename]).where(table.c.filename == filename)
+            if connection.execute(q).first() is None:
+                remove_with_derivatives(fp)
+    finally:
+        connection.close()
+
+
+@event.listens_for(Session, "after_rollback")
+def keep_released_uploads(session):
+    session.info.pop("released_uploads", None)
+
+
+def posts_page(threadid, before=None, limit=50):
+    """
+    Fetch the newest posts in a thread, optionally only those posted before
+    the post with the ID ``before``.
+
+    Posts are ordered by timestamp, then ID, so that pages are found through
+    the thread's index instead of by counting past everything newer. Returns
+    the page, oldest first, and the ID to pass as ``before`` for the next
+    older page, or None if there isn't one.
+    """
+
+    q = Post.query.filter(Post.threadid == threadid)
+
+    if before is not None:
+        sq = db.session.query(Post.timestamp).filter(Post.id == before)
+        timestamp = sq.as_scalar()
+        q = q.filter(or_(Post.timestamp < timestamp,
+            and_(Post.timestamp == timestamp, Post.id < before)))
+
+    q = q.order_by(Post.timestamp.desc(), Post.id.desc())
+    posts = q.limit(limit + 1).all()
+
+    if len(posts) > limit:
+        posts = posts[:limit]
+        older = posts[-1].id
+    else:
+        older = None
+
+    posts.reverse()
+    return posts, older
 
 
 class Universe(db.Model):
@@ -115,6 +468,11 @@ class Universe(db.Model):
     slug = db.Column(db.String(85), primary_key=True)
     title = db.Column(db.Unicode(80), nullable=False)
     board_fk = db.Column(db.String(5), FK(Board.abbreviation))
+    # Counts every change to the universe, its characters and its comics, so
+    # that pages showing them can be validated without reading them. Kept by
+    # the events below.
+    revision = db.Column(db.Integer, nullable=False, default=0,
+                         server_default="0")
 
     board = relationship(Board, backref="universe", uselist=False)
 
@@ -166,12 +524,18 @@ class Character(db.Model, FilenameMixin):
             fp.moveTo(self.fp())
 
 
-class Comic(db.Model, FilenameMixin):
+class Comic(db.Model, DerivativesMixin, MarkupMixin):
     """
     A comic.
     """
 
     __tablename__ = "comics"
+    __table_args__ = (
+        # Navigation walks a single universe in upload order or in story
+        # order.
+        db.Index("ix_comics_universe_time", "universe_fk", "time"),
+        db.Index("ix_comics_universe_position", "universe_fk", "position"),
+    )
 
     # Serial number, for simple PK.
     id = db.Column(db.Integer, primary_key=True, unique=True, nullable=False)
@@ -179,14 +543,18 @@ class Comic(db.Model, FilenameMixin):
     time = db.Column(db.DateTime, unique=True, nullable=False)
     # Local filename.
     filename = db.Column(db.String(50), unique=True, nullable=False)
-    # Position in the timeline.
+    # Position in the timeline. Sparse; see POSITION_GAP.
     position = db.Column(db.Integer, nullable=False)
     # Title of the comic.
     title = db.Column(db.Unicode(80), nullable=False)
+    # Title of the comic, as it appears in URLs. Set by retitle().
+    slug = db.Column(db.String(255))
     # Description/alt text.
     description = db.Column(db.UnicodeText(1024 * 1024))
     # Commentary.
     comment = db.Column(db.UnicodeText(1024 * 1024))
+    # Commentary, rendered.
+    comment_html = db.Column(db.UnicodeText(16 * 1024 * 1024))
     # The discussion thread.
     threadid = db.Column(db.Integer, FK(Thread.id))
     # The universe in which this comic occurs.
@@ -199,6 +567,8 @@ class Comic(db.Model, FilenameMixin):
     # The universe which owns this comic.
     universe = relationship(Universe, backref="comics")
 
+    markup_fields = [("comment", "comment_html", True)]
+
     def __init__(self, universe, filename):
         self.universe = universe
         self.filename = filename
@@ -223,8 +593,12 @@ class Comic(db.Model, FilenameMixin):
         }
         return d
 
+    def retitle(self, title):
+        self.title = title
+        self.slug = slugify(title)
+
     def segments(self):
-        return ["comics", self.universe.slug, self.filename]
+        return sharded(["comics", self.universe.slug, self.filename])
 
     def verify_fp(self):
         """
@@ -239,6 +613,10 @@ class Comic(db.Model, FilenameMixin):
         Move this comic to come just after another comic in the timeline.
 
         If after is True, move this comic to just *before* another comic.
+
+        Positions are sparse, so this comic takes the midpoint of the gap
+        between its new neighbors and no other comics are touched. Only when
+        that gap is exhausted does the universe get rebalanced.
         """
 
         if not prior:
@@ -253,24 +631,109 @@ class Comic(db.Model, FilenameMixin):
                 "Comic.insert called with differing universes %r and %r" %
                 (self.universe, prior.universe))
 
-        if after:
-            position = max(prior.position - 1, 0)
-        else:
-            position = prior.position + 1
+        # This comic may still be pending without a position; don't let the
+        # neighbor lookups flush it.
+        with db.session.no_autoflush:
+            q = db.session.query(Comic.position)
+            q = q.filter(Comic.universe == self.universe)
+            if self.id is not None:
+                q = q.filter(Comic.id != self.id)
+
+            if after:
+                upper = prior.position
+                lower = q.filter(Comic.position < upper).order_by(
+                    Comic.position.desc()).first()
+                if lower is None:
+                    lower = upper - 2 * POSITION_GAP
+                else:
+                    lower = lower[0]
+            else:
+                lower = prior.position
+                upper = q.filter(Comic.position > lower).order_by(
+                    Comic.position).first()
+                if upper is None:
+                    upper = lower + 2 * POSITION_GAP
+                else:
+                    upper = upper[0]
+
+            if upper - lower < 2:
+                # Out of room. Spread everybody else back out; afterwards,
+                # the prior comic's neighbors are exactly one gap away.
+                rebalance_positions(self.universe, exclude=self)
+                if after:
+                    lower = prior.position - POSITION_GAP
+                    upper = prior.position
+                else:
+                    lower = prior.position
+                    upper = prior.position + POSITION_GAP
+
+        self.position = (lower + upper) // 2
+        db.session.add(self)
 
-        q = Comic.query.filter(Comic.universe == self.universe)
-        q = q.filter(Comic.position >= position).order_by(Comic.position)
 
-        for i, comic in enumerate(q):
-            # The correct new position. The +1 offset is because this current
-            # comic is shifting the old comics up.
-            target = i + position + 1
-            if comic.position != target:
-                comic.position = target
-                db.session.add(comic)
+def revise_universe(connection, slug):
+    table = Universe.__table__
+    q = table.update().where(table.c.slug == slug)
+    connection.execute(q.values(revision=table.c.revision + 1))
 
-        self.position = position
-        db.session.add(self)
+
+@event.listens_for(Universe, "after_update")
+def revise_edited_universe(mapper, connection, target):
+    revise_universe(connection, target.slug)
+
+
+# Comics are also dirtied by changes to their casts.
+@event.listens_for(Character, "after_insert")
+@event.listens_for(Character, "after_update")
+@event.listens_for(Character, "after_delete")
+@event.listens_for(Comic, "after_insert")
+@event.listens_for(Comic, "after_update")
+@event.listens_for(Comic, "after_delete")
+def revise_owning_universe(mapper, connection, target):
+    revise_universe(connection, target.universe_fk)
+
+
+def rebalance_positions(universe, exclude=None):
+    """
+    Renumber the timeline of a universe so that every comic is separated from
+    its neighbors by ``POSITION_GAP``.
+
+    The relative order of comics is preserved. If ``exclude`` is given, that
+    comic is skipped, so that it can be placed afterwards.
+
+    Returns the number of comics which were moved.
+    """
+
+    q = Comic.query.filter(Comic.universe == universe)
+    if exclude is not None and exclude.id is not None:
+        q = q.filter(Comic.id != exclude.id)
+
+    moved = 0
+
+    for i, comic in enumerate(q.order_by(Comic.position, Comic.id)):
+        target = i * POSITION_GAP
+        if comic.position != target:
+            comic.position = target
+            db.session.add(comic)
+            moved += 1
+
+    return moved
+
+
+def smallest_gap(universe):
+    """
+    Find the tightest spacing between two neighboring comics in a universe.
+
+    Returns None if the universe has fewer than two comics.
+    """
+
+    q = db.session.query(Comic.position).filter(Comic.universe == universe)
+    positions = [row[0] for row in q.order_by(Comic.position)]
+
+    if len(positions) < 2:
+        return None
+
+    return min(b - a for a, b in zip(positions, positions[1:]))
 
 
 class Portrait(db.Model, FilenameMixin):
@@ -309,18 +772,21 @@ class Portrait(db.Model, FilenameMixin):
         image.save(self.fp().path)
 
 
-class Newspost(db.Model):
+class Newspost(db.Model, MarkupMixin):
 
     __tablename__ = "newsposts"
 
     time = db.Column(db.DateTime, primary_key=True)
     title = db.Column(db.Unicode(80), nullable=False)
     content = db.Column(db.UnicodeText(1024 * 1024))
+    content_html = db.Column(db.UnicodeText(16 * 1024 * 1024))
 
     # Reference to the attached portrait.
     portrait_id = db.Column(db.String(45), FK(Portrait.slug), nullable=False)
     portrait = relationship(Portrait, backref="newsposts")
 
+    markup_fields = [("content", "content_html", True)]
+
     def __init__(self, title, content=u""):
         self.time = datetime.utcnow()
         self.title = title
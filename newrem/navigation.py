@@ -0,0 +1,209 @@
+"""
+In-memory timelines for navigating between comics.
+
+Navigation needs the neighbors of a comic in upload order and in story
+order. Rather than asking the database for each neighbor, each universe's
+timeline is loaded once with a single query and then searched with bisect.
+Unpublished comics are kept in the index and skipped when answering, so that
+an index stays valid as scheduled comics go live.
+"""
+
+from bisect import bisect_left, bisect_right
+from operator import itemgetter
+from threading import Lock
+from time import time
+
+from newrem.cache import generation
+from newrem.models import db, casts, Comic
+
+# How long, in seconds, an index may be trusted without being rebuilt. Admin
+# writes invalidate indices immediately: in the process which handled them
+# directly, and in other processes through the universe's cache generation
+# when the cache is shared.
+MAX_AGE = 60
+
+
+class NavigationIndex(object):
+    """
+    The timeline of a single universe.
+
+    Built from rows of (id, time, position), one per comic, and rows of
+    (character slug, comic ID) from the casts.
+    """
+
+    generation = None
+
+    def __init__(self, rows, cast=()):
+        self.by_time = sorted(rows, key=itemgetter(1))
+        self.times = [row[1] for row in self.by_time]
+
+        self.by_position = sorted(rows, key=itemgetter(2, 0))
+        self.positions = [row[2] for row in self.by_position]
+
+        # Each character's appearances, as sorted indices into the story
+        # order.
+        order = dict((row[0], i) for i, row in enumerate(self.by_position))
+        self.appearances = {}
+        for slug, cid in cast:
+            if cid in order:
+                self.appearances.setdefault(slug, []).append(order[cid])
+        for l in self.appearances.itervalues():
+            l.sort()
+
+        self.built = time()
+
+    @classmethod
+    def build(cls, universe):
+        q = db.session.query(Comic.id, Comic.time, Comic.position)
+        q = q.filter(Comic.universe_fk == universe.slug)
+        rows = [tuple(row) for row in q]
+
+        q = db.session.query(casts.c.character_id, casts.c.comic_id)
+        q = q.join(Comic, Comic.id == casts.c.comic_id)
+        q = q.filter(Comic.universe_fk == universe.slug)
+        cast = [tuple(row) for row in q]
+
+        return cls(rows, cast)
+
+    def stale(self, generation=None):
+        if generation is not None and generation != self.generation:
+            return True
+        return time() - self.built > MAX_AGE
+
+    def published(self, now):
+        """
+        The number of comics, in upload order, which are live at ``now``.
+        """
+
+        return bisect_left(self.times, now)
+
+    def newest(self, now):
+        """
+        The upload time of the newest live comic, or None.
+        """
+
+        live = self.published(now)
+        if live:
+            return self.times[live - 1]
+        return None
+
+    def upload_neighbors(self, comic, now):
+        """
+        Find the first, previous, next, and last comic IDs in upload order.
+
+        Missing neighbors are None.
+        """
+
+        live = self.published(now)
+        before = bisect_left(self.times, comic.time)
+        after = bisect_right(self.times, comic.time)
+
+        if before:
+            first = self.by_time[0][0]
+            previous = self.by_time[before - 1][0]
+        else:
+            first = previous = None
+
+        if after < live:
+            next = self.by_time[after][0]
+            last = self.by_time[live - 1][0]
+        else:
+            next = last = None
+
+        return first, previous, next, last
+
+    def story_neighbors(self, comic, now):
+        """
+        Find the previous and next comic IDs in story order.
+
+        Missing neighbors are None.
+        """
+
+        before = bisect_left(self.positions, comic.position)
+        after = bisect_right(self.positions, comic.position)
+
+        previous = self._scan(xrange(before - 1, -1, -1), now)
+        next = self._scan(xrange(after, len(self.by_position)), now)
+
+        return previous, next
+
+    def character_neighbors(self, comic, slugs, now):
+        """
+        Find the previous and next appearances, in story order, of each of
+        several characters.
+
+        Returns a dictionary of slugs to pairs of comic IDs. Missing
+        neighbors are None.
+        """
+
+        before = bisect_left(self.positions, comic.position)
+        after = bisect_right(self.positions, comic.position)
+
+        d = {}
+
+        for slug in slugs:
+            l = self.appearances.get(slug, [])
+            i = bisect_left(l, before)
+            j = bisect_left(l, after)
+
+            previous = self._scan((l[k] for k in xrange(i - 1, -1, -1)),
+                                  now)
+            next = self._scan((l[k] for k in xrange(j, len(l))), now)
+
+            d[slug] = previous, next
+
+        return d
+
+    def _scan(self, indices, now):
+        """
+        Walk through indices into the story order, returning the first
+        published comic ID.
+        """
+
+        for i in indices:
+            cid, t, position = self.by_position[i]
+            if t < now:
+                return cid
+        return None
+
+    def next_publication(self, now):
+        """
+        The time at which the next scheduled comic goes live, or None.
+        """
+
+        live = self.published(now)
+        if live < len(self.times):
+            return self.times[live]
+        return None
+
+
+_indices = {}
+_lock = Lock()
+
+
+def navigation_for(universe):
+    """
+    Get an up-to-date ``NavigationIndex`` for a universe.
+    """
+
+    current = generation("universe", universe.slug)
+    index = _indices.get(universe.slug)
+
+    if index is None or index.stale(current):
+        # Don't let a crowd of requests all rebuild the same index at once.
+        with _lock:
+            index = _indices.get(universe.slug)
+            if index is None or index.stale(current):
+                index = NavigationIndex.build(universe)
+                index.generation = current
+                _indices[universe.slug] = index
+
+    return index
+
+
+def invalidate(universe):
+    """
+    Forget the index for a universe, after its comics change.
+    """
+
+    _indices.pop(universe.slug, None)
@@ -0,0 +1,142 @@
+"""
+Online schema upgrades.
+
+``db.create_all()`` only creates tables which don't exist yet, so columns and
+indexes added to the models later have to be added to existing databases by
+hand. The helpers here compare the models against a live database and add
+whatever is missing, without rebuilding any tables.
+"""
+
+from sqlalchemy import inspect
+from sqlalchemy.schema import CreateColumn, CreateIndex
+
+
+def missing_columns(engine, metadata):
+    """
+    Find columns in the metadata which are missing from existing tables.
+
+    Tables which don't exist at all are skipped; ``create_all()`` handles
+    those.
+    """
+
+    inspector = inspect(engine)
+    tables = set(inspector.get_table_names())
+
+    missing = []
+
+    for table in metadata.sorted_tables:
+        if table.name not in tables:
+            continue
+
+        existing = set(c["name"] for c in inspector.get_columns(table.name))
+        for column in table.columns:
+            if column.name not in existing:
+                missing.append(column)
+
+    return missing
+
+
+def missing_indexes(engine, metadata):
+    """
+    Find named indexes in the metadata which are missing from existing
+    tables.
+    """
+
+    inspector = inspect(engine)
+    tables = set(inspector.get_table_names())
+
+    missing = []
+
+    for table in metadata.sorted_tables:
+        if table.name not in tables:
+            continue
+
+        existing = set(i["name"] for i in inspector.get_indexes(table.name))
+        for index in sorted(table.indexes, key=lambda i: i.name):
+            if index.name not in existing:
+                missing.append(index)
+
+    return missing
+
+
+def online(engine, ddl):
+    """
+    Ask the database not to lock out readers and writers while running some
+    ``ALTER TABLE`` DDL.
+
+    MySQL (5.6 and newer) can build indexes and add columns in place. SQLite
+    has no such option, but it only blocks writers, and only for as long as
+    the statement runs.
+    """
+
+    if engine.dialect.name == "mysql":
+        return ddl + ", ALGORITHM=INPLACE, LOCK=NONE"
+    return ddl
+
+
+def add_column(engine, column):
+    """
+    Add a column to an existing table.
+
+    New columns must be nullable or have a server default, since existing
+    rows need a value for them.
+    """
+
+    table = engine.dialect.identifier_preparer.format_table(column.table)
+    spec = CreateColumn(column).compile(dialect=engine.dialect)
+    engine.execute(online(engine, "ALTER TABLE %s ADD COLUMN %s" %
+                          (table, spec)))
+
+
+def add_index(engine, index):
+    """
+    Build an index on an existing table.
+    """
+
+    if engine.dialect.name == "mysql":
+        preparer = engine.dialect.identifier_preparer
+        columns = ", ".join(preparer.quote(c.name) for c in index.columns)
+        ddl = "ALTER TABLE %s ADD %sINDEX %s (%s)" % (
+            preparer.format_table(index.table),
+            "UNIQUE " if index.unique else "",
+            preparer.quote(index.name),
+            columns)
+        engine.execute(online(engine, ddl))
+    else:
+        engine.execute(CreateIndex(index))
+
+
+def upgrade(engine, metadata, log=None):
+    """
+    Bring an existing database up to date with the models.
+
+    Missing tables are created, then missing columns are added, then missing
+    indexes are built. Every step is idempotent, so an interrupted upgrade can
+    simply be run again.
+
+    Returns a list of descriptions of the changes made.
+    """
+
+    changes = []
+
+    def record(message):
+        changes.append(message)
+        if log is not None:
+            log(message)
+
+    inspector = inspect(engine)
+    tables = set(inspector.get_table_names())
+    for table in metadata.sorted_tables:
+        if table.name not in tables:
+            table.create(bind=engine)
+            record("created table %s" % table.name)
+
+    for column in missing_columns(engine, metadata):
+        add_column(engine, column)
+        record("added column %s.%s" % (column.table.name, column.name))
+
+    for index in missing_indexes(engine, metadata):
+        add_index(engine, index)
+        record("built index %s on %s" % (index.name, index.table.name))
+
+    return changes
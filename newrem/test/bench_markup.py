@@ -0,0 +1,66 @@
+"""
+Compare the speed of the blog markup renderers.
+
+Run with::
+
+    python -m newrem.test.bench_markup [--parsley-limit BYTES]
+
+The Parsley renderer is skipped for inputs larger than the limit, since it
+slows down badly on long comments.
+"""
+
+from optparse import OptionParser
+from random import Random
+import sys
+from time import time
+
+from newrem.grammars import BlogGrammar, LinearBlogGrammar
+
+SIZES = [100, 1000, 10 * 1000, 100 * 1000, 1000 * 1000]
+
+PIECES = ["lorem ", "ipsum ", "dolor ", "*sit* ", "**amet** ", "_elit_ ",
+          "\r\n", "\r\n\r\n", "\r\n>implying\r\n", "<&> "]
+
+
+def sample(size, seed=0):
+    r = Random(seed)
+    pieces = []
+    length = 0
+    while length < size:
+        piece = r.choice(PIECES)
+        pieces.append(piece)
+        length += len(piece)
+    return "".join(pieces)[:size]
+
+
+def timed(grammar, text):
+    start = time()
+    grammar(text).paragraphs()
+    return time() - start
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option("--parsley-limit", type="int", default=10 * 1000,
+                      help="largest input to give the Parsley renderer")
+    options, args = parser.parse_args(argv[1:])
+
+    print "%10s %12s %12s" % ("bytes", "parsley", "linear")
+    for size in SIZES:
+        text = sample(size)
+
+        if size <= options.parsley_limit:
+            parsley = "%11.4fs" % timed(BlogGrammar, text)
+        else:
+            parsley = "%12s" % "skipped"
+
+        linear = "%11.4fs" % timed(LinearBlogGrammar, text)
+
+        print "%10d %s %s" % (size, parsley, linear)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
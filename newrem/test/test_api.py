@@ -0,0 +1,137 @@
+from datetime import datetime, timedelta
+import json
+from shutil import rmtree
+from tempfile import mkdtemp
+import unittest
+
+from bp.filepath import FilePath
+
+from flask import Flask
+
+from newrem.api import api
+from newrem.converters import make_model_converter, merge_view_args
+from newrem.models import db, Character, Comic, Post, Thread, Universe
+
+
+class TestAPI(unittest.TestCase):
+
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite://"
+        self.app.config["DCON_UPLOAD_PATH"] = FilePath(mkdtemp())
+        self.app.config["DCON_STATIC_URL"] = "/static/"
+        self.app.url_map.converters["universe"] = make_model_converter(
+            self.app, Universe, "slug")
+        self.app.url_value_preprocessor(
+            lambda endpoint, values: merge_view_args(db.session, values))
+        # Comic pages are linked to, but not served, here.
+        self.app.add_url_rule("/<u>/comics/<int:cid>/<name>", "comics")
+        self.app.register_blueprint(api, url_prefix="/api")
+
+        db.init_app(self.app)
+        with self.app.test_request_context():
+            db.create_all()
+
+            universe = Universe(u"Testing")
+            alice = Character(universe, u"Alice")
+
+            # Story order is the reverse of upload order.
+            for i in range(5):
+                comic = Comic(universe, "%d.png" % i)
+                comic.retitle(u"Comic %d" % i)
+                comic.time = datetime(2012, 1, 1) + timedelta(days=i)
+                comic.position = 5 - i
+                comic.thread = Thread(None, comic.title, u"DCoN")
+                if i % 2:
+                    comic.characters = [alice]
+                db.session.add(comic)
+
+            comic.time = datetime.now() + timedelta(days=1)
+            db.session.commit()
+
+            thread = Comic.query.get(1).thread
+            for i in range(3):
+                post = Post(u"Anonymous", u"Post %d" % i, "", None)
+                post.timestamp = datetime(2012, 2, 1, i)
+                thread.add_post(post)
+                db.session.add(post)
+            db.session.commit()
+
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        with self.app.test_request_context():
+            db.drop_all()
+        rmtree(self.app.config["DCON_UPLOAD_PATH"].path)
+
+    def get(self, url, status=200):
+        # Links are absolute.
+        url = url.replace("http://localhost", "")
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status)
+        return json.loads(response.data)
+
+    def walk(self, url):
+        ids = []
+        while url is not None:
+            d = self.get(url)
+            ids.extend(comic["id"] for comic in d["comics"])
+            url = d["next"]
+        return ids
+
+    def test_comics_position(self):
+        self.assertEqual(self.walk("/api/testing/comics?limit=1"),
+                         [4, 3, 2, 1])
+
+    def test_comics_time(self):
+        self.assertEqual(self.walk("/api/testing/comics?order=time&limit=3"),
+                         [1, 2, 3, 4])
+
+    def test_comics_bad_order(self):
+        self.get("/api/testing/comics?order=random", 400)
+
+    def test_comic(self):
+        d = self.get("/api/testing/comics/2")
+        self.assertEqual(d["title"], u"Comic 1")
+        self.assertEqual(d["characters"], [{"slug": "alice",
+                                            "name": u"Alice"}])
+        self.assertEqual(d["navigation"]["previous"], 1)
+        self.assertEqual(d["navigation"]["last"], 4)
+        self.assertEqual(d["navigation"]["story"], {"previous": 3,
+                                                    "next": 1})
+        self.assertEqual(d["navigation"]["characters"]["alice"],
+                         {"previous": 4, "next": None})
+
+    def test_unpublished(self):
+        self.get("/api/testing/comics/5", 404)
+
+    def test_not_modified(self):
+        response = self.client.get("/api/testing/comics/2")
+        etag = response.headers["ETag"]
+
+        response = self.client.get("/api/testing/comics/2",
+                                   headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 304)
+
+    def test_new_post(self):
+        url = "/api/testing/comics/1/posts"
+        etag = self.client.get(url).headers["ETag"]
+
+        with self.app.test_request_context():
+            thread = Comic.query.get(1).thread
+            post = Post(u"Anonymous", u"Post 3", "", None)
+            thread.add_post(post)
+            db.session.add(post)
+            db.session.commit()
+
+        response = self.client.get(url, headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 200)
+
+    def test_posts(self):
+        d = self.get("/api/testing/comics/1/posts?limit=2")
+        self.assertEqual([p["comment"] for p in d["posts"]],
+                         [u"Post 1", u"Post 2"])
+
+        d = self.get(d["older"])
+        self.assertEqual([p["comment"] for p in d["posts"]], [u"Post 0"])
+        self.assertEqual(d["older"], None)
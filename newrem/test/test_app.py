@@ -0,0 +1,121 @@
+from collections import namedtuple
+from shutil import rmtree
+from tempfile import mkdtemp
+from unittest import TestCase
+
+from bp.filepath import FilePath
+
+from newrem import files
+from newrem.app import DCoN
+
+
+FauxUniverse = namedtuple("FauxUniverse", "slug")
+
+
+class TestSendStaticFile(TestCase):
+
+    def setUp(self):
+        self.first = FilePath(mkdtemp())
+        self.second = FilePath(mkdtemp())
+
+        self.app = DCoN(__name__)
+        self.app.static_paths.extend([self.first.path, self.second.path])
+        self.app.config["DCON_CONFIG"] = {}
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        rmtree(self.first.path)
+        rmtree(self.second.path)
+
+    def test_later_path(self):
+        self.second.child("style.css").setContent("body {}")
+        response = self.client.get("/static/style.css")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, "body {}")
+        self.assertEqual(self.app.static_roots["style.css"][1],
+                         self.second.path)
+
+    def test_remembered_miss(self):
+        self.assertEqual(self.client.get("/static/late.css").status_code, 404)
+        self.first.child("late.css").setContent("body {}")
+        self.assertEqual(self.client.get("/static/late.css").status_code, 404)
+
+    def test_removed(self):
+        fp = self.first.child("gone.css")
+        fp.setContent("body {}")
+        self.client.get("/static/gone.css")
+        fp.remove()
+        self.assertEqual(self.client.get("/static/gone.css").status_code, 404)
+        self.assertFalse("gone.css" in self.app.static_roots)
+
+    def test_escape(self):
+        response = self.client.get("/static/../etc/passwd")
+        self.assertEqual(response.status_code, 404)
+
+    def test_x_sendfile(self):
+        self.first.child("style.css").setContent("body {}")
+        self.app.config["DCON_CONFIG"]["sendfile"] = "x-sendfile"
+        self.app.config["USE_X_SENDFILE"] = True
+
+        response = self.client.get("/static/style.css")
+        self.assertEqual(response.headers["X-Sendfile"],
+                         self.first.child("style.css").path)
+        self.assertEqual(response.data, "")
+
+    def test_x_accel_redirect(self):
+        self.first.child("style.css").setContent("body {}")
+        self.app.config["DCON_CONFIG"]["sendfile"] = "x-accel-redirect"
+        self.app.config["USE_X_SENDFILE"] = True
+
+        response = self.client.get("/static/style.css")
+        self.assertFalse("X-Sendfile" in response.headers)
+        self.assertEqual(response.headers["X-Accel-Redirect"],
+                         "/_sendfile" + self.first.child("style.css").path)
+
+
+class TestUniverseTemplate(TestCase):
+
+    def setUp(self):
+        self.root = FilePath(mkdtemp())
+
+        self.app = DCoN(__name__)
+        self.app.template_paths.append(self.root.path)
+        self.u = FauxUniverse("testing")
+
+        self.interval = files.CHECK_INTERVAL
+
+    def tearDown(self):
+        files.CHECK_INTERVAL = self.interval
+        rmtree(self.root.path)
+
+    def override(self, name):
+        fp = self.root.descendant(["universe", "testing", name])
+        if not fp.parent().exists():
+            fp.parent().makedirs()
+        fp.setContent("override")
+
+    def test_generic(self):
+        self.assertEqual(self.app.universe_template(self.u, "comics.html"),
+                         "universe/comics.html")
+
+    def test_override(self):
+        self.override("comics.html")
+        self.assertEqual(self.app.universe_template(self.u, "comics.html"),
+                         "universe/testing/comics.html")
+        self.assertEqual(self.app.universe_template(self.u, "cast.html"),
+                         "universe/cast.html")
+
+    def test_new_override(self):
+        files.CHECK_INTERVAL = -1
+        self.app.universe_template(self.u, "comics.html")
+        self.override("comics.html")
+        self.assertEqual(self.app.universe_template(self.u, "comics.html"),
+                         "universe/testing/comics.html")
+
+    def test_packaged_override(self):
+        app = DCoN("newrem")
+        u = FauxUniverse("flavor-text")
+        self.assertEqual(app.universe_template(u, "comics.html"),
+                         "universe/flavor-text/comics.html")
+        self.assertEqual(app.universe_template(u, "nonexistent.html"),
+                         "universe/nonexistent.html")
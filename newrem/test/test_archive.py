@@ -0,0 +1,144 @@
+from datetime import datetime
+from shutil import rmtree
+from StringIO import StringIO
+import tarfile
+from tempfile import mkdtemp
+import unittest
+
+from bp.filepath import FilePath
+
+from flask import Flask
+
+from newrem.archive import Exporter, Restorer
+from newrem.models import (db, Board, Character, Comic, Post, Thread,
+                           Universe, Upload)
+
+
+class TestArchive(unittest.TestCase):
+
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite://"
+        self.app.config["DCON_UPLOAD_PATH"] = FilePath(mkdtemp())
+
+        db.init_app(self.app)
+        self.ctx = self.app.test_request_context()
+        self.ctx.push()
+        db.create_all()
+
+        universe = Universe(u"Testing")
+        universe.board = Board("t", u"Testing")
+        alice = Character(universe, u"Alice")
+
+        for i in range(3):
+            comic = Comic(universe, "%d.png" % i)
+            comic.retitle(u"Comic %d" % i)
+            comic.comment = u"Commentary"
+            comic.time = datetime(2012, 1, 1, i)
+            comic.position = i
+            comic.characters = [alice]
+            comic.thread = Thread(universe.board, comic.title, u"DCoN")
+            comic.thread.add_post(Post(u"Anonymous", u"Hi", "", "p.png"))
+            db.session.add(comic)
+        db.session.commit()
+
+        for comic in Comic.query:
+            self.make_file(comic.fp(), comic.filename)
+        self.make_file(Post.query.first().fp(), "post")
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.ctx.pop()
+        rmtree(self.app.config["DCON_UPLOAD_PATH"].path)
+
+    def make_file(self, fp, content):
+        if not fp.parent().exists():
+            fp.parent().makedirs()
+        fp.setContent(content)
+
+    def export(self):
+        handle = StringIO()
+        universe = Universe.query.get("testing")
+        files = Exporter(universe, handle, chunk=2).export()
+        self.assertEqual(files, 4)
+        return handle.getvalue()
+
+    def wipe(self):
+        db.drop_all()
+        db.create_all()
+        rmtree(self.app.config["DCON_UPLOAD_PATH"].path)
+        self.app.config["DCON_UPLOAD_PATH"].makedirs()
+
+    def restore(self, archive):
+        return Restorer(StringIO(archive)).restore()
+
+    def test_round_trip(self):
+        archive = self.export()
+        self.wipe()
+
+        counts = self.restore(archive)
+        self.assertEqual(counts["comics"], 3)
+        self.assertEqual(counts["post"], 3)
+        self.assertEqual(counts["files"], 4)
+
+        comic = Comic.query.get(1)
+        self.assertEqual(comic.title, u"Comic 0")
+        self.assertEqual(comic.time, datetime(2012, 1, 1, 0))
+        self.assertEqual([c.slug for c in comic.characters], ["alice"])
+        self.assertEqual(comic.thread.post_count, 1)
+        self.assertEqual(comic.fp().getContent(), "0.png")
+        self.assertEqual(Upload.query.get("p.png").refcount, 3)
+
+    def test_again(self):
+        archive = self.export()
+
+        counts = self.restore(archive)
+        self.assertEqual(sum(counts.values()), 0)
+        self.assertEqual(Comic.query.count(), 3)
+        self.assertEqual(Upload.query.get("p.png").refcount, 3)
+
+    def test_taken(self):
+        archive = self.export()
+        Comic.query.get(1).universe_fk = "other"
+        db.session.commit()
+
+        self.assertRaises(ValueError, self.restore, archive)
+
+    def test_other_universe(self):
+        archive = self.export()
+        Universe.query.get("testing").title = u"Someone else's"
+        db.session.commit()
+
+        self.assertRaises(ValueError, self.restore, archive)
+
+    def test_time_taken(self):
+        archive = self.export()
+        self.wipe()
+
+        universe = Universe(u"Other")
+        comic = Comic(universe, "other.png")
+        comic.id = 10
+        comic.retitle(u"Other")
+        comic.time = datetime(2012, 1, 1, 1)
+        comic.position = 0
+        db.session.add(comic)
+        db.session.commit()
+
+        try:
+            self.restore(archive)
+        except ValueError, e:
+            self.assertTrue("time" in e.args[0])
+        else:
+            self.fail("The comic's time was taken")
+
+    def test_characters_chunked(self):
+        universe = Universe.query.get("testing")
+        self.make_file(universe.characters[0].fp(), "alice")
+
+        handle = StringIO()
+        Exporter(universe, handle, chunk=2).export()
+        names = tarfile.open(fileobj=StringIO(handle.getvalue())).getnames()
+        self.assertTrue("characters/00000.json" in names)
+        self.assertTrue(names.index("characters/00000.json") <
+                        names.index("files/characters/testing/alice.png"))
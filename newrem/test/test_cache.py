@@ -0,0 +1,128 @@
+from datetime import datetime, timedelta
+from shutil import rmtree
+from tempfile import mkdtemp
+from unittest import TestCase
+
+from flask import Flask
+
+from newrem.cache import (DEFAULT_TIMEOUT, cache, bump, configure_cache,
+                          generation, shared, timeout_until)
+from newrem.conditional import conditional
+from newrem.decorators import cached
+
+
+class TestGeneration(TestCase):
+
+    def test_stable(self):
+        self.assertEqual(generation("test", 1), generation("test", 1))
+
+    def test_bump(self):
+        before = generation("test", 2)
+        bump("test", 2)
+        self.assertNotEqual(before, generation("test", 2))
+
+    def test_independent(self):
+        before = generation("test", 3)
+        bump("test", 4)
+        self.assertEqual(before, generation("test", 3))
+
+
+class TestConfigureCache(TestCase):
+
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.backend = cache.backend
+
+    def tearDown(self):
+        cache.backend = self.backend
+        cache.timeout = DEFAULT_TIMEOUT
+
+    def configure(self, **config):
+        self.app.config["DCON_CONFIG"] = config
+        configure_cache(self.app)
+
+    def test_shared(self):
+        directory = mkdtemp()
+        try:
+            self.configure(cache_dir=directory, job_queue="jobs.db")
+            self.assertTrue(shared())
+        finally:
+            rmtree(directory)
+
+    def test_single_process(self):
+        self.configure(single_process=True)
+        self.assertFalse(shared())
+
+    def test_unshared(self):
+        self.configure()
+        self.assertFalse(shared())
+
+    def test_worker(self):
+        self.configure(single_process=True, job_queue="jobs.db")
+        self.assertFalse(shared())
+
+
+class TestTimeoutUntil(TestCase):
+
+    def setUp(self):
+        self.now = datetime(2012, 12, 21)
+
+    def test_none(self):
+        self.assertEqual(timeout_until(None, self.now), DEFAULT_TIMEOUT)
+
+    def test_soon(self):
+        when = self.now + timedelta(seconds=30)
+        self.assertEqual(timeout_until(when, self.now), 30)
+
+    def test_round_up(self):
+        when = self.now + timedelta(seconds=30, microseconds=1)
+        self.assertEqual(timeout_until(when, self.now), 31)
+
+    def test_far(self):
+        when = self.now + timedelta(days=2)
+        self.assertEqual(timeout_until(when, self.now), DEFAULT_TIMEOUT)
+
+    def test_past(self):
+        when = self.now - timedelta(days=2)
+        self.assertEqual(timeout_until(when, self.now), 1)
+
+
+class TestCached(TestCase):
+
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.calls = []
+
+        @self.app.route("/feed")
+        @cached(lambda: [("test", "feed")])
+        def feed():
+            self.calls.append(None)
+            return "feed %d" % len(self.calls)
+
+        self.tag = "first"
+
+        @self.app.route("/tagged")
+        @conditional(lambda: (self.tag, None))
+        @cached(lambda: [("test", "feed")])
+        def tagged():
+            self.calls.append(None)
+            return "tagged %d" % len(self.calls)
+
+        self.client = self.app.test_client()
+
+        # Don't see anything cached by other tests.
+        bump("test", "feed")
+
+    def test_cached(self):
+        self.assertEqual(self.client.get("/feed").data, "feed 1")
+        self.assertEqual(self.client.get("/feed").data, "feed 1")
+
+    def test_bump(self):
+        self.client.get("/feed")
+        bump("test", "feed")
+        self.assertEqual(self.client.get("/feed").data, "feed 2")
+
+    def test_tagged(self):
+        self.client.get("/tagged")
+        self.tag = "second"
+        self.assertEqual(self.client.get("/tagged").data, "tagged 2")
@@ -0,0 +1,71 @@
+from datetime import datetime, timedelta
+import unittest
+
+from flask import Flask
+
+from newrem.chan import REPLIES_SHOWN, previews
+from newrem.models import db, Post, Thread
+
+class TestPreviews(unittest.TestCase):
+
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite://"
+
+        db.init_app(self.app)
+        self.ctx = self.app.test_request_context()
+        self.ctx.push()
+        db.create_all()
+
+        self.start = datetime(2012, 1, 1)
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.ctx.pop()
+
+    def make_thread(self, replies):
+        thread = Thread(None, u"Subject", u"Anonymous")
+        db.session.add(thread)
+        db.session.flush()
+        for i in range(replies + 1):
+            post = Post(u"Anonymous", u"%d" % i, "", None)
+            post.timestamp = self.start + timedelta(minutes=i)
+            thread.add_post(post)
+            db.session.add(post)
+        db.session.commit()
+        return thread
+
+    def comments(self, preview):
+        posts, omitted = preview
+        return [post.comment for post in posts], omitted
+
+    def test_empty(self):
+        self.assertEqual(previews([]), {})
+
+    def test_short(self):
+        thread = self.make_thread(1)
+        d = previews([thread])
+        self.assertEqual(self.comments(d[thread.id]), ([u"0", u"1"], 0))
+
+    def test_long(self):
+        replies = REPLIES_SHOWN + 2
+        long = self.make_thread(replies)
+        short = self.make_thread(0)
+        d = previews([long, short])
+
+        expected = [u"0"] + [u"%d" % i
+                             for i in range(3, replies + 1)]
+        self.assertEqual(self.comments(d[long.id]), (expected, 2))
+        self.assertEqual(self.comments(d[short.id]), ([u"0"], 0))
+
+    def test_same_timestamp(self):
+        thread = self.make_thread(REPLIES_SHOWN + 1)
+        for post in Post.query.filter_by(threadid=thread.id):
+            post.timestamp = self.start
+        db.session.commit()
+
+        posts, omitted = previews([thread])[thread.id]
+        self.assertEqual(len(posts), REPLIES_SHOWN + 1)
+        self.assertEqual(posts[0].comment, u"0")
+        self.assertEqual(omitted, 1)
@@ -0,0 +1,61 @@
+from datetime import datetime
+from unittest import TestCase
+
+from flask import Flask
+
+from newrem.conditional import conditional, make_etag
+
+
+class TestConditional(TestCase):
+
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.calls = []
+        self.etag = make_etag("test", 1)
+        self.last_modified = datetime(2012, 12, 21, 12, 0, 0, 500)
+
+        @self.app.route("/page")
+        @conditional(lambda: (self.etag, self.last_modified))
+        def page():
+            self.calls.append(None)
+            return "page"
+
+        self.client = self.app.test_client()
+
+    def test_full(self):
+        response = self.client.get("/page")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, "page")
+        self.assertTrue(self.etag in response.headers["ETag"])
+        self.assertEqual(response.headers["Last-Modified"],
+                         "Fri, 21 Dec 2012 12:00:00 GMT")
+
+    def test_etag(self):
+        headers = {"If-None-Match": 'W/"%s"' % self.etag}
+        response = self.client.get("/page", headers=headers)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(self.calls, [])
+
+    def test_etag_stale(self):
+        headers = {"If-None-Match": '"%s"' % make_etag("test", 0)}
+        response = self.client.get("/page", headers=headers)
+        self.assertEqual(response.status_code, 200)
+
+    def test_etag_wins(self):
+        headers = {
+            "If-None-Match": '"%s"' % make_etag("test", 0),
+            "If-Modified-Since": "Fri, 21 Dec 2012 12:00:00 GMT",
+        }
+        response = self.client.get("/page", headers=headers)
+        self.assertEqual(response.status_code, 200)
+
+    def test_modified_since(self):
+        headers = {"If-Modified-Since": "Fri, 21 Dec 2012 12:00:00 GMT"}
+        response = self.client.get("/page", headers=headers)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(self.calls, [])
+
+    def test_modified_since_stale(self):
+        headers = {"If-Modified-Since": "Fri, 21 Dec 2012 11:59:59 GMT"}
+        response = self.client.get("/page", headers=headers)
+        self.assertEqual(response.status_code, 200)
@@ -1,10 +1,13 @@
 from datetime import datetime
 from unittest import TestCase
 
+from werkzeug.exceptions import NotFound
+from werkzeug.routing import ValidationError
+
 from flask import Flask
 
-from newrem.converters import make_model_converter
-from newrem.models import db, Newspost
+from newrem.converters import forget, make_model_converter, merge_view_args
+from newrem.models import db, Newspost, Universe
 
 class TestNewspostConverter(TestCase):
 
@@ -41,9 +44,91 @@ class TestNewspostConverter(TestCase):
             db.session.add(news)
             db.session.commit()
 
-            result = self.converter.to_python(fragment)
-            db.session.add(result)
+            values = {"n": self.converter.to_python(fragment)}
+            merge_view_args(db.session, values)
+            result = values["n"]
 
             # No direct equality check, but this is close enough.
-            self.assertEqual(result.title, news.title)
-            self.assertEqual(result.time, news.time)
+            self.assertEqual(result.title, u"Test")
+            self.assertEqual(result.time, dt)
+
+    def test_raw_to_url(self):
+        self.assertEqual(self.converter.to_url(datetime(2012, 12, 21)),
+                         "1356048000")
+
+class TestUniverseConverter(TestCase):
+
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite://"
+        self.converter = make_model_converter(self.app, Universe, "slug")(None)
+
+        db.init_app(self.app)
+        with self.app.test_request_context():
+            db.create_all()
+            db.session.add(Universe(u"Testing"))
+            db.session.commit()
+
+    def tearDown(self):
+        with self.app.test_request_context():
+            db.drop_all()
+
+    def rename(self, title):
+        with self.app.test_request_context():
+            u = Universe.query.one()
+            u.title = title
+            db.session.commit()
+
+    def test_missing(self):
+        self.assertRaises(ValidationError, self.converter.to_python, "nope")
+
+    def load(self, slug):
+        values = {"u": self.converter.to_python(slug)}
+        with self.app.test_request_context():
+            merge_view_args(db.session, values)
+            return values["u"].title
+
+    def test_lookup(self):
+        lookup = self.converter.to_python("testing")
+        self.assertEqual((lookup.model, lookup.key), (Universe, "testing"))
+
+    def test_fresh(self):
+        self.converter.to_python("testing")
+        self.rename(u"Renamed")
+        self.assertEqual(self.load("testing"), u"Renamed")
+
+    def test_remembered(self):
+        self.converter.to_python("testing")
+        with self.app.test_request_context():
+            db.session.delete(Universe.query.one())
+            db.session.commit()
+        self.converter.to_python("testing")
+
+    def test_forget(self):
+        self.converter.to_python("testing")
+        with self.app.test_request_context():
+            db.session.delete(Universe.query.one())
+            db.session.commit()
+        forget(Universe)
+        self.assertRaises(ValidationError, self.converter.to_python,
+                          "testing")
+
+    def test_gone(self):
+        values = {"u": self.converter.to_python("testing")}
+        with self.app.test_request_context():
+            db.session.delete(Universe.query.one())
+            db.session.commit()
+            self.assertRaises(NotFound, merge_view_args, db.session, values)
+
+    def test_merge(self):
+        values = {"u": self.converter.to_python("testing"), "cid": 1}
+        with self.app.test_request_context():
+            merge_view_args(db.session, values)
+            self.assertTrue(values["u"] in db.session)
+            self.assertFalse(values["u"] in db.session.dirty)
+            self.assertEqual(values["cid"], 1)
+
+            # Loaded objects can be changed like any other.
+            values["u"].title = u"Renamed"
+            db.session.commit()
+            self.assertEqual(Universe.query.one().title, u"Renamed")
@@ -1,6 +1,18 @@
+from hashlib import md5
+from shutil import rmtree
+from StringIO import StringIO
+from tempfile import mkdtemp
 from unittest import TestCase
 
-from newrem.files import extend_url
+from bp.filepath import FilePath
+
+from PIL import Image
+
+from werkzeug.datastructures import FileStorage
+
+from newrem import files
+from newrem.files import (AssetManifest, extend_url, save_upload, shard,
+                          sharded)
 
 
 class TestExtendURL(TestCase):
@@ -10,3 +22,116 @@ class TestExtendURL(TestCase):
         segments = ["test", "path"]
         expected = "http://example.com/test/path"
         self.assertEqual(extend_url(url, segments), expected)
+
+
+class TestShard(TestCase):
+
+    def test_shard_example(self):
+        # md5("strip.png") is 1e6d68...
+        self.assertEqual(shard("strip.png"), ["1e", "6d"])
+
+    def test_shard_unicode(self):
+        self.assertEqual(shard(u"strip.png"), shard("strip.png"))
+
+    def test_sharded(self):
+        segments = ["comics", "test", "strip.png"]
+        expected = ["comics", "test", "1e", "6d", "strip.png"]
+        self.assertEqual(sharded(segments), expected)
+
+
+class TestSaveUpload(TestCase):
+
+    def setUp(self):
+        self.fp = FilePath(mkdtemp())
+        self.chunk_size = files.CHUNK_SIZE
+        files.CHUNK_SIZE = 4
+
+    def tearDown(self):
+        files.CHUNK_SIZE = self.chunk_size
+        rmtree(self.fp.path)
+
+    def image(self, format="PNG"):
+        handle = StringIO()
+        Image.new("RGB", (4, 4)).save(handle, format)
+        return handle.getvalue()
+
+    def upload(self, data, content_type="image/png"):
+        return FileStorage(StringIO(data), "upload", content_type=content_type)
+
+    def test_named_by_contents(self):
+        data = self.image()
+        filename = save_upload(self.upload(data), self.fp.child("comments"))
+        self.assertEqual(filename, md5(data).hexdigest() + ".png")
+        fp = self.fp.descendant(sharded(["comments", filename]))
+        self.assertEqual(fp.getContent(), data)
+
+    def test_same_contents(self):
+        first = save_upload(self.upload(self.image()), self.fp)
+        second = save_upload(self.upload(self.image()), self.fp)
+        self.assertEqual(first, second)
+        self.assertEqual([p.basename() for p in self.fp.walk()
+                          if p.isfile()], [first])
+
+    def test_sniffed_type(self):
+        data = self.image("JPEG")
+        filename = save_upload(self.upload(data, "text/html"), self.fp)
+        self.assertEqual(filename, md5(data).hexdigest() + ".jpg")
+
+    def test_not_an_image(self):
+        self.assertEqual(save_upload(self.upload("<html>"), self.fp), None)
+        self.assertEqual(self.fp.children(), [])
+
+    def test_empty(self):
+        self.assertEqual(save_upload(self.upload(""), self.fp), None)
+        self.assertEqual(self.fp.children(), [])
+
+
+class TestAssetManifest(TestCase):
+
+    def setUp(self):
+        self.first = FilePath(mkdtemp())
+        self.second = FilePath(mkdtemp())
+        self.manifest = AssetManifest([self.first.path, self.second.path])
+
+        self.interval = files.CHECK_INTERVAL
+
+    def tearDown(self):
+        files.CHECK_INTERVAL = self.interval
+
+        rmtree(self.first.path)
+        rmtree(self.second.path)
+
+    def touch(self, root, *segments):
+        fp = root.descendant(segments)
+        if not fp.parent().exists():
+            fp.parent().makedirs()
+        fp.touch()
+
+    def test_missing(self):
+        self.assertEqual(self.manifest.names(["404"]), [])
+
+    def test_all_paths(self):
+        self.touch(self.first, "404", "b.png")
+        self.touch(self.first, "404", "a.png")
+        self.touch(self.second, "404", "c.png")
+        self.assertEqual(self.manifest.names(["404"]),
+                         ["a.png", "b.png", "c.png"])
+
+    def test_build(self):
+        self.touch(self.first, "u", "images", "banners", "a.png")
+        self.manifest.build()
+        self.assertTrue(("u", "images", "banners") in self.manifest.listings)
+
+    def test_remembered(self):
+        self.touch(self.first, "404", "a.png")
+        self.manifest.names(["404"])
+        self.touch(self.first, "404", "b.png")
+        self.assertEqual(self.manifest.names(["404"]), ["a.png"])
+
+    def test_refreshed(self):
+        files.CHECK_INTERVAL = -1
+        self.manifest.names(["404"])
+        self.touch(self.first, "404", "a.png")
+        self.assertEqual(self.manifest.names(["404"]), ["a.png"])
+        self.touch(self.second, "404", "b.png")
+        self.assertEqual(self.manifest.names(["404"]), ["a.png", "b.png"])
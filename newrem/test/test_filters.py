@@ -0,0 +1,29 @@
+from collections import namedtuple
+from unittest import TestCase
+
+from flask import Flask
+
+from newrem.filters import url_for_comic
+
+
+# No universe attribute, so any attempt to load one fails loudly.
+FauxComic = namedtuple("FauxComic", "id, title, slug, universe_fk")
+
+
+class TestURLForComic(TestCase):
+
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.app.add_url_rule("/<u>/comics/<int:cid>/<name>", "comics")
+
+    def test_stored_slug(self):
+        comic = FauxComic(1, u"Ignored", "stored", "testing")
+        with self.app.test_request_context():
+            self.assertEqual(url_for_comic(comic),
+                             "/testing/comics/1/stored")
+
+    def test_missing_slug(self):
+        comic = FauxComic(2, u"Caf\xe9 Time!", None, "testing")
+        with self.app.test_request_context():
+            self.assertEqual(url_for_comic(comic),
+                             "/testing/comics/2/cafe-time")
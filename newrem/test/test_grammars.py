@@ -1,8 +1,9 @@
+from random import Random
 from unittest import TestCase
 
 from ometa.runtime import ParseError
 
-from newrem.grammars import BlogGrammar
+from newrem.grammars import BlogGrammar, LinearBlogGrammar
 
 class TestBlogGrammar(TestCase):
 
@@ -97,3 +98,71 @@ class TestBlogGrammarSafety(TestCase):
         text = """;!--"<XSS>=&{()}"""
         sanitized = BlogGrammar(text).safe_paragraphs()
         self.assertTrue("<XSS>" not in sanitized)
+
+class TestLinearBlogGrammar(TestCase):
+    """
+    LinearBlogGrammar must produce exactly the same output as BlogGrammar.
+    """
+
+    corpus = [
+        "",
+        "asdf",
+        "asdf\r\njkl",
+        "asdf\r\n\r\njkl",
+        "asdf\r\n\r\n\r\njkl",
+        "*asdf*",
+        "**asdf**",
+        "_asdf_",
+        "**a*sd*f**",
+        "*a**sd**f*",
+        "_a*sd*f_",
+        "*as\r\n\r\ndf*",
+        "**a*b**",
+        "*a**",
+        "*",
+        "**",
+        "***",
+        "****",
+        "*_*_*_",
+        "_*_*_*",
+        "**unclosed *italics* and _underline_",
+        "\r\n>mfw\r\n",
+        "\r\n\r\n>mfw\r\n\r\n",
+        "\r\n>a\r\n>b\r\n",
+        "\r\n>*quoted* **bold**\r\nafter",
+        "\r\n>unterminated",
+        "\r\n\r\nx",
+        "\r\r\n\n",
+        "<br />",
+        """;!--"<XSS>=&{()}""",
+        "*<b>*",
+        "'quoted' \"double\" & ampersand",
+        u"\xe9*\xe8*_\xea_",
+    ]
+
+    def assertParity(self, text):
+        for rule in ("paragraphs", "safe_paragraphs"):
+            expected = getattr(BlogGrammar(text), rule)()
+            actual = getattr(LinearBlogGrammar(text), rule)()
+            self.assertEqual(expected, actual,
+                "%s of %r: %r != %r" % (rule, text, expected, actual))
+
+    def test_corpus(self):
+        for text in self.corpus:
+            self.assertParity(text)
+
+    def test_random(self):
+        pieces = ["a", "b", " ", "*", "**", "_", "\r\n", "\r", "\n", ">",
+                  "<", "&", "'", '"', "\r\n>"]
+        r = Random(42)
+        for i in range(300):
+            length = r.randint(0, 30)
+            text = "".join(r.choice(pieces) for j in range(length))
+            self.assertParity(text)
+
+    def test_deep_nesting(self):
+        # Far deeper than Python's recursion limit.
+        text = "_*" * 5000 + "x" + "*_" * 5000
+        html = LinearBlogGrammar(text).paragraphs()
+        self.assertEqual(html, "<p>" + "<u><i>" * 5000 + "x" +
+                         "</i></u>" * 5000 + "</p>")
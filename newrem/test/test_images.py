@@ -0,0 +1,103 @@
+from shutil import rmtree
+from tempfile import mkdtemp
+from unittest import TestCase
+
+from bp.filepath import FilePath
+
+from PIL import Image
+
+from newrem.images import (SIZES, derivative_fp, derivative_segments,
+                           make_derivatives, make_derivatives_at,
+                           move_with_derivatives, remove_with_derivatives)
+
+
+class TestDerivativeSegments(TestCase):
+
+    def test_derivative_segments(self):
+        segments = ["comics", "testing", "strip.png"]
+        expected = ["comics", "testing", "thumb", "strip.png"]
+        self.assertEqual(derivative_segments(segments, "thumb"), expected)
+
+
+class TestMakeDerivatives(TestCase):
+
+    def setUp(self):
+        self.root = FilePath(mkdtemp())
+
+    def tearDown(self):
+        rmtree(self.root.path)
+
+    def make_image(self, size, name="strip.png"):
+        fp = self.root.child(name)
+        Image.new("RGB", size).save(fp.path)
+        return fp
+
+    def size_of(self, fp, size):
+        return Image.open(derivative_fp(fp, size).path).size
+
+    def test_large(self):
+        fp = self.make_image((2000, 1000))
+        make_derivatives(fp)
+        self.assertEqual(self.size_of(fp, "thumb"), (200, 100))
+        self.assertEqual(self.size_of(fp, "web"), (960, 480))
+
+    def test_small(self):
+        fp = self.make_image((100, 50))
+        make_derivatives(fp)
+        for size in SIZES:
+            self.assertEqual(derivative_fp(fp, size).getContent(),
+                             fp.getContent())
+
+    def test_format(self):
+        fp = self.make_image((2000, 1000), "strip.jpg")
+        make_derivatives(fp)
+        image = Image.open(derivative_fp(fp, "web").path)
+        self.assertEqual(image.format, "JPEG")
+
+    def test_not_an_image(self):
+        fp = self.root.child("notes.txt")
+        fp.setContent("Not an image.")
+        self.assertRaises(IOError, make_derivatives, fp)
+        self.assertFalse(make_derivatives_at(fp.path))
+
+    def test_missing(self):
+        self.assertFalse(make_derivatives_at(self.root.child("gone").path))
+
+
+class TestMoveWithDerivatives(TestCase):
+
+    def setUp(self):
+        self.root = FilePath(mkdtemp())
+        self.source = self.root.descendant(["comments", "a.png"])
+        self.target = self.root.descendant(["comments", "ab", "a.png"])
+
+        Image.new("RGB", (10, 10)).save(self.make_parent(self.source).path)
+        make_derivatives(self.source)
+
+    def tearDown(self):
+        rmtree(self.root.path)
+
+    def make_parent(self, fp):
+        if not fp.parent().exists():
+            fp.parent().makedirs()
+        return fp
+
+    def test_move(self):
+        self.assertEqual(move_with_derivatives(self.source, self.target),
+                         1 + len(SIZES))
+        for size in SIZES:
+            self.assertTrue(derivative_fp(self.target, size).exists())
+        self.assertFalse(self.source.exists())
+
+    def test_resume(self):
+        # Interrupted after moving the original.
+        self.make_parent(self.target)
+        self.source.moveTo(self.target)
+
+        self.assertEqual(move_with_derivatives(self.source, self.target),
+                         len(SIZES))
+        self.assertEqual(move_with_derivatives(self.source, self.target), 0)
+
+    def test_remove(self):
+        remove_with_derivatives(self.source)
+        self.assertEqual([fp for fp in self.root.walk() if fp.isfile()], [])
@@ -0,0 +1,139 @@
+from datetime import datetime
+from shutil import rmtree
+from tempfile import mkdtemp
+import unittest
+
+from bp.filepath import FilePath
+
+from flask import Flask
+
+from newrem.importer import (import_comics, parse_entries, queue_derivatives,
+                             read_manifest)
+from newrem.jobs import queue
+from newrem.models import db, POSITION_GAP, Character, Comic, Universe
+
+
+class TestReadManifest(unittest.TestCase):
+
+    def setUp(self):
+        self.fp = FilePath(mkdtemp())
+
+    def tearDown(self):
+        rmtree(self.fp.path)
+
+    def test_yaml(self):
+        fp = self.fp.child("manifest.yaml")
+        fp.setContent("- file: a.png\n"
+                      "  title: First\n"
+                      "  time: 2012-01-01 10:00:00\n"
+                      "  characters: [alice, bob]\n")
+        entries = parse_entries(read_manifest(fp.path))
+        self.assertEqual(entries[0]["time"], datetime(2012, 1, 1, 10))
+        self.assertEqual(entries[0]["characters"], [u"alice", u"bob"])
+
+    def test_csv(self):
+        fp = self.fp.child("manifest.csv")
+        fp.setContent("file,title,time,characters,order\n"
+                      "b.png,Second,2012-01-02,\"alice, bob\",2\n"
+                      "a.png,First,2012-01-01 10:00,,1\n")
+        entries = parse_entries(read_manifest(fp.path))
+        self.assertEqual([e["filename"] for e in entries], ["a.png", "b.png"])
+        self.assertEqual(entries[0]["time"], datetime(2012, 1, 1, 10))
+        self.assertEqual(entries[1]["characters"], [u"alice", u"bob"])
+
+    def test_order_zero(self):
+        entries = parse_entries([{"file": "a.png", "title": "A", "order": 1},
+                                 {"file": "b.png", "title": "B", "order": 0}])
+        self.assertEqual([e["filename"] for e in entries], ["b.png", "a.png"])
+
+    def test_missing_title(self):
+        self.assertRaises(ValueError, parse_entries, [{"file": "a.png"}])
+
+    def test_bad_time(self):
+        self.assertRaises(ValueError, parse_entries,
+                          [{"file": "a.png", "title": "A", "time": "soon"}])
+
+
+class TestImportComics(unittest.TestCase):
+
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite://"
+        self.app.config["DCON_UPLOAD_PATH"] = FilePath(mkdtemp())
+        self.images = FilePath(mkdtemp())
+
+        db.init_app(self.app)
+        self.ctx = self.app.test_request_context()
+        self.ctx.push()
+        db.create_all()
+
+        self.universe = Universe(u"Testing")
+        self.character = Character(self.universe, u"Alice")
+        db.session.add(self.universe)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.ctx.pop()
+        rmtree(self.app.config["DCON_UPLOAD_PATH"].path)
+        rmtree(self.images.path)
+
+    def entries(self, count):
+        rows = []
+        for i in range(count):
+            name = "%03d.png" % i
+            self.images.child(name).setContent(name)
+            rows.append({"file": name, "title": "Comic %d" % i,
+                         "time": datetime(2012, 1, 1, 0, i),
+                         "characters": ["alice"]})
+        return parse_entries(rows)
+
+    def test_import(self):
+        result = import_comics(self.universe, self.entries(5), self.images,
+                               batch=2)
+        self.assertEqual(result, (5, 0, 5))
+
+        comics = Comic.query.order_by(Comic.position).all()
+        self.assertEqual([c.position for c in comics],
+                         [i * POSITION_GAP for i in range(5)])
+        self.assertEqual(comics[0].characters, [self.character])
+        self.assertEqual(comics[0].slug, "comic-0")
+        self.assertTrue(comics[0].thread is not None)
+        self.assertEqual(comics[4].fp().getContent(), "004.png")
+
+    def test_resume(self):
+        import_comics(self.universe, self.entries(2), self.images)
+        Comic.query.first().fp().remove()
+
+        result = import_comics(self.universe, self.entries(3), self.images)
+        self.assertEqual(result, (1, 2, 2))
+        self.assertEqual(Comic.query.count(), 3)
+
+    def test_queue_derivatives(self):
+        entries = self.entries(3)
+        import_comics(self.universe, entries, self.images)
+        Comic.query.first().derivatives_version = 1
+        db.session.commit()
+
+        path = queue.path
+        queue.path = self.images.child("jobs.sqlite").path
+        try:
+            self.assertEqual(queue_derivatives(self.universe, entries), 2)
+            self.assertEqual(queue.counts(), {"queued": 2})
+        finally:
+            queue.path = path
+
+    def test_unknown_character(self):
+        entries = self.entries(1)
+        entries[0]["characters"] = [u"mallory"]
+        self.assertRaises(ValueError, import_comics, self.universe, entries,
+                          self.images)
+        self.assertEqual(Comic.query.count(), 0)
+
+    def test_missing_file(self):
+        entries = self.entries(2)
+        self.images.child("001.png").remove()
+        self.assertRaises(ValueError, import_comics, self.universe, entries,
+                          self.images)
+        self.assertEqual(Comic.query.count(), 0)
@@ -0,0 +1,173 @@
+from shutil import rmtree
+from tempfile import mkdtemp
+import os.path
+import unittest
+
+from bp.filepath import FilePath
+
+from PIL import Image
+
+from flask import Flask
+
+from newrem import jobs
+from newrem.jobs import MAX_ATTEMPTS, Queue, job, queue, run_next
+from newrem.models import db, Portrait
+
+calls = []
+
+@job
+def record(value):
+    calls.append(value)
+
+@job
+def explode():
+    raise ValueError("Kaboom")
+
+class TestQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = mkdtemp()
+        self.queue = Queue(os.path.join(self.directory, "jobs.sqlite"))
+
+    def tearDown(self):
+        rmtree(self.directory)
+
+    def test_empty(self):
+        self.assertEqual(self.queue.claim(), None)
+        self.assertEqual(self.queue.counts(), {})
+
+    def test_claim(self):
+        jid = self.queue.enqueue("record", value=1)
+        row = self.queue.claim()
+        self.assertEqual(row["id"], jid)
+        self.assertEqual(row["attempts"], 1)
+        self.assertEqual(self.queue.counts(), {"running": 1})
+
+        # Nobody else gets it.
+        self.assertEqual(self.queue.claim(), None)
+
+    def test_order(self):
+        first = self.queue.enqueue("record", value=1)
+        second = self.queue.enqueue("record", value=2)
+        self.assertEqual(self.queue.claim()["id"], first)
+        self.assertEqual(self.queue.claim()["id"], second)
+
+    def test_finish(self):
+        jid = self.queue.enqueue("record", value=1)
+        self.queue.claim()
+        self.queue.finish(jid)
+        self.assertEqual(self.queue.counts(), {"done": 1})
+
+    def test_fail_retries_later(self):
+        jid = self.queue.enqueue("record", value=1)
+        self.queue.claim()
+        self.queue.fail(jid, 1, "Oops")
+        self.assertEqual(self.queue.counts(), {"queued": 1})
+        # Not due yet.
+        self.assertEqual(self.queue.claim(), None)
+
+    def test_fail_gives_up(self):
+        jid = self.queue.enqueue("record", value=1)
+        self.queue.claim()
+        self.queue.fail(jid, MAX_ATTEMPTS, "Oops")
+        self.assertEqual(self.queue.counts(), {"failed": 1})
+        self.assertEqual(self.queue.recent()[0]["error"], "Oops")
+
+        self.queue.retry(jid)
+        row = self.queue.claim()
+        self.assertEqual(row["id"], jid)
+        self.assertEqual(row["attempts"], 1)
+
+    def test_lease(self):
+        jid = self.queue.enqueue("record", value=1)
+        self.queue.claim()
+
+        lease = jobs.LEASE
+        jobs.LEASE = -1
+        try:
+            self.assertEqual(self.queue.claim()["id"], jid)
+        finally:
+            jobs.LEASE = lease
+
+class TestRunNext(unittest.TestCase):
+
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite://"
+        db.init_app(self.app)
+        self.ctx = self.app.test_request_context()
+        self.ctx.push()
+
+        self.directory = mkdtemp()
+        self.path = queue.path
+        queue.path = os.path.join(self.directory, "jobs.sqlite")
+
+        del calls[:]
+
+    def tearDown(self):
+        queue.path = self.path
+        rmtree(self.directory)
+        self.ctx.pop()
+
+    def test_nothing(self):
+        self.assertFalse(run_next())
+
+    def test_run(self):
+        queue.enqueue("record", value=42)
+        self.assertEqual(calls, [])
+        self.assertTrue(run_next())
+        self.assertEqual(calls, [42])
+        self.assertEqual(queue.counts(), {"done": 1})
+
+    def test_failure(self):
+        queue.enqueue("explode")
+        self.assertTrue(run_next())
+        job = queue.recent()[0]
+        self.assertEqual(job["status"], "queued")
+        self.assertTrue("Kaboom" in job["error"])
+
+    def test_inline(self):
+        queue.path = None
+        self.assertEqual(queue.enqueue("record", value=7), None)
+        self.assertEqual(calls, [7])
+
+    def test_inline_failure(self):
+        queue.path = None
+        self.assertEqual(queue.enqueue("explode"), None)
+
+class TestPortrait(unittest.TestCase):
+
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite://"
+        self.app.config["DCON_UPLOAD_PATH"] = FilePath(mkdtemp())
+        db.init_app(self.app)
+        self.ctx = self.app.test_request_context()
+        self.ctx.push()
+        db.create_all()
+
+        db.session.add(Portrait(u"Cid"))
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.ctx.pop()
+        rmtree(self.app.config["DCON_UPLOAD_PATH"].path)
+
+    def test_resized(self):
+        staged = self.app.config["DCON_UPLOAD_PATH"].child("staged")
+        Image.new("RGB", (500, 100)).save(staged.path, "PNG")
+
+        jobs.portrait("cid", staged.path)
+        self.assertFalse(os.path.exists(staged.path))
+        image = Image.open(Portrait.query.get("cid").fp().path)
+        self.assertEqual(image.size, (250, 50))
+
+    def test_unreadable(self):
+        staged = self.app.config["DCON_UPLOAD_PATH"].child("staged")
+        staged.setContent("Not an image")
+
+        # Raised, so that the job is marked as failed, and kept for a retry.
+        self.assertRaises(IOError, jobs.portrait, "cid", staged.path)
+        self.assertTrue(os.path.exists(staged.path))
@@ -0,0 +1,53 @@
+from datetime import datetime, timedelta
+from shutil import rmtree
+from tempfile import mkdtemp
+import unittest
+
+from bp.filepath import FilePath
+
+from flask import Flask
+
+from newrem.manage import rebalance
+from newrem.models import db, Comic, Universe
+from newrem.navigation import navigation_for
+
+
+class TestRebalance(unittest.TestCase):
+
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite://"
+        self.app.config["DCON_UPLOAD_PATH"] = FilePath(mkdtemp())
+
+        db.init_app(self.app)
+        self.ctx = self.app.test_request_context()
+        self.ctx.push()
+        db.create_all()
+
+        # Dense positions, as in databases from before they were sparse.
+        self.universe = Universe(u"Rebalancing")
+        for i in range(5):
+            comic = Comic(self.universe, "%d.png" % i)
+            comic.retitle(u"Comic %d" % i)
+            comic.time = datetime(2012, 1, 1) + timedelta(days=i)
+            comic.position = i
+            db.session.add(comic)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.ctx.pop()
+        rmtree(self.app.config["DCON_UPLOAD_PATH"].path)
+
+    def test_neighbors(self):
+        now = datetime.now()
+        comic = Comic.query.get(3)
+
+        # Load the timeline, as a running site would have.
+        navigation_for(self.universe)
+
+        rebalance(self.app, ["--force"])
+
+        index = navigation_for(self.universe)
+        self.assertEqual(index.story_neighbors(comic, now), (2, 4))
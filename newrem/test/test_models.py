@@ -1,6 +1,16 @@
+from datetime import datetime, timedelta
+from tempfile import mkdtemp
 import unittest
 
-from newrem.models import (Board, Newspost, Post, Universe)
+from bp.filepath import FilePath
+
+from flask import Flask
+
+from newrem.files import sharded
+from newrem.markup import MARKUP_VERSION
+from newrem.models import (db, POSITION_GAP, Board, Character, Comic,
+                           Newspost, Post, Thread, Universe, Upload,
+                           rebalance_positions, posts_page, smallest_gap)
 
 class TestPostModel(unittest.TestCase):
 
@@ -33,3 +43,464 @@ class TestNewspostModel(unittest.TestCase):
 
     def test_trivial(self):
         pass
+
+class TestComicInsert(unittest.TestCase):
+
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite://"
+        self.app.config["DCON_UPLOAD_PATH"] = FilePath(mkdtemp())
+
+        db.init_app(self.app)
+        self.ctx = self.app.test_request_context()
+        self.ctx.push()
+        db.create_all()
+
+        self.universe = Universe(u"Testing")
+        db.session.add(self.universe)
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.ctx.pop()
+        self.app.config["DCON_UPLOAD_PATH"].remove()
+
+    def make_comic(self, name):
+        comic = Comic(self.universe, name)
+        comic.title = unicode(name)
+        # Uploads happen too quickly to tell apart.
+        self.uploads += 1
+        comic.time = datetime(2012, 1, 1) + timedelta(minutes=self.uploads)
+        return comic
+
+    uploads = 0
+
+    def timeline(self):
+        q = Comic.query.filter_by(universe=self.universe)
+        return [c.filename for c in q.order_by(Comic.position)]
+
+    def append(self, name):
+        last = Comic.query.order_by(Comic.position.desc()).first()
+        comic = self.make_comic(name)
+        comic.insert(last)
+        db.session.commit()
+        return comic
+
+    def test_insert_first(self):
+        comic = self.append("a")
+        self.assertEqual(comic.position, 0)
+
+    def test_insert_after(self):
+        self.append("a")
+        comic = self.append("b")
+        self.assertEqual(comic.position, POSITION_GAP)
+        self.assertEqual(self.timeline(), ["a", "b"])
+
+    def test_insert_before(self):
+        a = self.append("a")
+        comic = self.make_comic("b")
+        comic.insert(a, True)
+        db.session.commit()
+        self.assertEqual(self.timeline(), ["b", "a"])
+
+    def test_insert_between_touches_nobody(self):
+        a = self.append("a")
+        c = self.append("c")
+        comic = self.make_comic("b")
+        comic.insert(a)
+        dirty = [o for o in db.session.dirty if isinstance(o, Comic)]
+        self.assertEqual(dirty, [])
+        db.session.commit()
+        self.assertEqual(self.timeline(), ["a", "b", "c"])
+        self.assertEqual((a.position, c.position), (0, POSITION_GAP))
+
+    def test_insert_exhausted_rebalances(self):
+        a = self.append("a")
+        self.append("z")
+        # Keep wedging comics in right after the first one until the gap
+        # runs out.
+        names = ["b%02d" % i for i in range(15)]
+        for name in names:
+            comic = self.make_comic(name)
+            comic.insert(a)
+            db.session.commit()
+        self.assertEqual(self.timeline(),
+                         ["a"] + list(reversed(names)) + ["z"])
+        self.assertTrue(smallest_gap(self.universe) > 1)
+
+    def test_rebalance_dense(self):
+        for i, name in enumerate("abc"):
+            comic = self.make_comic(name)
+            comic.position = i
+            db.session.add(comic)
+        db.session.commit()
+        self.assertEqual(smallest_gap(self.universe), 1)
+        self.assertEqual(rebalance_positions(self.universe), 2)
+        db.session.commit()
+        self.assertEqual(smallest_gap(self.universe), POSITION_GAP)
+        self.assertEqual(self.timeline(), ["a", "b", "c"])
+
+
+class TestMarkupMixin(unittest.TestCase):
+
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite://"
+
+        db.init_app(self.app)
+        self.ctx = self.app.test_request_context()
+        self.ctx.push()
+        db.create_all()
+
+        self.thread = Thread(None, u"Subject", u"Anonymous")
+        db.session.add(self.thread)
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.ctx.pop()
+
+    def make_post(self, comment):
+        post = Post(u"Anonymous", comment, "", None)
+        post.thread = self.thread
+        db.session.add(post)
+        db.session.commit()
+        return post
+
+    def test_rendered_on_insert(self):
+        post = self.make_post(u"*hi* <b>")
+        self.assertEqual(post.markup_version, MARKUP_VERSION)
+        self.assertEqual(post.comment_html, u"<p><i>hi</i> &lt;b&gt;</p>")
+        self.assertEqual(post.html("comment"), post.comment_html)
+
+    def test_rendered_on_update(self):
+        post = self.make_post(u"*hi*")
+        post.comment = u"**bye**"
+        db.session.commit()
+        self.assertEqual(post.comment_html, u"<p><b>bye</b></p>")
+
+    def test_empty(self):
+        post = self.make_post(None)
+        self.assertEqual(post.comment_html, None)
+        self.assertEqual(post.html("comment"), u"")
+
+    def test_stale_version(self):
+        post = self.make_post(u"*hi*")
+        post.comment_html = u"stale"
+        post.markup_version = MARKUP_VERSION - 1
+        self.assertEqual(post.html("comment"), u"<p><i>hi</i></p>")
+
+class TestThreadBump(unittest.TestCase):
+
+    def setUp(self):
+        self.thread = Thread(None, u"Subject", u"Anonymous")
+        self.thread.bumped = datetime(2012, 1, 1)
+
+    def make_post(self, email):
+        post = Post(u"Anonymous", u"A comment.", email, None)
+        post.timestamp = datetime(2012, 2, 1)
+        return post
+
+    def test_bump(self):
+        self.thread.bump(self.make_post(""))
+        self.assertEqual(self.thread.bumped, datetime(2012, 2, 1))
+
+    def test_sage(self):
+        for email in ("sage", " SAGE "):
+            self.thread.bump(self.make_post(email))
+            self.assertEqual(self.thread.bumped, datetime(2012, 1, 1))
+
+    def test_no_email(self):
+        self.thread.bump(self.make_post(None))
+        self.assertEqual(self.thread.bumped, datetime(2012, 2, 1))
+
+class TestPostsPage(unittest.TestCase):
+
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite://"
+
+        db.init_app(self.app)
+        self.ctx = self.app.test_request_context()
+        self.ctx.push()
+        db.create_all()
+
+        self.thread = Thread(None, u"Subject", u"Anonymous")
+        db.session.add(self.thread)
+        db.session.flush()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.ctx.pop()
+
+    def make_posts(self, *minutes):
+        for i, minute in enumerate(minutes):
+            post = Post(u"Anonymous", u"%d" % i, "", None)
+            post.timestamp = datetime(2012, 1, 1, 0, minute)
+            post.threadid = self.thread.id
+            db.session.add(post)
+        db.session.commit()
+
+    def pages(self, limit):
+        pages = []
+        before = None
+        while True:
+            posts, before = posts_page(self.thread.id, before, limit)
+            pages.append([post.comment for post in posts])
+            if before is None:
+                return pages
+
+    def test_empty(self):
+        self.assertEqual(posts_page(self.thread.id), ([], None))
+
+    def test_single_page(self):
+        self.make_posts(0, 1, 2)
+        self.assertEqual(self.pages(3), [[u"0", u"1", u"2"]])
+
+    def test_pages(self):
+        self.make_posts(0, 1, 2, 3, 4)
+        self.assertEqual(self.pages(2),
+                         [[u"3", u"4"], [u"1", u"2"], [u"0"]])
+
+    def test_timestamp_order(self):
+        self.make_posts(5, 0, 3, 1)
+        self.assertEqual(self.pages(2), [[u"2", u"0"], [u"1", u"3"]])
+
+    def test_same_timestamp(self):
+        self.make_posts(1, 1, 1, 0, 1)
+        self.assertEqual(self.pages(2),
+                         [[u"2", u"4"], [u"0", u"1"], [u"3"]])
+
+class TestThreadCounters(unittest.TestCase):
+
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite://"
+
+        db.init_app(self.app)
+        self.ctx = self.app.test_request_context()
+        self.ctx.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.ctx.pop()
+
+    def make_post(self, filename=None, email=""):
+        return Post(u"Anonymous", u"A comment.", email, filename)
+
+    def test_new_thread(self):
+        thread = Thread(None, u"Subject", u"Anonymous")
+        post = self.make_post("a.png")
+        thread.add_post(post)
+        db.session.add(thread)
+        db.session.commit()
+
+        self.assertEqual(post.threadid, thread.id)
+        self.assertEqual(thread.post_count, 1)
+        self.assertEqual(thread.image_count, 1)
+        self.assertEqual(thread.last_post, post.timestamp)
+
+    def test_existing_thread(self):
+        thread = Thread(None, u"Subject", u"Anonymous")
+        db.session.add(thread)
+        db.session.commit()
+
+        for filename in (None, "a.png", None):
+            post = self.make_post(filename)
+            thread.add_post(post)
+            db.session.add(post)
+        db.session.commit()
+
+        self.assertEqual(thread.post_count, 3)
+        self.assertEqual(thread.image_count, 1)
+        self.assertEqual(thread.last_post, post.timestamp)
+        self.assertEqual(Post.query.filter_by(threadid=thread.id).count(), 3)
+
+    def test_sage(self):
+        thread = Thread(None, u"Subject", u"Anonymous")
+        thread.bumped = datetime(2012, 1, 1)
+        db.session.add(thread)
+        db.session.commit()
+
+        post = self.make_post(email="sage")
+        thread.add_post(post)
+        db.session.add(post)
+        db.session.commit()
+
+        self.assertEqual(thread.bumped, datetime(2012, 1, 1))
+        self.assertEqual(thread.last_post, post.timestamp)
+
+class TestUploadCounts(unittest.TestCase):
+
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite://"
+        self.app.config["DCON_UPLOAD_PATH"] = FilePath(mkdtemp())
+
+        db.init_app(self.app)
+        self.ctx = self.app.test_request_context()
+        self.ctx.push()
+        db.create_all()
+
+        self.fp = self.app.config["DCON_UPLOAD_PATH"].descendant(
+            sharded(["comments", "a.png"]))
+        self.fp.parent().makedirs()
+        self.fp.setContent("image")
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.ctx.pop()
+
+    def make_post(self):
+        thread = Thread(None, u"Subject", u"Anonymous")
+        post = Post(u"Anonymous", u"A comment.", "", "a.png")
+        thread.add_post(post)
+        db.session.add(thread)
+        db.session.commit()
+        return post
+
+    def refcount(self):
+        upload = Upload.query.get("a.png")
+        return upload and upload.refcount
+
+    def test_counted(self):
+        self.make_post()
+        self.make_post()
+        self.assertEqual(self.refcount(), 2)
+
+    def test_delete_shared(self):
+        first = self.make_post()
+        self.make_post()
+
+        db.session.delete(first)
+        db.session.commit()
+
+        self.assertEqual(self.refcount(), 1)
+        self.assertTrue(self.fp.exists())
+
+    def test_delete_last(self):
+        first = self.make_post()
+        second = self.make_post()
+
+        db.session.delete(first)
+        db.session.delete(second)
+        db.session.commit()
+
+        self.assertEqual(self.refcount(), None)
+        self.assertFalse(self.fp.exists())
+
+    def test_delete_from_thread(self):
+        first = self.make_post()
+        second = Post(u"Anonymous", u"Another comment.", "", "a.png")
+        first.thread.add_post(second)
+        db.session.add(second)
+        db.session.commit()
+        thread = first.thread
+
+        db.session.delete(first)
+        db.session.commit()
+
+        self.assertEqual(thread.posts, [second])
+        self.assertEqual(thread.post_count, 1)
+        self.assertEqual(thread.image_count, 1)
+        self.assertEqual(self.refcount(), 1)
+        self.assertTrue(self.fp.exists())
+
+    def test_released_but_taken(self):
+        # Released by one commit, then taken again by another post before
+        # the file was removed.
+        self.make_post()
+        db.session().info["released_uploads"] = [("a.png", self.fp)]
+        db.session.commit()
+
+        self.assertTrue(self.fp.exists())
+
+    def test_delete_rolled_back(self):
+        post = self.make_post()
+
+        db.session.delete(post)
+        db.session.flush()
+        db.session.rollback()
+
+        self.assertEqual(self.refcount(), 1)
+        self.assertTrue(self.fp.exists())
+
+    def test_uncounted(self):
+        post = self.make_post()
+        Upload.query.delete()
+        db.session.commit()
+
+        db.session.delete(post)
+        db.session.commit()
+
+        self.assertTrue(self.fp.exists())
+
+
+class TestRevisions(unittest.TestCase):
+
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite://"
+        self.app.config["DCON_UPLOAD_PATH"] = FilePath(mkdtemp())
+
+        db.init_app(self.app)
+        self.ctx = self.app.test_request_context()
+        self.ctx.push()
+        db.create_all()
+
+        self.universe = Universe(u"Testing")
+        self.character = Character(self.universe, u"Alice")
+        self.comic = Comic(self.universe, "a.png")
+        self.comic.retitle(u"A")
+        self.comic.position = 0
+        self.comic.thread = Thread(None, u"A", u"DCoN")
+        db.session.add(self.comic)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.ctx.pop()
+
+    def universe_revision(self):
+        q = db.session.query(Universe.revision)
+        return q.filter_by(slug=self.universe.slug).scalar()
+
+    def thread_revision(self):
+        q = db.session.query(Thread.revision)
+        return q.filter_by(id=self.comic.threadid).scalar()
+
+    def test_comic(self):
+        before = self.universe_revision()
+        self.comic.retitle(u"B")
+        db.session.commit()
+        self.assertTrue(self.universe_revision() > before)
+
+    def test_cast(self):
+        before = self.universe_revision()
+        self.comic.characters = [self.character]
+        db.session.commit()
+        self.assertTrue(self.universe_revision() > before)
+
+    def test_character(self):
+        before = self.universe_revision()
+        self.character.major = True
+        db.session.commit()
+        self.assertTrue(self.universe_revision() > before)
+
+    def test_post(self):
+        before = self.thread_revision()
+        post = Post(u"Anonymous", u"Hi", "", None)
+        self.comic.thread.add_post(post)
+        db.session.add(post)
+        db.session.commit()
+        added = self.thread_revision()
+        self.assertTrue(added > before)
+
+        post.derivatives_version = 1
+        db.session.commit()
+        self.assertTrue(self.thread_revision() > added)
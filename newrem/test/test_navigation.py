@@ -0,0 +1,110 @@
+from collections import namedtuple
+from datetime import datetime
+from unittest import TestCase
+
+from newrem.navigation import NavigationIndex
+
+
+FauxComic = namedtuple("FauxComic", "id, time, position")
+
+
+def day(d):
+    return datetime(2012, 1, d)
+
+
+class TestNavigationIndex(TestCase):
+
+    def setUp(self):
+        # Uploaded in ID order, but the third comic belongs at the start of
+        # the story, and the fifth has not been published yet.
+        self.comics = [
+            FauxComic(1, day(1), 1024),
+            FauxComic(2, day(2), 2048),
+            FauxComic(3, day(3), 0),
+            FauxComic(4, day(4), 3072),
+            FauxComic(5, day(10), 1536),
+        ]
+        self.index = NavigationIndex(self.comics)
+        self.now = day(5)
+
+    def test_published(self):
+        self.assertEqual(self.index.published(self.now), 4)
+
+    def test_upload_neighbors_middle(self):
+        result = self.index.upload_neighbors(self.comics[1], self.now)
+        self.assertEqual(result, (1, 1, 3, 4))
+
+    def test_upload_neighbors_first(self):
+        result = self.index.upload_neighbors(self.comics[0], self.now)
+        self.assertEqual(result, (None, None, 2, 4))
+
+    def test_upload_neighbors_last_skips_unpublished(self):
+        result = self.index.upload_neighbors(self.comics[3], self.now)
+        self.assertEqual(result, (1, 3, None, None))
+
+    def test_upload_neighbors_after_publication(self):
+        result = self.index.upload_neighbors(self.comics[3], day(11))
+        self.assertEqual(result, (1, 3, 5, 5))
+
+    def test_story_neighbors(self):
+        result = self.index.story_neighbors(self.comics[0], self.now)
+        self.assertEqual(result, (3, 2))
+
+    def test_story_neighbors_skips_unpublished(self):
+        result = self.index.story_neighbors(self.comics[1], self.now)
+        self.assertEqual(result, (1, 4))
+
+    def test_story_neighbors_ends(self):
+        self.assertEqual(
+            self.index.story_neighbors(self.comics[2], self.now), (None, 1))
+        self.assertEqual(
+            self.index.story_neighbors(self.comics[3], self.now), (2, None))
+
+    def test_next_publication(self):
+        self.assertEqual(self.index.next_publication(self.now), day(10))
+        self.assertEqual(self.index.next_publication(day(11)), None)
+
+    def test_newest(self):
+        self.assertEqual(self.index.newest(self.now), day(4))
+        self.assertEqual(self.index.newest(day(1)), None)
+
+    def test_empty(self):
+        index = NavigationIndex([])
+        self.assertEqual(index.published(self.now), 0)
+        self.assertEqual(index.newest(self.now), None)
+        self.assertEqual(index.next_publication(self.now), None)
+
+
+class TestCharacterNeighbors(TestCase):
+
+    def setUp(self):
+        self.comics = [
+            FauxComic(1, day(1), 0),
+            FauxComic(2, day(2), 1024),
+            FauxComic(3, day(3), 2048),
+            FauxComic(4, day(10), 3072),
+            FauxComic(5, day(4), 4096),
+        ]
+        cast = [
+            ("alice", 1), ("alice", 3), ("alice", 4), ("alice", 5),
+            ("bob", 2), ("bob", 3),
+            # Somebody else's comic; ignored.
+            ("bob", 99),
+        ]
+        self.index = NavigationIndex(self.comics, cast)
+        self.now = day(5)
+
+    def test_character_neighbors(self):
+        result = self.index.character_neighbors(self.comics[2],
+            ["alice", "bob"], self.now)
+        self.assertEqual(result, {"alice": (1, 5), "bob": (2, None)})
+
+    def test_character_neighbors_published(self):
+        result = self.index.character_neighbors(self.comics[2], ["alice"],
+            day(11))
+        self.assertEqual(result, {"alice": (1, 4)})
+
+    def test_character_neighbors_unknown(self):
+        result = self.index.character_neighbors(self.comics[0], ["carol"],
+            self.now)
+        self.assertEqual(result, {"carol": (None, None)})
@@ -0,0 +1,56 @@
+from unittest import TestCase
+
+from sqlalchemy import (Column, Index, Integer, MetaData, String, Table,
+                        create_engine, inspect)
+
+from newrem.schema import missing_columns, missing_indexes, upgrade
+
+
+def make_metadata(new=False):
+    metadata = MetaData()
+    table = Table("things", metadata,
+        Column("id", Integer, primary_key=True),
+        Column("name", String(30)),
+    )
+    if new:
+        table.append_column(Column("slug", String(30)))
+        Index("ix_things_name", table.c.name)
+    return metadata
+
+
+class TestUpgrade(TestCase):
+
+    def setUp(self):
+        self.engine = create_engine("sqlite://")
+        make_metadata().create_all(self.engine)
+        self.engine.execute("INSERT INTO things (name) VALUES ('one')")
+        self.metadata = make_metadata(new=True)
+
+    def test_missing(self):
+        columns = missing_columns(self.engine, self.metadata)
+        self.assertEqual([c.name for c in columns], ["slug"])
+        indexes = missing_indexes(self.engine, self.metadata)
+        self.assertEqual([i.name for i in indexes], ["ix_things_name"])
+
+    def test_upgrade(self):
+        changes = upgrade(self.engine, self.metadata)
+        self.assertEqual(len(changes), 2)
+
+        inspector = inspect(self.engine)
+        names = [c["name"] for c in inspector.get_columns("things")]
+        self.assertTrue("slug" in names)
+        names = [i["name"] for i in inspector.get_indexes("things")]
+        self.assertEqual(names, ["ix_things_name"])
+
+        # Existing rows survive.
+        rows = self.engine.execute("SELECT name, slug FROM things").fetchall()
+        self.assertEqual([tuple(row) for row in rows], [(u"one", None)])
+
+    def test_upgrade_idempotent(self):
+        upgrade(self.engine, self.metadata)
+        self.assertEqual(upgrade(self.engine, self.metadata), [])
+
+    def test_upgrade_new_table(self):
+        engine = create_engine("sqlite://")
+        changes = upgrade(engine, self.metadata)
+        self.assertEqual(changes, ["created table things"])
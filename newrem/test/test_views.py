@@ -0,0 +1,139 @@
+from datetime import datetime, timedelta
+from shutil import rmtree
+from tempfile import mkdtemp
+import unittest
+
+from bp.filepath import FilePath
+
+from sqlalchemy import event
+
+from flask import Flask
+
+from newrem.models import db, Character, Comic, Post, Thread, Universe
+from newrem.views import archive_entries, universe_state
+
+
+class TestArchiveEntries(unittest.TestCase):
+
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite://"
+        self.app.config["DCON_UPLOAD_PATH"] = FilePath(mkdtemp())
+
+        db.init_app(self.app)
+        self.ctx = self.app.test_request_context()
+        self.ctx.push()
+        db.create_all()
+
+        self.universe = Universe(u"Testing")
+        alice = Character(self.universe, u"Alice")
+        alice.major = True
+        bob = Character(self.universe, u"Bob")
+
+        # Story order is the reverse of upload order.
+        for i in range(20):
+            comic = Comic(self.universe, "%d.png" % i)
+            comic.retitle(u"Comic %d" % i)
+            comic.time = datetime(2012, 1, 1) + timedelta(days=i)
+            comic.position = 20 - i
+            comic.characters = [[], [bob, alice], [alice]][i % 3]
+            db.session.add(comic)
+
+        comic.time = datetime.now() + timedelta(days=1)
+        db.session.commit()
+
+        self.now = datetime.now()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.ctx.pop()
+        rmtree(self.app.config["DCON_UPLOAD_PATH"].path)
+
+    def test_entries(self):
+        entries = archive_entries(self.universe, self.now)
+
+        self.assertEqual([comic.title for comic, cast in entries][:2],
+                         [u"Comic 18", u"Comic 17"])
+        self.assertEqual(len(entries), 19)
+
+        casts = dict((comic.title, cast) for comic, cast in entries)
+        self.assertEqual(casts[u"Comic 0"], [])
+        self.assertEqual(casts[u"Comic 1"],
+                         [("alice", u"Alice", True), ("bob", u"Bob", False)])
+        self.assertEqual(casts[u"Comic 2"], [("alice", u"Alice", True)])
+
+    def test_queries(self):
+        statements = []
+        # Refresh the universe, which the commit expired, before counting.
+        self.universe.slug
+
+        def count(*args):
+            statements.append(args)
+
+        engine = db.get_engine(self.app)
+        event.listen(engine, "before_cursor_execute", count)
+        try:
+            archive_entries(self.universe, self.now)
+        finally:
+            event.remove(engine, "before_cursor_execute", count)
+
+        self.assertEqual(len(statements), 2)
+
+
+class TestUniverseState(unittest.TestCase):
+
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite://"
+        self.app.config["DCON_UPLOAD_PATH"] = FilePath(mkdtemp())
+
+        db.init_app(self.app)
+        self.ctx = self.app.test_request_context()
+        self.ctx.push()
+        db.create_all()
+
+        self.universe = Universe(u"Testing")
+        for i in range(2):
+            comic = Comic(self.universe, "%d.png" % i)
+            comic.retitle(u"Comic %d" % i)
+            comic.time = datetime(2012, 1, 1 + i)
+            comic.position = i
+            comic.thread = Thread(None, comic.title, u"DCoN")
+            db.session.add(comic)
+        comic.time = datetime.now() + timedelta(days=1)
+        db.session.commit()
+
+        self.comic = Comic.query.get(1)
+        self.now = datetime.now()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.ctx.pop()
+        rmtree(self.app.config["DCON_UPLOAD_PATH"].path)
+
+    def state(self):
+        return universe_state(self.universe, self.now, self.comic.id)
+
+    def test_newest(self):
+        revision, newest, thread = self.state()
+        self.assertEqual(newest, datetime(2012, 1, 1))
+
+    def test_edit(self):
+        before = self.state()
+        Comic.query.get(2).retitle(u"Spoilers")
+        db.session.commit()
+        self.assertNotEqual(self.state(), before)
+
+    def test_post(self):
+        before = self.state()
+        post = Post(u"Anonymous", u"Hi", "", None)
+        self.comic.thread.add_post(post)
+        db.session.add(post)
+        db.session.commit()
+        self.assertNotEqual(self.state(), before)
+
+    def test_other_comic(self):
+        state = universe_state(self.universe, self.now, 3)
+        self.assertEqual(state[2], None)
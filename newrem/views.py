@@ -3,28 +3,42 @@ import os.path
 from operator import attrgetter
 from random import choice
 
+from sqlalchemy import func
 from sqlalchemy.orm.exc import NoResultFound
 
-from jinja2.exceptions import TemplateNotFound
+from jinja2 import Markup
 
-from flask import abort, flash, redirect, render_template, request, url_for
+from flask import (abort, flash, redirect, render_template, request,
+    session, url_for)
 from flask.ext.holster.main import init_holster
 from flask.ext.login import current_user
 
 from newrem.app import DCoN
-from newrem.converters import make_model_converter
+from newrem.cache import cache, timeout_until
+from newrem.conditional import (conditional, is_fresh, make_etag,
+    not_modified, with_validators)
+from newrem.converters import make_model_converter, merge_view_args
 from newrem.decorators import cached
-from newrem.files import assets_in_paths, save_file
+from newrem.files import assets_in_paths, fp_root, save_upload
 from newrem.filters import url_for_comic
 from newrem.forms import CommentForm
-from newrem.grammars import BlogGrammar
-from newrem.models import (db, Board, Character, Comic, Newspost, Post,
-    Universe)
-from newrem.util import chan_filename, make_rss2
+from newrem.jobs import queue
+from newrem.markup import blogify, eblogify
+from newrem.models import (db, casts, Board, Character, Comic, Newspost,
+    Post, Thread, Universe, posts_page)
+from newrem.navigation import navigation_for
+from newrem.util import make_rss2
 
 app = DCoN(__name__)
 init_holster(app)
 
+# Cached comic pages carry this marker where the discussion form goes, since
+# that form is different for every visitor.
+DISCUSSION_MARKER = u"<!-- dcon:discussion -->"
+
+# How many posts of a comic's discussion to show at once.
+POSTS_PER_PAGE = 50
+
 # Register converters.
 app.url_map.converters["board"] = make_model_converter(app, Board,
     "abbreviation")
@@ -35,21 +49,12 @@ app.url_map.converters["newspost"] = make_model_converter(app, Newspost,
 app.url_map.converters["universe"] = make_model_converter(app, Universe,
     "slug")
 
-@app.template_filter()
-def blogify(s):
-    """
-    Run a string through a grammar to prettify it somewhat.
-    """
+@app.url_value_preprocessor
+def attach_view_args(endpoint, values):
+    merge_view_args(db.session, values)
 
-    return BlogGrammar(s).paragraphs()
-
-@app.template_filter()
-def eblogify(s):
-    """
-    Like ``blogify``, but also apply HTML escapes. For untrusted input.
-    """
-
-    return BlogGrammar(s).safe_paragraphs()
+app.template_filter()(blogify)
+app.template_filter()(eblogify)
 
 def get_comic_query(universe):
     """
@@ -69,25 +74,52 @@ def get_comic_query(universe):
 def get_neighbors_for(universe, comic):
     """
     Grab the comics around a given comic.
+
+    The neighbors are found in the universe's navigation index, and then
+    loaded together in one query. Besides the "upload" and "chrono"
+    neighbors, "characters" maps the slug of each character in the comic to
+    their previous and next appearances.
     """
 
-    comics = {}
+    index = navigation_for(universe)
+    now = datetime.now()
 
     # Grab the comics corresponding to navigation buttons: First, previous,
-    # next, last. This first query doesn't need to have the temporal filter.
-    q = Comic.query.filter(Comic.universe == universe)
-    q = q.filter(Comic.time < comic.time)
-    a = q.order_by(Comic.time).first()
-    b = q.order_by(Comic.time.desc()).first()
+    # next, last. And then previous and next in the story, overall and for
+    # each character.
+    upload = index.upload_neighbors(comic, now)
+    chrono = index.story_neighbors(comic, now)
+    slugs = [character.slug for character in comic.characters]
+    appearances = index.character_neighbors(comic, slugs, now)
+
+    ids = list(upload + chrono)
+    for pair in appearances.itervalues():
+        ids.extend(pair)
+    found = load_comics(ids)
 
-    q = get_comic_query(universe).filter(Comic.time > comic.time)
-    c = q.order_by(Comic.time).first()
-    d = q.order_by(Comic.time.desc()).first()
+    comics = {}
 
-    comics["upload"] = a, b, c, d
+    comics["upload"] = tuple(found.get(cid) for cid in upload)
+    comics["chrono"] = tuple(found.get(cid) for cid in chrono)
+    comics["characters"] = dict(
+        (slug, tuple(found.get(cid) for cid in pair))
+        for slug, pair in appearances.iteritems())
 
     return comics
 
+def load_comics(ids):
+    """
+    Load several comics by ID at once, returning a dictionary of IDs to
+    comics.
+    """
+
+    ids = set(cid for cid in ids if cid is not None)
+    if not ids:
+        return {}
+
+    return dict((comic.id, comic)
+                for comic in Comic.query.filter(Comic.id.in_(ids)))
+
 @app.route("/")
 def index():
     universes = Universe.query.all()
@@ -115,8 +147,6 @@ def universe_context(app, u):
 
 @app.route("/<universe:u>/cast")
 def cast(u):
-    # Re-add the universe to the session so that we can query it.
-    db.session.add(u)
     q = Character.query.filter_by(universe=u, major=True)
     characters = sorted(q.all(), key=attrgetter("name"))
 
@@ -125,10 +155,7 @@ def cast(u):
         "characters": characters,
     })
 
-    try:
-        return render_template("universe/%s/cast.html" % u.slug, **context)
-    except TemplateNotFound:
-        return render_template("universe/cast.html", **context)
+    return render_template(app.universe_template(u, "cast.html"), **context)
 
 
 @app.route("/<universe:u>/")
@@ -179,60 +206,185 @@ def recent(u):
         return redirect(url_for_comic(comic))
 
 
+def universe_state(u, now, cid=None):
+    """
+    Read what pages about a universe depend on: the universe's revision, the
+    time its newest comic went live and, for a comic, the revision of its
+    thread.
+
+    These come straight from the database, in one query, so that every
+    process agrees on them.
+    """
+
+    q = db.session.query(func.max(Comic.time))
+    newest = q.filter(Comic.universe_fk == u.slug, Comic.time < now)
+
+    q = db.session.query(Thread.revision)
+    q = q.join(Comic, Comic.threadid == Thread.id)
+    thread = q.filter(Comic.id == cid, Comic.universe_fk == u.slug)
+
+    q = db.session.query(Universe.revision,
+                         newest.as_scalar().label("newest"),
+                         thread.as_scalar().label("thread"))
+    row = q.filter(Universe.slug == u.slug).first()
+
+    if row is None:
+        return None, None, None
+    return tuple(row)
+
+
+def comic_page_key(u, cid, char):
+    """
+    Make the cache key for a rendered comic page, for a character of the
+    universe or None.
+
+    Pages are filed under the state of their universe and of their comic's
+    thread, as read by ``universe_state()``, so they are replaced as soon as
+    anything on them changes, whichever process changed it.
+    """
+
+    state = universe_state(u, datetime.now(), cid)
+    slug = char.slug if char is not None else ""
+    return "comic-page:%s:%d:%s:%s" % (u.slug, cid, slug, make_etag(*state))
+
+
+def fill_discussion(page, u, cid):
+    """
+    Finish a cached comic page for the current visitor by rendering the
+    discussion form into it.
+    """
+
+    context = {
+        "u": u,
+        "cid": cid,
+    }
+
+    if not current_user.is_anonymous():
+        context["ocform"] = CommentForm()
+
+    fragment = render_template("universe/discussion.html", **context)
+    return page.replace(DISCUSSION_MARKER, fragment, 1)
+
+
 @app.route("/<universe:u>/comics/<int:cid>/<name>")
 @app.route("/<universe:u>/comics/<int:cid>")
 def comics(u, cid, name=None):
     # The name is purely decorative.
-    try:
-        comic = get_comic_query(u).filter_by(id=cid).one()
-    except NoResultFound:
-        abort(404)
-
     char = request.args.get("char", None)
+
+    # Only real characters get pages of their own in the cache; anything
+    # else gets a flashed message, and those pages aren't cached.
     if char is not None:
         char = Character.query.filter_by(universe=u, slug=char).first()
         if char is None:
             flash("That character doesn't exist, and typing them into the "
                 "URL doesn't magically spring them into the comic. Sorry.")
-        elif char not in comic.characters:
+
+    key = comic_page_key(u, cid, char)
+
+    # Signed-in visitors get a comment form whose CSRF token expires, so
+    # their copies are never revalidated.
+    anonymous = current_user.is_anonymous()
+    etag = make_etag(key)
+
+    # Pages are only cached when they aren't carrying any flashed messages,
+    # so don't serve a cached page to somebody who has some waiting.
+    if not session.get("_flashes"):
+        if anonymous and is_fresh(etag):
+            return not_modified(etag)
+
+        entry = cache.get(key)
+        if entry is not None:
+            page, last_modified = entry
+            if not anonymous:
+                return fill_discussion(page, u, cid)
+            if is_fresh(etag, last_modified):
+                return not_modified(etag, last_modified)
+            return with_validators(fill_discussion(page, u, cid), etag,
+                                   last_modified)
+
+    try:
+        comic = get_comic_query(u).filter_by(id=cid).one()
+    except NoResultFound:
+        abort(404)
+
+    if char is not None:
+        if char not in comic.characters:
             flash("That character isn't in this particular comic, and won't "
                 "be, no matter how hard you wish. Sorry.")
             char = None
 
     comics = get_neighbors_for(u, comic)
-
-    before = get_comic_query(u).filter(Comic.position < comic.position)
-    # And reverse it for first() and such.
-    before = before.order_by(Comic.position.desc())
-    after = get_comic_query(u).filter(Comic.position > comic.position)
-    after = after.order_by(Comic.position)
-
-    chrono = before.first(), after.first()
+    chrono = comics["chrono"]
 
     cdict = {}
 
     for character in comic.characters:
-        pred = Comic.characters.any(Character.slug == character.slug)
-        previous = before.filter(pred).first()
-        next = after.filter(pred).first()
-
+        previous, next = comics["characters"][character.slug]
         cdict[character.slug] = character, previous, next
 
+    posts, older = posts_page(comic.threadid, limit=POSTS_PER_PAGE)
+
+    # The page changes when the comic does, when its thread gets a new post,
+    # and when a new comic goes live and shows up in the navigation.
+    newest_post = posts[-1].timestamp if posts else None
+    newest_comic = navigation_for(u).newest(datetime.now())
+    last_modified = max(t for t in (comic.time, newest_post, newest_comic)
+                        if t is not None)
+
     context = universe_context(app, u)
     context.update({
         "comic": comic,
         "comics": comics,
         "chrono": chrono,
         "characters": cdict,
+        "discussion": Markup(DISCUSSION_MARKER),
+        "posts": posts,
+        "older": older,
     })
 
-    if not current_user.is_anonymous():
-        context["ocform"] = CommentForm()
+    cacheable = not session.get("_flashes")
+
+    page = render_template(app.universe_template(u, "comics.html"), **context)
+
+    if cacheable:
+        # The next and last links change when the next comic goes live.
+        when = universe_next_publication(u)
+        cache.set(key, (page, last_modified), timeout=timeout_until(when))
+        if anonymous:
+            return with_validators(fill_discussion(page, u, cid), etag,
+                                   last_modified)
+
+    return fill_discussion(page, u, cid)
+
+
+def older_posts_validators(u, cid):
+    revision, newest, thread = universe_state(u, datetime.now(), cid)
+    before = request.args.get("before", type=int)
+    return make_etag(thread, before), None
+
+@app.route("/<universe:u>/comics/<int:cid>/posts")
+@conditional(older_posts_validators)
+def older_posts(u, cid):
+    """
+    Render a page of older posts from a comic's discussion, as a fragment
+    to be added to the comic page.
+    """
+
+    before = request.args.get("before", type=int)
+    if before is None:
+        abort(404)
 
     try:
-        return render_template("universe/%s/comics.html" % u.slug, **context)
-    except TemplateNotFound:
-        return render_template("universe/comics.html", **context)
+        comic = get_comic_query(u).filter_by(id=cid).one()
+    except NoResultFound:
+        abort(404)
+
+    posts, older = posts_page(comic.threadid, before,
+                              limit=POSTS_PER_PAGE)
+
+    return render_template("universe/posts.html", u=u, comic=comic,
+        posts=posts, older=older)
 
 
 @app.route("/<universe:u>/comics/<int:cid>/comment", methods=("POST",))
@@ -254,20 +406,46 @@ def comment(u, cid):
             name = current_user.username
 
         post = Post(name, form.comment.data, "", None)
-        post.thread = comic.thread
 
         image = form.datafile.file
         if image:
-            post.filename = chan_filename(image)
-            save_file(post.fp(), image)
+            directory = fp_root(app).child("comments")
+            post.filename = save_upload(image, directory)
 
+        comic.thread.add_post(post)
         db.session.add(post)
         db.session.commit()
 
+        if post.filename:
+            queue.enqueue("derive", model="post", id=post.id)
+
     return redirect(url_for_comic(comic))
 
+def next_publication():
+    """
+    Find the time at which the next scheduled comic in any universe goes live.
+    """
+
+    q = db.session.query(func.min(Comic.time))
+    return q.filter(Comic.time >= datetime.now()).scalar()
+
+def universe_next_publication(u):
+    return navigation_for(u).next_publication(datetime.now())
+
+def feed_validators():
+    q = db.session.query(func.max(Comic.time))
+    newest = q.filter(Comic.time < datetime.now()).scalar()
+    q = db.session.query(Universe.slug, Universe.revision)
+    revisions = [tuple(row) for row in q.order_by(Universe.slug)]
+    return make_etag(newest, *revisions), newest
+
+def universe_feed_validators(u):
+    revision, newest, thread = universe_state(u, datetime.now())
+    return make_etag(u.slug, revision, newest), newest
+
 @app.route("/rss.xml")
-@cached
+@conditional(feed_validators)
+@cached(lambda: [("comics",)], next_publication)
 def rss():
     # Filter out comics that have not yet gone live.
     q = Comic.query.filter(Comic.time < datetime.now())
@@ -282,7 +460,8 @@ def rss():
     return make_rss2(link, "DCoN", stuff)
 
 @app.route("/<universe:u>/rss.xml")
-@cached
+@conditional(universe_feed_validators)
+@cached(lambda u: [("universe", u.slug)], universe_next_publication)
 def universe_rss(u):
     q = get_comic_query(u).order_by(Comic.time.desc())
     comics = q[:10]
@@ -295,6 +474,46 @@ def universe_rss(u):
 
     return make_rss2(link, u.title, stuff)
 
+def archive_entries(u, now):
+    """
+    List the published comics of a universe in story order, each with its
+    cast as (slug, name, major) tuples. Only major characters are on the
+    cast page, so only they can be linked to.
+
+    This takes two queries however many comics there are, and loads only
+    the columns which the archive shows.
+    """
+
+    q = db.session.query(Comic.id, Comic.title, Comic.slug, Comic.time,
+                         Comic.universe_fk)
+    q = q.filter(Comic.universe_fk == u.slug, Comic.time < now)
+    comics = q.order_by(Comic.position, Comic.id).all()
+
+    q = db.session.query(casts.c.comic_id, Character.slug, Character.name,
+                         Character.major)
+    q = q.join(Character, Character.slug == casts.c.character_id)
+    q = q.join(Comic, Comic.id == casts.c.comic_id)
+    q = q.filter(Comic.universe_fk == u.slug, Comic.time < now)
+
+    cast = {}
+    for cid, slug, name, major in q.order_by(Character.name):
+        cast.setdefault(cid, []).append((slug, name, bool(major)))
+
+    return [(comic, cast.get(comic.id, [])) for comic in comics]
+
+
+@app.route("/<universe:u>/archive")
+@conditional(universe_feed_validators)
+@cached(lambda u: [("universe", u.slug)], universe_next_publication)
+def archive(u):
+    context = universe_context(app, u)
+    context.update({
+        "entries": archive_entries(u, datetime.now()),
+    })
+
+    return render_template(app.universe_template(u, "archive.html"),
+                           **context)
+
 @app.errorhandler(404)
 def not_found(error):
     segments = ["404"]